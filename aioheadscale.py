@@ -0,0 +1,361 @@
+# pylint: disable=wrong-import-order
+
+import headscale, deadline, topology, logs, httpx, os, asyncio, functools, contextvars, threading
+from cache              import cache, cache_bypass
+from breaker            import breaker
+from limiter            import limiter
+from concurrent.futures import Future
+
+logger = logs.get_logger(__name__)
+
+##################################################################
+# One event loop thread for all asynchronous Headscale I/O
+##################################################################
+class EventLoopThread():
+    """ Runs an asyncio event loop in a daemon thread.  Any thread or loop can hand it coroutines. """
+    def __init__(self):
+        self.loop   = None
+        self.thread = None
+        self.lock   = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None: return
+            self.loop   = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, name="headscale-io", daemon=True)
+            self.thread.start()
+
+    def running_here(self):
+        """ True when called from a coroutine running on this loop """
+        try: return asyncio.get_running_loop() is self.loop
+        except RuntimeError: return False
+
+    def submit(self, coroutine):
+        """ Schedules coroutine in a copy of the caller's context.  Returns a concurrent.futures.Future. """
+        self.start()
+        context = contextvars.copy_context()
+        future  = Future()
+
+        def copy_result(task):
+            if future.cancelled(): return
+            if task.cancelled(): future.cancel()
+            elif task.exception() is not None: future.set_exception(task.exception())
+            else: future.set_result(task.result())
+
+        def schedule():
+            if not future.set_running_or_notify_cancel():
+                coroutine.close()
+                return
+            self.loop.create_task(coroutine, context=context).add_done_callback(copy_result)
+
+        self.loop.call_soon_threadsafe(schedule)
+        return future
+
+io_loop = EventLoopThread()
+
+def on_io_loop(function):
+    """ Runs the coroutine function on the shared I/O loop, whichever loop awaits it.
+        Connections in the pool belong to that loop, so every request has to run there. """
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        if io_loop.running_here(): return await function(*args, **kwargs)
+        return await asyncio.wrap_future(io_loop.submit(function(*args, **kwargs)))
+    return wrapper
+
+def run(coroutine):
+    """ Blocks the calling (non-loop) thread until coroutine has finished on the I/O loop """
+    return io_loop.submit(coroutine).result()
+
+async def gather(*coroutines, return_exceptions=False):
+    """ Awaits the coroutines concurrently on the I/O loop and returns their results in order """
+    return await asyncio.gather(*coroutines, return_exceptions=return_exceptions)
+
+##################################################################
+# Pooled asynchronous HTTP client
+##################################################################
+class AsyncSingleFlight():
+    """ Lets concurrent callers with the same key share one task and its result.
+        Only used on the I/O loop, so it needs no lock. """
+    def __init__(self):
+        self.calls  = {}  # key -> task in flight
+        self.joined = 0   # Callers that shared another caller's task
+
+    async def do(self, key, function):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(function())
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self.calls.pop(key, None) if self.calls.get(key) is done else None)
+        else: self.joined += 1
+        # A caller that goes away (ie, a closed browser tab or a missed deadline) doesn't cancel the request for the others
+        return await deadline.wait(asyncio.shield(task))
+
+class AsyncHeadscaleClient():
+    """ Owns an httpx.AsyncClient with a keep-alive pool.  The API key and auth failure
+        callbacks are shared with the synchronous headscale.client. """
+    def __init__(self, pool_size=headscale.HS_POOL_SIZE, connect_timeout=headscale.HS_CONNECT_TIMEOUT, read_timeout=headscale.HS_READ_TIMEOUT, keepalive=headscale.HS_KEEPALIVE):
+        self.limits  = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size if keepalive else 0)
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.session = None
+        self.in_flight = AsyncSingleFlight()
+
+    def get_session(self):
+        # Created on first use, from inside the I/O loop that owns its connections
+        if self.session is None:
+            self.session = httpx.AsyncClient(limits=self.limits, timeout=self.timeout, headers={'Accept': 'application/json'})
+        return self.session
+
+    async def request(self, method, url, path, api_key=None, **kwargs):
+        """ Sends a request to the Headscale server at url+path """
+        headers  = kwargs.pop("headers", {})
+        api_key  = api_key if api_key is not None else headscale.client.api_key
+        headers['Authorization'] = 'Bearer '+str(api_key)
+        # Fail fast while Headscale is down instead of waiting on every request
+        breaker.before_request()
+        try:
+            # Wait our turn (see limiter.py), but never past the request's deadline, if it has one
+            async with limiter.slot_async(): response = await deadline.wait(self.get_session().request(method, str(url)+path, headers=headers, **kwargs))
+        except httpx.TransportError:
+            breaker.record_failure()
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        breaker.record_response(response.status_code)
+        if response.status_code in (401, 403):
+            logger.warning("Headscale rejected the API key (%i) for %s", response.status_code, path)
+            # The callbacks write to the shared store
+            for callback in headscale.client.auth_failure_callbacks: await cache.off_loop(callback)
+        return response
+
+    async def get(self, url, path, api_key=None, **kwargs):
+        return await self.request("GET", url, path, api_key, **kwargs)
+
+    async def fetch(self, url, path, api_key=None, generation=None):
+        """ GETs url+path and returns (status_code, parsed JSON).  Concurrent identical
+            calls share one upstream request, so callers must not modify the result.
+            generation is the cache generation of the resource:  a caller that arrives after
+            an invalidation never joins a request that started before it. """
+        async def load():
+            # Shared by callers with different deadlines, so only the HS_* timeouts apply
+            with deadline.unbounded(): response = await self.get(url, path, api_key)
+            return response.status_code, response.json()
+        return await self.in_flight.do((str(url)+path, api_key, generation), load)
+
+    async def post(self, url, path, api_key=None, **kwargs):
+        return await self.request("POST", url, path, api_key, **kwargs)
+
+    async def delete(self, url, path, api_key=None, **kwargs):
+        return await self.request("DELETE", url, path, api_key, **kwargs)
+
+client = AsyncHeadscaleClient()
+
+# GET requests for cacheable resources go through the shared TTL cache.
+# Non-200 responses are returned to the caller but never stored.
+async def cached_get(resource, url, api_key, path):
+    async def load():
+        generation   = await cache.off_loop(cache.generation, resource)
+        status, body = await client.fetch(url, path, api_key, generation)
+        return body, status == 200
+    return await cache.fetch_async(resource, str(url)+path, load)
+
+def result(response, action):
+    """ The {"status", "body"} dict returned by the user-facing mutations """
+    status = "True" if response.status_code == 200 else "False"
+    if response.status_code == 200: logger.info("%s succeeded.", action)
+    else: logger.error("%s failed!  %s", action, str(response.json()))
+    return {"status": status, "body": response.json()}
+
+##################################################################
+# Functions related to API KEYS.  Key renewal stays on the
+# synchronous client (renewal.py), outside of any request.
+##################################################################
+@on_io_loop
+async def test_api_key(url, api_key):
+    response = await client.get(url, "/api/v1/apikey", api_key)
+    return response.status_code
+
+@on_io_loop
+async def get_api_key_info(url, api_key):
+    logger.info("Getting API key information")
+    _, body    = await client.fetch(url, "/api/v1/apikey", api_key)
+    key_prefix = str(api_key[0:10])
+    for key in body["apiKeys"]:
+        if key_prefix == key["prefix"]: return key
+    logger.error("Could not find a valid key in Headscale.  Need a new API key.")
+    return "Key not found"
+
+##################################################################
+# Functions related to MACHINES
+##################################################################
+@on_io_loop
+async def register_machine(url, api_key, machine_key, user):
+    logger.info("Registering machine %s to user %s", str(machine_key), str(user))
+    response = await client.post(url, "/api/v1/machine/register?user="+str(user)+"&key="+str(machine_key), api_key)
+    if response.status_code == 200: await cache.off_loop(cache.invalidate, "machines", "routes")
+    return response.json()
+
+@on_io_loop
+async def set_machine_tags(url, api_key, machine_id, tags_list):
+    logger.info("Setting machine_id %s tag %s", str(machine_id), str(tags_list))
+    response = await client.post(url, "/api/v1/machine/"+str(machine_id)+"/tags", api_key, content=tags_list, headers={'Content-Type': 'application/json'})
+    if response.status_code == 200: await cache.off_loop(cache.invalidate, "machines", "routes")
+    return response.json()
+
+@on_io_loop
+async def move_user(url, api_key, machine_id, new_user):
+    logger.info("Moving machine_id %s to user %s", str(machine_id), str(new_user))
+    response = await client.post(url, "/api/v1/machine/"+str(machine_id)+"/user?user="+str(new_user), api_key)
+    if response.status_code == 200: await cache.off_loop(cache.invalidate, "machines", "routes")
+    return response.json()
+
+@on_io_loop
+async def update_route(url, api_key, route_id, current_state):
+    action = "disable" if current_state == "True" else "enable"
+    logger.info("Updating Route %s:  Action: %s", str(route_id), str(action))
+    response = await client.post(url, "/api/v1/routes/"+str(route_id)+"/"+str(action), api_key)
+    if response.status_code == 200: await cache.off_loop(cache.invalidate, "routes")
+    return response.json()
+
+@on_io_loop
+async def update_routes(url, api_key, route_ids, enabled):
+    """ Puts several routes (ie, both exit routes of a machine) in the same state at once.
+        If any of them fails, the ones already changed are put back.  Returns the state the
+        routes (plus the other routes in their failover groups) are really in afterwards, and
+        under "not_reverted", any route that couldn't be put back. """
+    # Decide from Headscale's current state, not a cached copy
+    token = cache_bypass.set(True)
+    try: routes = {str(route["id"]): route for route in (await get_routes(url, api_key))["routes"]}
+    finally: cache_bypass.reset(token)
+    route_ids = [route_id for route_id in route_ids if route_id in routes]
+    logger.info("Setting routes %s to enabled=%s", ", ".join(route_ids), str(enabled))
+
+    # update_route takes the state the route is in now
+    current_state = "False" if enabled else "True"
+    to_change    = [route_id for route_id in route_ids if routes[route_id]["enabled"] != enabled]
+    responses    = await gather(*(update_route(url, api_key, route_id, current_state) for route_id in to_change), return_exceptions=True)
+    failed       = [route_id for route_id, response in zip(to_change, responses) if isinstance(response, BaseException) or "code" in response]
+    not_reverted = []
+    if failed:
+        changed        = [route_id for route_id in to_change if route_id not in failed]
+        logger.error("Updating routes %s failed.  Reverting routes %s", ", ".join(failed), ", ".join(changed))
+        reverted_state = "True" if enabled else "False"
+        reverts        = await gather(*(update_route(url, api_key, route_id, reverted_state) for route_id in changed), return_exceptions=True)
+        not_reverted   = [route_id for route_id, response in zip(changed, reverts) if isinstance(response, BaseException) or "code" in response]
+        if not_reverted: logger.error("Reverting routes %s failed.  They are left enabled=%s.", ", ".join(not_reverted), str(enabled))
+
+    # Headscale picks new primaries for failover groups, so report every route sharing a (non-exit) prefix
+    prefixes = {routes[route_id]["prefix"] for route_id in route_ids if not topology.is_exit_prefix(routes[route_id]["prefix"])}
+    token = cache_bypass.set(True)
+    try: fresh = (await get_routes(url, api_key))["routes"]
+    finally: cache_bypass.reset(token)
+    return {
+        "status"      : "False" if failed else "True",
+        "failed"      : failed,
+        "not_reverted": not_reverted,
+        "routes"      : [
+            {"id": str(route["id"]), "prefix": route["prefix"], "enabled": route["enabled"], "isPrimary": route["isPrimary"]}
+            for route in fresh if str(route["id"]) in route_ids or route["prefix"] in prefixes
+        ],
+    }
+
+@on_io_loop
+async def get_machines(url, api_key):
+    logger.info("Getting machine information")
+    return await cached_get("machines", url, api_key, "/api/v1/machine")
+
+@on_io_loop
+async def get_machine_info(url, api_key, machine_id):
+    logger.info("Getting information for machine ID %s", str(machine_id))
+    return await cached_get("machines", url, api_key, "/api/v1/machine/"+str(machine_id))
+
+@on_io_loop
+async def delete_machine(url, api_key, machine_id):
+    logger.info("Deleting machine %s", str(machine_id))
+    response = await client.delete(url, "/api/v1/machine/"+str(machine_id), api_key)
+    if response.status_code == 200: await cache.off_loop(cache.invalidate, "machines", "routes")
+    return result(response, "Deleting machine "+str(machine_id))
+
+@on_io_loop
+async def rename_machine(url, api_key, machine_id, new_name):
+    logger.info("Renaming machine %s", str(machine_id))
+    response = await client.post(url, "/api/v1/machine/"+str(machine_id)+"/rename/"+str(new_name), api_key)
+    if response.status_code == 200: await cache.off_loop(cache.invalidate, "machines", "routes")
+    return result(response, "Renaming machine "+str(machine_id))
+
+@on_io_loop
+async def get_routes(url, api_key):
+    logger.info("Getting routes")
+    return await cached_get("routes", url, api_key, "/api/v1/routes")
+
+##################################################################
+# Functions related to USERS
+##################################################################
+@on_io_loop
+async def get_users(url, api_key):
+    logger.info("Getting Users")
+    return await cached_get("users", url, api_key, "/api/v1/user")
+
+@on_io_loop
+async def rename_user(url, api_key, old_name, new_name):
+    logger.info("Renaming user %s to %s.", str(old_name), str(new_name))
+    response = await client.post(url, "/api/v1/user/"+str(old_name)+"/rename/"+str(new_name), api_key)
+    if response.status_code == 200: await cache.off_loop(cache.invalidate, "users", "machines", "routes", "preauth_keys")
+    return result(response, "Renaming user "+str(old_name))
+
+@on_io_loop
+async def delete_user(url, api_key, user_name):
+    logger.info("Deleting a User:  %s", str(user_name))
+    response = await client.delete(url, "/api/v1/user/"+str(user_name), api_key)
+    if response.status_code == 200: await cache.off_loop(cache.invalidate, "users", "preauth_keys")
+    return result(response, "Deleting user "+str(user_name))
+
+@on_io_loop
+async def add_user(url, api_key, data):
+    logger.info("Adding user:  %s", str(data))
+    response = await client.post(url, "/api/v1/user", api_key, content=data, headers={'Content-Type': 'application/json'})
+    if response.status_code == 200: await cache.off_loop(cache.invalidate, "users")
+    return result(response, "Adding user")
+
+##################################################################
+# Functions related to PREAUTH KEYS in USERS
+##################################################################
+@on_io_loop
+async def get_preauth_keys(url, api_key, user_name):
+    logger.info("Getting PreAuth Keys in User %s", str(user_name))
+    return await cached_get("preauth_keys", url, api_key, "/api/v1/preauthkey?user="+str(user_name))
+
+# Upper bound on concurrent PreAuth key requests when loading every user's keys
+PREAUTH_WORKERS = int(os.environ.get("PREAUTH_WORKERS", "8"))
+
+@on_io_loop
+async def get_all_preauth_keys(url, api_key, users):
+    """ Every user's PreAuth keys, fetched concurrently.  Returns {user_name: preauth_keys}.
+        Users whose keys didn't arrive before the request's deadline are left out. """
+    user_names = [user["name"] for user in users["users"]]
+    logger.info("Getting PreAuth keys for %i users", len(user_names))
+    limit      = asyncio.Semaphore(PREAUTH_WORKERS)
+    async def fetch(user_name):
+        async with limit: return await get_preauth_keys(url, api_key, user_name)
+    responses  = await gather(*(fetch(user_name) for user_name in user_names), return_exceptions=True)
+    preauth_keys = {}
+    for user_name, response in zip(user_names, responses):
+        if isinstance(response, deadline.DeadlineExceeded):
+            logger.warning("PreAuth keys for user %s missed the deadline", user_name)
+        elif isinstance(response, BaseException): raise response
+        else: preauth_keys[user_name] = response
+    return preauth_keys
+
+@on_io_loop
+async def add_preauth_key(url, api_key, data):
+    logger.info("Adding PreAuth Key:  %s", str(data))
+    response = await client.post(url, "/api/v1/preauthkey", api_key, content=data, headers={'Content-Type': 'application/json'})
+    if response.status_code == 200: await cache.off_loop(cache.invalidate, "preauth_keys")
+    return result(response, "Adding PreAuth Key")
+
+@on_io_loop
+async def expire_preauth_key(url, api_key, data):
+    logger.info("Expiring PreAuth Key...")
+    response = await client.post(url, "/api/v1/preauthkey/expire", api_key, content=data, headers={'Content-Type': 'application/json'})
+    if response.status_code == 200: await cache.off_loop(cache.invalidate, "preauth_keys")
+    return result(response, "Expiring PreAuth Key")
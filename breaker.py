@@ -0,0 +1,115 @@
+# pylint: disable=wrong-import-order
+
+import logs, os, time, sqlite3, requests, threading
+from store              import shared_store
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logs.get_logger(__name__)
+
+##################################################################
+# Circuit breaker around the Headscale API
+##################################################################
+BREAKER_THRESHOLD = int(os.environ.get("BREAKER_THRESHOLD", "5"))     # Consecutive failures that open the circuit
+BREAKER_RESET     = float(os.environ.get("BREAKER_RESET", "10"))      # Seconds the circuit stays open before a probe
+# Statuses that mean Headscale (or the proxy in front of it) is down.  Any other answer,
+# a 500 for a rejected change included, means Headscale is up.
+OUTAGE_STATUSES   = (502, 503, 504)
+
+class CircuitOpen(requests.exceptions.ConnectionError):
+    """ Raised instead of calling Headscale while the circuit is open """
+
+class CircuitBreaker():
+    """ Closed:  requests go through.  Open:  they fail fast with CircuitOpen.
+        Half open:  one probe request goes through and its result closes or re-opens the circuit.
+        With a shared store, every worker sees when Headscale went away. """
+    def __init__(self, threshold, reset_timeout, shared=None):
+        self.threshold     = threshold
+        self.reset_timeout = reset_timeout
+        self.shared        = shared
+        self.state         = "closed"
+        self.failures      = 0      # Consecutive failures
+        self.opened_at     = 0      # time.monotonic() when the circuit last opened
+        self.probing       = False  # A half open probe is in flight
+        self.last_success  = None   # time.time() of the last good response.  Cached data is "stale since" then.
+        self.lock          = threading.Lock()
+        # State changes are reported from the I/O loop, where a SQLite write could block every
+        # in-flight Headscale call for its whole busy timeout.  One thread writes them, in order.
+        self.writer        = ThreadPoolExecutor(max_workers=1, thread_name_prefix="breaker-publish") if shared is not None else None
+
+    def before_request(self):
+        """ Raises CircuitOpen unless the caller may send its request """
+        with self.lock:
+            if self.state == "closed": return
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.reset_timeout: raise CircuitOpen("Headscale circuit is open")
+                logger.info("Probing Headscale after %.0f seconds", self.reset_timeout)
+                self.state = "half_open"
+            if self.probing: raise CircuitOpen("Headscale circuit is half open and a probe is in flight")
+            self.probing = True
+
+    def record_response(self, status_code):
+        if status_code in OUTAGE_STATUSES: self.record_failure()
+        else: self.record_success()
+
+    def record_success(self):
+        with self.lock:
+            recovered         = self.state != "closed"
+            self.state        = "closed"
+            self.failures     = 0
+            self.probing      = False
+            self.last_success = time.time()
+        if recovered:
+            logger.warning("Headscale is back.  Closing the circuit.")
+            self.publish()
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing   = False
+            tripped        = self.state == "half_open" or (self.state == "closed" and self.failures >= self.threshold)
+            if tripped:
+                self.state     = "open"
+                self.opened_at = time.monotonic()
+        if tripped:
+            logger.error("Headscale failed %i times in a row.  Opening the circuit for %.0f seconds.", self.failures, self.reset_timeout)
+            self.publish()
+
+    def release(self):
+        """ The request ended without a verdict on Headscale (ie, the caller's deadline passed) """
+        with self.lock: self.probing = False
+
+    def publish(self):
+        """ Shares the current state with the other workers, from the writer thread """
+        if self.shared is None: return
+        with self.lock: state = {"open": self.state != "closed", "stale_since": self.last_success}
+        self.writer.submit(self.write_shared, state)
+
+    def write_shared(self, state):
+        try: self.shared.put("breaker", "state", state)
+        except sqlite3.Error as error: logger.warning("Shared store write failed:  %s", str(error))
+
+    def shared_state(self):
+        """ {"open", "stale_since"} as last published by any worker, or None """
+        if self.shared is None: return None
+        try: row = self.shared.get("breaker", "state")
+        except sqlite3.Error as error:
+            logger.warning("Shared store read failed:  %s", str(error))
+            return None
+        return row[0] if row else None
+
+    def stale_since(self):
+        """ time.time() of the last good response while the circuit is open (in any worker), or None """
+        with self.lock:
+            if self.state != "closed": return self.last_success
+        state = self.shared_state()
+        if state is None or not state["open"]: return None
+        return state["stale_since"]
+
+    def degraded(self):
+        """ True while the circuit is open (in any worker) and pages should be served from whatever data is cached, however old """
+        with self.lock:
+            if self.state != "closed": return True
+        state = self.shared_state()
+        return state is not None and state["open"]
+
+breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_RESET, shared_store)
@@ -0,0 +1,183 @@
+# pylint: disable=wrong-import-order
+
+import aioheadscale, deadline, snapshot, logs, os, json, time, asyncio, secrets, sqlite3, threading
+from store import shared_store
+
+logger = logs.get_logger(__name__)
+
+##################################################################
+# Bulk operations on machines and routes, run as background jobs
+##################################################################
+BULK_WORKERS   = int(os.environ.get("BULK_WORKERS", "4"))       # Items of one job changed concurrently
+BULK_MAX_ITEMS = int(os.environ.get("BULK_MAX_ITEMS", "500"))   # Largest job accepted
+TAG_MODES      = ("add", "remove", "set")                        # See tag_machines()
+BULK_JOB_TTL   = 60 * 60   # Finished jobs are kept this long, in seconds
+SAVE_INTERVAL  = 0.5       # Seconds between progress writes to the shared store
+
+class BulkJob():
+    """ Progress and per-item results of one bulk operation """
+    def __init__(self, action, items):
+        self.id       = secrets.token_hex(8)
+        self.action   = action
+        self.items    = items      # [(item id, label)]
+        self.results  = []         # {"id", "label", "ok", "detail"} in completion order
+        self.status   = "running"
+        self.started  = time.time()
+        self.finished = None
+        self.saved_at = 0
+
+    def record(self, item, label, ok, detail=""):
+        self.results.append({"id": item, "label": label, "ok": ok, "detail": detail})
+
+    def to_dict(self):
+        return {
+            "id"       : self.id,
+            "action"   : self.action,
+            "status"   : self.status,
+            "total"    : len(self.items),
+            "done"     : len(self.results),
+            "failed"   : sum(1 for result in self.results if not result["ok"]),
+            "started"  : self.started,
+            "finished" : self.finished,
+            "results"  : self.results,
+        }
+
+class BulkJobs():
+    """ Runs bulk jobs on the I/O loop and keeps their progress.  With a shared store,
+        progress can be polled from any worker. """
+    def __init__(self, workers, shared=None):
+        self.workers = workers
+        self.shared  = shared
+        self.jobs    = {}
+        self.lock    = threading.Lock()
+
+    def start(self, action, items, operation):
+        """ Starts operation(item) for every (item, label) in items.  operation returns (ok, detail).
+            Returns the {"status", "job"} response for the UI. """
+        job = BulkJob(action, items)
+        with self.lock:
+            self.prune()
+            self.jobs[job.id] = job
+        logger.info("Starting bulk job %s:  %s on %i items", job.id, action, len(items))
+        self.save(job, force=True)
+        aioheadscale.io_loop.submit(self.run(job, operation))
+        return {"status": "True", "job": job.to_dict()}
+
+    async def run(self, job, operation):
+        # The job outlives the request that started it
+        with deadline.unbounded():
+            workers = asyncio.Semaphore(self.workers)
+            async def one(item, label):
+                async with workers:
+                    try: ok, detail = await operation(item)
+                    except Exception as error: # pylint: disable=broad-except
+                        ok, detail = False, str(error)
+                job.record(item, label, ok, detail)
+                await self.save_async(job)
+            await asyncio.gather(*(one(item, label) for item, label in job.items))
+        job.status   = "finished"
+        job.finished = time.time()
+        await self.save_async(job, force=True)
+        logger.info("Bulk job %s finished:  %i of %i failed", job.id, job.to_dict()["failed"], len(job.items))
+
+    def save_due(self, job, force):
+        """ True if the job's progress should be written now.  Marks it as written. """
+        if self.shared is None or (not force and time.time() - job.saved_at < SAVE_INTERVAL): return False
+        job.saved_at = time.time()
+        return True
+
+    def save(self, job, force=False):
+        if self.save_due(job, force): self.write(job)
+
+    async def save_async(self, job, force=False):
+        """ save() for the I/O loop.  SQLite can block for its whole busy timeout, and the loop is shared. """
+        if self.save_due(job, force): await asyncio.to_thread(self.write, job)
+
+    def write(self, job):
+        try: self.shared.put("bulk", job.id, job.to_dict())
+        except sqlite3.Error as error: logger.warning("Shared store write failed:  %s", str(error))
+
+    def get(self, job_id):
+        """ The job's progress, or None """
+        with self.lock: job = self.jobs.get(job_id)
+        if job is not None: return job.to_dict()
+        if self.shared is None: return None
+        try: row = self.shared.get("bulk", job_id)
+        except sqlite3.Error as error:
+            logger.warning("Shared store read failed:  %s", str(error))
+            return None
+        return row[0] if row else None
+
+    def prune(self):
+        """ Forgets finished jobs older than BULK_JOB_TTL.  Called with the lock held. """
+        oldest = time.time() - BULK_JOB_TTL
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished and job.finished < oldest]:
+            del self.jobs[job_id]
+
+jobs = BulkJobs(BULK_WORKERS, shared_store)
+
+def outcome(response):
+    """ (ok, detail) for the response of a mutation in aioheadscale """
+    if "status" in response: return response["status"] == "True", "" if response["status"] == "True" else json.dumps(response["body"])
+    if "code" in response:   return False, str(response.get("message", ""))
+    return True, ""
+
+def rejected(items):
+    """ The response for a job that can't start, or None if it can """
+    if not items:                   return {"status": "False", "body": {"message": "Nothing to change"}}
+    if len(items) > BULK_MAX_ITEMS: return {"status": "False", "body": {"message": "At most "+str(BULK_MAX_ITEMS)+" items can be changed at once"}}
+    return None
+
+##################################################################
+# Bulk actions.  Each returns {"status", "job"}, or {"status", "body"} on error.
+##################################################################
+async def machine_labels(url, api_key, machine_ids):
+    """ Returns ([(machine_id, label)] for the machines that exist, {machine_id: machine}) """
+    machines = (await snapshot.load(url, api_key, "machines"))["machines"]["machines"]
+    by_id    = {str(machine["id"]): machine for machine in machines}
+    return [(machine_id, by_id[machine_id]["givenName"]) for machine_id in dict.fromkeys(machine_ids) if machine_id in by_id], by_id
+
+async def delete_machines(url, api_key, machine_ids):
+    items, _ = await machine_labels(url, api_key, machine_ids)
+    if rejected(items): return rejected(items)
+    async def operation(machine_id):
+        return outcome(await aioheadscale.delete_machine(url, api_key, machine_id))
+    return jobs.start("delete_machines", items, operation)
+
+async def move_machines(url, api_key, machine_ids, new_user):
+    items, _ = await machine_labels(url, api_key, machine_ids)
+    if rejected(items): return rejected(items)
+    async def operation(machine_id):
+        return outcome(await aioheadscale.move_user(url, api_key, machine_id, new_user))
+    return jobs.start("move_machines", items, operation)
+
+async def tag_machines(url, api_key, machine_ids, tags, mode):
+    """ mode is "add" or "remove" (keeping each machine's other tags), or "set" """
+    if mode not in TAG_MODES: return {"status": "False", "body": {"message": "Unknown tag mode "+mode}}
+    items, by_id = await machine_labels(url, api_key, machine_ids)
+    if rejected(items): return rejected(items)
+    tags = ["tag:"+tag for tag in tags]
+    async def operation(machine_id):
+        current = by_id[machine_id]["forcedTags"]
+        match mode:
+            case "add"   : new_tags = current + [tag for tag in tags if tag not in current]
+            case "remove": new_tags = [tag for tag in current if tag not in tags]
+            case "set"   : new_tags = tags
+            case _       : return False, "Unknown tag mode "+mode
+        return outcome(await aioheadscale.set_machine_tags(url, api_key, machine_id, json.dumps({"tags": new_tags})))
+    return jobs.start("tag_machines", items, operation)
+
+async def set_routes(url, api_key, enabled, route_ids=(), prefixes=(), machine_ids=()):
+    """ Enables or disables every route that is in route_ids, has one of prefixes, or belongs to one of machine_ids """
+    routes = (await snapshot.load(url, api_key, "routes"))["routes"]["routes"]
+    selected = [
+        route for route in routes
+        if str(route["id"]) in route_ids or route["prefix"] in prefixes or str(route["machine"]["id"]) in machine_ids
+    ]
+    # Routes already in the requested state are left alone
+    items = [(str(route["id"]), route["prefix"]+" on "+route["machine"]["givenName"]) for route in selected if route["enabled"] != enabled]
+    if rejected(items): return rejected(items)
+    current_state = "False" if enabled else "True"
+    async def operation(route_id):
+        return outcome(await aioheadscale.update_route(url, api_key, route_id, current_state))
+    return jobs.start("enable_routes" if enabled else "disable_routes", items, operation)
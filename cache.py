@@ -0,0 +1,195 @@
+# pylint: disable=wrong-import-order
+
+import logs, os, json, time, sqlite3, asyncio, threading
+from store       import shared_store
+from breaker     import breaker
+from contextvars import ContextVar
+from collections import OrderedDict
+
+logger = logs.get_logger(__name__)
+
+##################################################################
+# Read-through cache for Headscale GET responses
+##################################################################
+CACHE_ENABLED       = os.environ.get("CACHE_ENABLED", "true").replace('"', '').lower() != "false"
+CACHE_MAX_ENTRIES   = int(os.environ.get("CACHE_MAX_ENTRIES", "1024"))
+CACHE_MAX_BYTES     = int(os.environ.get("CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+CACHE_STALE_SECONDS = float(os.environ.get("CACHE_STALE_SECONDS", "30"))
+# Per-resource time-to-live, in seconds:
+CACHE_TTLS = {
+    "machines"     : float(os.environ.get("CACHE_TTL_MACHINES",     "10")),
+    "routes"       : float(os.environ.get("CACHE_TTL_ROUTES",       "10")),
+    "users"        : float(os.environ.get("CACHE_TTL_USERS",        "30")),
+    "preauth_keys" : float(os.environ.get("CACHE_TTL_PREAUTH_KEYS", "30")),
+}
+
+# Set to True in a context that must always read from Headscale (ie, the snapshot poller).
+# Fresh results are still stored for everybody else.
+cache_bypass = ContextVar("cache_bypass", default=False)
+
+class TTLCache():
+    """ Bounded LRU cache with per-resource TTLs and stale-while-revalidate.
+        With a shared store, entries and invalidations are also seen by the other workers. """
+    def __init__(self, ttls, stale_seconds, max_entries, max_bytes, shared=None):
+        self.ttls          = ttls
+        self.shared        = shared
+        self.stale_seconds = stale_seconds
+        self.max_entries   = max_entries
+        self.max_bytes     = max_bytes
+        self.entries       = OrderedDict()
+        self.total_bytes   = 0
+        self.generations   = {}     # Bumped on invalidation so in-flight loads don't store old data
+        self.refreshing    = set()  # Keys currently being revalidated in the background
+        self.listeners     = []     # Called with the resource names on every invalidation
+        self.tasks         = set()  # Background revalidations running on an event loop
+        self.lock          = threading.Lock()
+
+    def generation(self, resource):
+        """ Bumped on every invalidation, in any worker, so in-flight loads don't store old data """
+        if self.shared is not None:
+            try: return self.shared.generation(resource)
+            except sqlite3.Error as error: logger.warning("Shared store read failed:  %s", str(error))
+        return self.generations.get(resource, 0)
+
+    def lookup(self, resource, key):
+        """ Returns ("hit" | "stale" | "miss", value, generation) for key.
+            "stale" means the caller serves the value and must revalidate the entry. """
+        cache_key  = (resource, key)
+        now        = time.time()
+        ttl        = self.ttls.get(resource, 0)
+        generation = self.generation(resource)
+        if cache_bypass.get(): return "miss", None, generation
+
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            # Invalidated (possibly by another worker) since the entry was stored
+            if entry is not None and entry["generation"] != generation:
+                self.total_bytes -= self.entries.pop(cache_key)["size"]
+                entry = None
+        # While Headscale is failing, anything cached beats an error page
+        degraded = breaker.degraded()
+        # Another worker may already have fetched it
+        if entry is None: entry = self._load_shared(cache_key, generation, 0 if degraded else now - ttl - self.stale_seconds)
+        if entry is None: return "miss", None, generation
+
+        with self.lock:
+            age = now - entry["stored_at"]
+            if age < ttl:
+                self.entries.move_to_end(cache_key)
+                return "hit", entry["value"], generation
+            if age < ttl + self.stale_seconds or degraded:
+                self.entries.move_to_end(cache_key)
+                if cache_key in self.refreshing: return "hit", entry["value"], generation
+                self.refreshing.add(cache_key)
+                return "stale", entry["value"], generation
+            return "miss", None, generation
+
+    def _load_shared(self, cache_key, generation, oldest):
+        """ Copies a usable entry from the shared store into memory and returns it """
+        if self.shared is None: return None
+        try: row = self.shared.get("cache:"+cache_key[0], cache_key[1])
+        except sqlite3.Error as error:
+            logger.warning("Shared store read failed:  %s", str(error))
+            return None
+        if row is None: return None
+        value, stored_at, row_generation = row
+        if row_generation != generation or stored_at < oldest: return None
+        return self._insert(cache_key, value, len(json.dumps(value)), stored_at, generation)
+
+    def _insert(self, cache_key, value, size, stored_at, generation):
+        entry = {"value": value, "size": size, "stored_at": stored_at, "generation": generation}
+        with self.lock:
+            old = self.entries.pop(cache_key, None)
+            if old is not None: self.total_bytes -= old["size"]
+            self.entries[cache_key] = entry
+            self.total_bytes += size
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted["size"]
+        return entry
+
+    def fetch(self, resource, key, loader):
+        """ Returns the cached value for key, calling loader() on a miss.
+            loader returns a (value, cacheable) tuple. """
+        if not CACHE_ENABLED: return loader()[0]
+        state, value, generation = self.lookup(resource, key)
+        if state == "stale":
+            threading.Thread(target=self._revalidate, args=((resource, key), loader, generation), daemon=True).start()
+        if state != "miss": return value
+
+        value, cacheable = loader()
+        if cacheable: self._store((resource, key), value, generation)
+        return value
+
+    async def off_loop(self, function, *args):
+        """ Runs function in a thread if it may touch the shared store.  SQLite can block for its
+            whole busy timeout, and the I/O loop is shared by every in-flight Headscale call. """
+        if self.shared is None: return function(*args)
+        return await asyncio.to_thread(function, *args)
+
+    async def fetch_async(self, resource, key, loader):
+        """ fetch() for coroutine loaders.  Stale entries are revalidated in a task on the running loop. """
+        if not CACHE_ENABLED: return (await loader())[0]
+        state, value, generation = await self.off_loop(self.lookup, resource, key)
+        if state == "stale":
+            task = asyncio.get_running_loop().create_task(self._revalidate_async((resource, key), loader, generation))
+            # The loop only keeps weak references to tasks
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        if state != "miss": return value
+
+        value, cacheable = await loader()
+        if cacheable: await self.off_loop(self._store, (resource, key), value, generation)
+        return value
+
+    def _revalidate(self, cache_key, loader, generation):
+        logger.debug("Revalidating stale cache entry %s", str(cache_key))
+        try:
+            value, cacheable = loader()
+            if cacheable: self._store(cache_key, value, generation)
+        except Exception as error: # pylint: disable=broad-except
+            logger.warning("Background refresh of %s failed:  %s", str(cache_key), str(error))
+        finally:
+            with self.lock: self.refreshing.discard(cache_key)
+
+    async def _revalidate_async(self, cache_key, loader, generation):
+        logger.debug("Revalidating stale cache entry %s", str(cache_key))
+        try:
+            value, cacheable = await loader()
+            if cacheable: await self.off_loop(self._store, cache_key, value, generation)
+        except Exception as error: # pylint: disable=broad-except
+            logger.warning("Background refresh of %s failed:  %s", str(cache_key), str(error))
+        finally:
+            with self.lock: self.refreshing.discard(cache_key)
+
+    def _store(self, cache_key, value, generation):
+        size = len(json.dumps(value))
+        if size > self.max_bytes: return
+        # The resource was invalidated while we were loading it.  Drop the result.
+        if self.generation(cache_key[0]) != generation: return
+        entry = self._insert(cache_key, value, size, time.time(), generation)
+        if self.shared is None: return
+        try: self.shared.put("cache:"+cache_key[0], cache_key[1], value, generation, entry["stored_at"])
+        except sqlite3.Error as error: logger.warning("Shared store write failed:  %s", str(error))
+
+    def invalidate(self, *resources):
+        """ Evicts every entry belonging to the given resources, in every worker """
+        logger.info("Invalidating cached resources:  %s", ", ".join(resources))
+        with self.lock:
+            for resource in resources:
+                self.generations[resource] = self.generations.get(resource, 0) + 1
+            for cache_key in [key for key in self.entries if key[0] in resources]:
+                self.total_bytes -= self.entries.pop(cache_key)["size"]
+        if self.shared is not None:
+            try:
+                for resource in resources:
+                    self.shared.bump(resource)
+                    self.shared.delete("cache:"+resource)
+            except sqlite3.Error as error: logger.error("Shared store invalidation failed:  %s", str(error))
+        for listener in self.listeners: listener(resources)
+
+    def on_invalidate(self, listener):
+        """ Registers listener(resources) to run after every invalidation """
+        self.listeners.append(listener)
+
+cache = TTLCache(CACHE_TTLS, CACHE_STALE_SECONDS, CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, shared_store)
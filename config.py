@@ -0,0 +1,102 @@
+# pylint: disable=wrong-import-order
+
+import logs, os, time, yaml, threading
+
+logger = logs.get_logger(__name__)
+
+##################################################################
+# Parsed Headscale configuration with file-change detection
+##################################################################
+CONFIG_PATHS         = ["/etc/headscale/config.yml", "/etc/headscale/config.yaml"]
+CONFIG_POLL_INTERVAL = float(os.environ.get("CONFIG_POLL_INTERVAL", "5"))
+
+class HeadscaleConfig():
+    """ Read-only view of a parsed Headscale config.yaml """
+    def __init__(self, raw, path, version):
+        self.raw     = raw if isinstance(raw, dict) else {}
+        self.path    = path     # None if no config file could be read
+        self.version = version  # Incremented every time the file is re-parsed
+
+    def __contains__(self, key):
+        return key in self.raw
+
+    def section(self, key):
+        """ Returns a top-level mapping, or an empty dict if it is missing """
+        value = self.raw.get(key)
+        return value if isinstance(value, dict) else {}
+
+    @property
+    def server_url(self):                        return self.raw.get("server_url")
+    @property
+    def ip_prefixes(self):                       return self.raw.get("ip_prefixes")
+    @property
+    def disable_check_updates(self):             return self.raw.get("disable_check_updates")
+    @property
+    def ephemeral_node_inactivity_timeout(self): return self.raw.get("ephemeral_node_inactivity_timeout")
+    @property
+    def node_update_check_interval(self):        return self.raw.get("node_update_check_interval")
+    @property
+    def acl_policy_path(self):                   return self.raw.get("acl_policy_path")
+    @property
+    def dns_config(self):                        return self.section("dns_config")
+    @property
+    def derp(self):                              return self.section("derp")
+    @property
+    def oidc(self):                              return self.section("oidc")
+
+class ConfigService():
+    """ Parses the Headscale config once and re-parses it only when the file changes """
+    def __init__(self, paths, poll_interval):
+        self.paths         = paths
+        self.poll_interval = poll_interval
+        self.stamp         = None
+        self.last_check    = 0.0
+        self.current       = HeadscaleConfig({}, None, 0)
+        self.lock          = threading.Lock()
+
+    def find_config(self):
+        """ Returns the path and (inode, mtime, size) of the first readable config file """
+        for path in self.paths:
+            if not os.access(path, os.R_OK): continue
+            try:
+                config_stat = os.stat(path)
+                return path, (path, config_stat.st_ino, config_stat.st_mtime_ns, config_stat.st_size)
+            except OSError: continue
+        return None, None
+
+    def get(self):
+        """ Returns the current HeadscaleConfig, re-parsing the file if it has changed """
+        now = time.monotonic()
+        with self.lock:
+            # Only stat the file every poll_interval seconds
+            if self.last_check and now - self.last_check < self.poll_interval: return self.current
+            self.last_check = now
+
+            path, stamp = self.find_config()
+            if stamp == self.stamp: return self.current
+            if path is None:
+                logger.error("/etc/headscale/config.y(a)ml: READ: FAILED")
+                self.stamp   = None
+                self.current = HeadscaleConfig({}, None, self.current.version + 1)
+                return self.current
+
+            logger.info("Parsing %s", path)
+            try:
+                with open(path, "r") as config_file:
+                    raw = yaml.safe_load(config_file)
+            except (OSError, yaml.YAMLError) as error:
+                # Keep serving the last good config rather than an empty one
+                logger.error("Failed to parse %s:  %s", path, str(error))
+                return self.current
+            self.stamp   = stamp
+            self.current = HeadscaleConfig(raw, path, self.current.version + 1)
+            return self.current
+
+    def readable(self):
+        """ True if a Headscale config file could be read """
+        return self.get().path is not None
+
+config_service = ConfigService(CONFIG_PATHS, CONFIG_POLL_INTERVAL)
+
+def get_config():
+    return config_service.get()
@@ -0,0 +1,66 @@
+# pylint: disable=wrong-import-order
+
+import logs, os, time, asyncio, contextlib, contextvars
+
+logger = logs.get_logger(__name__)
+
+##################################################################
+# Request-scoped deadlines for Headscale calls
+##################################################################
+# Seconds a page may spend waiting on Headscale.  Sections that miss it are filled in by the browser.
+DEADLINES = {
+    "overview_page": float(os.environ.get("DEADLINE_OVERVIEW", "10")),
+    "machines_page": float(os.environ.get("DEADLINE_MACHINES", "10")),
+    "users_page"   : float(os.environ.get("DEADLINE_USERS",    "10")),
+    "routes_page"  : float(os.environ.get("DEADLINE_ROUTES",   "10")),
+}
+DEADLINE_API = float(os.environ.get("DEADLINE_API", "30"))  # Every /api endpoint
+MIN_TIMEOUT  = 0.05  # requests treats a timeout of 0 as "no timeout"
+
+# Absolute time.monotonic() value, or None.  Copied into the I/O loop along with the rest of the context.
+request_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+class DeadlineExceeded(TimeoutError):
+    """ Raised when a Headscale call doesn't finish before the request's deadline """
+
+def budget_for(endpoint):
+    return DEADLINES.get(endpoint, DEADLINE_API)
+
+def remaining():
+    """ Seconds left before the deadline, or None without one """
+    deadline = request_deadline.get()
+    if deadline is None: return None
+    return deadline - time.monotonic()
+
+def clamp(timeout):
+    """ Shortens a (connect, read) timeout so a synchronous request ends by the deadline """
+    left = remaining()
+    if left is None: return timeout
+    if left <= 0: raise DeadlineExceeded("Request deadline exceeded")
+    return tuple(max(MIN_TIMEOUT, min(part, left)) for part in timeout)
+
+@contextlib.contextmanager
+def budget(seconds):
+    """ Sets a deadline seconds from now, unless an earlier one is already set """
+    deadline = time.monotonic() + seconds
+    current  = request_deadline.get()
+    token    = request_deadline.set(deadline if current is None else min(current, deadline))
+    try: yield
+    finally: request_deadline.reset(token)
+
+@contextlib.contextmanager
+def unbounded():
+    """ Runs work that outlives a single request (shared results, health checks) without a deadline """
+    token = request_deadline.set(None)
+    try: yield
+    finally: request_deadline.reset(token)
+
+async def wait(awaitable):
+    """ Awaits awaitable, raising DeadlineExceeded if the deadline passes first """
+    left = remaining()
+    if left is None: return await awaitable
+    if left <= 0:
+        if asyncio.iscoroutine(awaitable): awaitable.close()
+        raise DeadlineExceeded("Request deadline exceeded")
+    try: return await asyncio.wait_for(awaitable, left)
+    except asyncio.TimeoutError as error: raise DeadlineExceeded("Request deadline exceeded") from error
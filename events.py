@@ -0,0 +1,148 @@
+# pylint: disable=wrong-import-order
+
+import helper, snapshot, timestamps, logs, os, json, time, queue, threading
+from collections import deque
+
+logger = logs.get_logger(__name__)
+
+##################################################################
+# Server-Sent Events:  diffs between successive snapshots
+##################################################################
+EVENTS_HEARTBEAT     = float(os.environ.get("EVENTS_HEARTBEAT", "15"))    # Seconds between keepalive comments
+EVENTS_MAX_STREAM    = float(os.environ.get("EVENTS_MAX_STREAM", "300"))  # Streams end after this long.  Browsers reconnect.
+EVENTS_QUEUE_SIZE    = int(os.environ.get("EVENTS_QUEUE_SIZE", "100"))    # Pending messages per subscriber
+EVENTS_HISTORY       = 50                                                  # Messages kept for replay on reconnect
+EVENTS_RETRY_MS      = 5000
+
+def is_online(machine):
+    return bool(machine.get("online", False))
+
+def machine_status(machine):
+    """ The parts of a machine's status badge that can change between polls.  custom.js colors it. """
+    return {
+        "online"   : is_online(machine),
+        "last_seen": timestamps.epoch(timestamps.parse(machine["lastSeen"])),
+    }
+
+def route_state(route, route_topology):
+    """ Everything the Machines and Routes pages show for a single route """
+    failover = route_topology.is_failover(route)
+    state    = {
+        "type"      : "route",
+        "id"        : str(route["id"]),
+        "machine_id": str(route["machine"]["id"]),
+        "prefix"    : route["prefix"],
+        "enabled"   : route["enabled"],
+        "primary"   : route["isPrimary"],
+        "failover"  : failover,
+        "color"     : "green",
+    }
+    if failover:
+        state["color"]          = helper.get_color(route_topology.failover_color_index(route["prefix"]), "failover")
+        state["prefix_enabled"] = any(partner["enabled"] for partner in route_topology.failover_groups[route["prefix"]])
+    return state
+
+def diff_snapshots(old, new):
+    """ Returns the list of changes between two snapshots, in a compact form for custom.js """
+    changes = []
+
+    # Machines:  added, removed, status and tags
+    for machine_id, machine in new.machines_by_id.items():
+        if machine_id not in old.machines_by_id:
+            changes.append({"type": "machine_added", "id": machine_id, "name": machine["givenName"]})
+            continue
+        old_machine = old.machines_by_id[machine_id]
+        # lastSeen moves on every poll, and custom.js works out the text and color from it.
+        # Only send the status (and only parse lastSeen) when the online state changes.
+        if is_online(old_machine) != is_online(machine):
+            changes.append({"type": "machine_status", "id": machine_id, **machine_status(machine)})
+        if old_machine["forcedTags"] != machine["forcedTags"]:
+            changes.append({"type": "machine_tags", "id": machine_id, "tags": [tag[4:] for tag in machine["forcedTags"]]})
+    for machine_id in old.machines_by_id:
+        if machine_id not in new.machines_by_id:
+            changes.append({"type": "machine_removed", "id": machine_id})
+
+    # Routes:  enabled and primary state, plus one entry per exit node
+    for route_id, route in new.topology.by_id.items():
+        old_route = old.topology.by_id.get(route_id)
+        if old_route is None: continue  # New routes appear with their machine's card on the next page load
+        if old_route["enabled"] != route["enabled"] or old_route["isPrimary"] != route["isPrimary"]:
+            changes.append(route_state(route, new.topology))
+    for machine_id, exit_routes in new.topology.exit_nodes.items():
+        exit_enabled = any(route["enabled"] for route in exit_routes)
+        old_exits    = old.topology.exit_nodes.get(machine_id)
+        if old_exits is not None and any(route["enabled"] for route in old_exits) != exit_enabled:
+            changes.append({"type": "exit", "machine_id": machine_id, "enabled": exit_enabled})
+
+    return changes
+
+def format_message(event, data, event_id=None):
+    message = "event: "+event+"\n"
+    if event_id is not None: message += "id: "+str(event_id)+"\n"
+    return message+"data: "+json.dumps(data)+"\n\n"
+
+class EventBroker():
+    """ Fans diffs from the snapshot poller out to every open /api/events stream """
+    def __init__(self, queue_size, history_size):
+        self.queue_size    = queue_size
+        self.subscribers   = set()
+        self.history       = deque(maxlen=history_size)  # (snapshot version, message) for replay
+        self.history_floor = 0     # Diffs for versions at or below this one are no longer in history
+        self.lock          = threading.Lock()
+
+    def publish(self, old_snapshot, new_snapshot):
+        """ Snapshot listener.  Diffs the two snapshots and queues the result for every subscriber. """
+        if old_snapshot is None: return
+        changes = diff_snapshots(old_snapshot, new_snapshot)
+        if not changes: return
+        message = format_message("diff", {"version": new_snapshot.version, "changes": changes}, new_snapshot.version)
+        logger.info("Publishing %i changes to %i event subscribers", len(changes), len(self.subscribers))
+
+        with self.lock:
+            if len(self.history) == self.history.maxlen: self.history_floor = self.history[0][0]
+            self.history.append((new_snapshot.version, message))
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers: self.deliver(subscriber, message)
+
+    def deliver(self, subscriber, message):
+        try: subscriber.put_nowait(message)
+        except queue.Full:
+            # A client that stopped reading gets told to reload instead of an unbounded backlog
+            while True:
+                try: subscriber.get_nowait()
+                except queue.Empty: break
+            subscriber.put_nowait(format_message("reload", {}))
+
+    def subscribe(self, last_event_id=None):
+        """ Registers a new subscriber.  Replays missed diffs if the browser is reconnecting. """
+        subscriber = queue.Queue(maxsize=self.queue_size)
+        with self.lock:
+            self.subscribers.add(subscriber)
+            if last_event_id is not None:
+                if last_event_id < self.history_floor:
+                    self.deliver(subscriber, format_message("reload", {}))
+                else:
+                    for version, message in self.history:
+                        if version > last_event_id: self.deliver(subscriber, message)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock: self.subscribers.discard(subscriber)
+
+    def stream(self, last_event_id=None):
+        """ Generator for an SSE response.  Ends after EVENTS_MAX_STREAM so worker threads are recycled. """
+        # The poller is shared by every stream.  It stops after the last one closes, unless SNAPSHOT_MODE needs it.
+        snapshot.poller.subscribe()
+        subscriber = self.subscribe(last_event_id)
+        started    = time.monotonic()
+        try:
+            yield "retry: "+str(EVENTS_RETRY_MS)+"\n\n"
+            while time.monotonic() - started < EVENTS_MAX_STREAM:
+                try: yield subscriber.get(timeout=EVENTS_HEARTBEAT)
+                except queue.Empty: yield ": keepalive\n\n"
+        finally:
+            self.unsubscribe(subscriber)
+            snapshot.poller.unsubscribe()
+
+broker = EventBroker(EVENTS_QUEUE_SIZE, EVENTS_HISTORY)
+snapshot.poller.on_publish(broker.publish)
@@ -0,0 +1,61 @@
+# pylint: disable=wrong-import-order
+
+import logs, os, json, hashlib, threading
+from collections import OrderedDict
+
+logger = logs.get_logger(__name__)
+
+##################################################################
+# Rendered HTML fragments, keyed by a hash of what they show
+##################################################################
+FRAGMENT_CACHE_SIZE = int(os.environ.get("FRAGMENT_CACHE_SIZE", "2048"))  # Fragments kept.  0 disables the cache.
+
+def fragment_key(*parts):
+    """ sha256 of the JSON-encoded parts.  Equal data gives an equal key, whatever its dict order. """
+    encoded = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+class FragmentCache():
+    """ LRU of rendered fragments.  A changed input changes the key, so entries never need invalidating. """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries     = OrderedDict()
+        self.lock        = threading.Lock()
+        # Metrics for /api/stats
+        self.hits        = 0
+        self.misses      = 0
+        self.evictions   = 0
+
+    def get(self, key, render):
+        """ The fragment stored under key, or render()'s result, stored for next time """
+        if self.max_entries <= 0: return render()
+        with self.lock:
+            fragment = self.entries.get(key)
+            if fragment is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return fragment
+            self.misses += 1
+        # Rendered outside the lock.  Two threads missing the same key both render it, with the same result.
+        fragment = render()
+        with self.lock:
+            self.entries[key] = fragment
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return fragment
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries"   : len(self.entries),
+                "max"       : self.max_entries,
+                "hits"      : self.hits,
+                "misses"    : self.misses,
+                "evictions" : self.evictions,
+                "hit_rate"  : round(self.hits / lookups, 3) if lookups else 0,
+            }
+
+machine_cards = FragmentCache(FRAGMENT_CACHE_SIZE)
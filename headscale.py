@@ -1,8 +1,11 @@
 # pylint: disable=wrong-import-order
 
-import requests, json, os, logging, yaml
+import requests, json, os, logging, config, deadline, threading
+from breaker             import breaker
+from limiter             import limiter
+from requests.adapters   import HTTPAdapter
 from cryptography.fernet import Fernet
-from datetime            import timedelta, date
+from datetime            import datetime, timedelta, timezone, date
 from dateutil            import parser
 from flask               import Flask
 from dotenv              import load_dotenv
@@ -20,61 +23,193 @@ match LOG_LEVEL:
     case "CRITICAL": app.logger.setLevel(logging.CRITICAL)
 
 ##################################################################
-# Functions related to HEADSCALE and API KEYS
+# Pooled HTTP client for the calls made outside of requests
+##################################################################
+HS_POOL_SIZE       = int(os.environ.get("HS_POOL_SIZE", "20"))
+HS_CONNECT_TIMEOUT = float(os.environ.get("HS_CONNECT_TIMEOUT", "5"))
+HS_READ_TIMEOUT    = float(os.environ.get("HS_READ_TIMEOUT", "30"))
+HS_KEEPALIVE       = os.environ.get("HS_KEEPALIVE", "true").replace('"', '').lower() != "false"
+
+class SingleFlight():
+    """ Lets concurrent callers with the same key share one call and its result """
+    def __init__(self):
+        self.calls  = {}  # key -> {"done": Event, "result", "error"} for calls in flight
+        self.joined = 0   # Callers that shared another caller's call
+        self.lock   = threading.Lock()
+
+    def do(self, key, function):
+        with self.lock:
+            call   = self.calls.get(key)
+            leader = call is None
+            if leader: call = self.calls[key] = {"done": threading.Event(), "result": None, "error": None}
+            else: self.joined += 1
+
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None: raise call["error"]
+            return call["result"]
+
+        try: call["result"] = function()
+        except BaseException as error:
+            call["error"] = error
+            raise
+        finally:
+            with self.lock: del self.calls[key]
+            call["done"].set()
+        return call["result"]
+
+class HeadscaleClient():
+    """ Owns a pooled, keep-alive requests.Session for the synchronous Headscale API calls """
+    def __init__(self, pool_size=HS_POOL_SIZE, connect_timeout=HS_CONNECT_TIMEOUT, read_timeout=HS_READ_TIMEOUT, keepalive=HS_KEEPALIVE):
+        self.timeout = (connect_timeout, read_timeout)
+        self.api_key = None
+        self.lock    = threading.Lock()
+        # Called whenever Headscale rejects our credentials (401/403)
+        self.auth_failure_callbacks = []
+        self.in_flight = SingleFlight()
+        # One adapter per scheme.  pool_maxsize bounds the number of sockets kept open
+        # to the Headscale server; pool_block makes extra threads wait for a free socket
+        # instead of opening (and then discarding) throwaway connections.
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session = requests.Session()
+        self.session.mount("http://",  adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            'Accept': 'application/json',
+            'Connection': 'keep-alive' if keepalive else 'close'
+        })
+
+    def set_api_key(self, api_key):
+        """ Sets the Authorization header on the shared session """
+        with self.lock:
+            if api_key == self.api_key: return
+            self.api_key = api_key
+            self.session.headers['Authorization'] = 'Bearer '+str(api_key)
+
+    def on_auth_failure(self, callback):
+        """ Registers a callback to run when Headscale answers 401 or 403 """
+        self.auth_failure_callbacks.append(callback)
+
+    def request(self, method, url, path, api_key=None, **kwargs):
+        """ Sends a request to the Headscale server at url+path """
+        headers = kwargs.pop("headers", {})
+        # Requests made with a key other than the session key (ie, testing a freshly
+        # renewed key) carry their own header instead of touching the shared session.
+        if api_key is not None and api_key != self.api_key:
+            headers['Authorization'] = 'Bearer '+str(api_key)
+        # Fail fast while Headscale is down instead of waiting on every request
+        breaker.before_request()
+        try:
+            # Wait our turn (see limiter.py), but never past the request's deadline, if it has one
+            with limiter.slot(): response = self.session.request(method, str(url)+path, headers=headers, timeout=deadline.clamp(self.timeout), **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            breaker.record_failure()
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        breaker.record_response(response.status_code)
+        if response.status_code in (401, 403):
+            app.logger.warning("Headscale rejected the API key (%i) for %s", response.status_code, path)
+            for callback in self.auth_failure_callbacks: callback()
+        return response
+
+    def get(self, url, path, api_key=None, **kwargs):
+        return self.request("GET", url, path, api_key, **kwargs)
+
+    def fetch(self, url, path, api_key=None):
+        """ GETs url+path and returns (status_code, parsed JSON).  Concurrent identical
+            calls share one upstream request, so callers must not modify the result. """
+        def load():
+            # Shared by callers with different deadlines, so only the HS_* timeouts apply
+            with deadline.unbounded(): response = self.get(url, path, api_key)
+            return response.status_code, response.json()
+        return self.in_flight.do((str(url)+path, api_key), load)
+
+    def post(self, url, path, api_key=None, **kwargs):
+        return self.request("POST", url, path, api_key, **kwargs)
+
+    def delete(self, url, path, api_key=None, **kwargs):
+        return self.request("DELETE", url, path, api_key, **kwargs)
+
+client = HeadscaleClient()
+
+##################################################################
+# Functions related to HEADSCALE and API KEYS.  Pages and /api
+# endpoints call Headscale through aioheadscale.  The synchronous
+# client is left to the background key renewal and health checks.
 ##################################################################
 def get_url(inpage=False):
     if not inpage: 
         return os.environ['HS_SERVER']
-    config_file = ""
-    try:
-        config_file = open("/etc/headscale/config.yml",  "r")
-        app.logger.info("Opening /etc/headscale/config.yml")
-    except: 
-        config_file = open("/etc/headscale/config.yaml", "r")
-        app.logger.info("Opening /etc/headscale/config.yaml")
-    config_yaml = yaml.safe_load(config_file)
-    if "server_url" in config_yaml: 
-        return str(config_yaml["server_url"])
+    server_url = config.get_config().server_url
+    if server_url: 
+        return str(server_url)
     app.logger.warning("Failed to find server_url in the config. Falling back to ENV variable")
     return os.environ['HS_SERVER']
 
+class ApiKeyHolder():
+    """ Keeps the decrypted API key in memory and reloads it only when key.txt changes """
+    def __init__(self, key_path):
+        self.key_path = key_path
+        self.stamp    = None  # (inode, mtime, size) of key.txt when it was last read
+        self.api_key  = None
+        self.fernet   = None
+        self.lock     = threading.Lock()
+
+    def get_fernet(self):
+        # User-set encryption key
+        if self.fernet is None: self.fernet = Fernet(os.environ['KEY'])
+        return self.fernet
+
+    def get(self):
+        try: key_stat = os.stat(self.key_path)
+        except FileNotFoundError: return False
+        stamp = (key_stat.st_ino, key_stat.st_mtime_ns, key_stat.st_size)
+
+        with self.lock:
+            if stamp == self.stamp: return self.api_key
+            app.logger.info("Loading the API key from %s", self.key_path)
+            # The encrypted key read from the file
+            with open(self.key_path, "rb") as key_file:
+                enc_api_key = key_file.read()
+            # Decrypting the key
+            self.api_key = "NULL" if enc_api_key == b'' else self.get_fernet().decrypt(enc_api_key).decode()
+            self.stamp   = stamp
+            api_key      = self.api_key
+
+        # Keep the shared session's Authorization header in step with the stored key
+        if api_key != "NULL": client.set_api_key(api_key)
+        return api_key
+
+    def set(self, api_key):
+        # Encrypting the key
+        encrypted_key = self.get_fernet().encrypt(api_key.encode())
+        temp_path     = self.key_path+".tmp"
+        with self.lock:
+            # Write to a temporary file and swap it in so readers (including other
+            # workers) never see a half-written key.
+            with open(temp_path, "wb") as key_file:
+                written = key_file.write(encrypted_key)
+            os.replace(temp_path, self.key_path)
+            key_stat     = os.stat(self.key_path)
+            self.stamp   = (key_stat.st_ino, key_stat.st_mtime_ns, key_stat.st_size)
+            self.api_key = api_key
+        client.set_api_key(api_key)
+        # Return true if the file wrote correctly
+        return True if written else False
+
+# Key file on the filesystem for persistent storage
+api_key_holder = ApiKeyHolder(os.path.join(DATA_DIRECTORY, "key.txt"))
+
 def set_api_key(api_key):
-    # User-set encryption key
-    encryption_key = os.environ['KEY']                      
-    # Key file on the filesystem for persistent storage
-    key_file       = open(os.path.join(DATA_DIRECTORY, "key.txt"), "wb+")
-    # Preparing the Fernet class with the key
-    fernet         = Fernet(encryption_key)                 
-    # Encrypting the key
-    encrypted_key  = fernet.encrypt(api_key.encode())       
-    # Return true if the file wrote correctly
-    return True if key_file.write(encrypted_key) else False 
+    return api_key_holder.set(api_key)
 
 def get_api_key():
-    if not os.path.exists(os.path.join(DATA_DIRECTORY, "key.txt")): return False
-    # User-set encryption key
-    encryption_key = os.environ['KEY']                      
-    # Key file on the filesystem for persistent storage
-    key_file       = open(os.path.join(DATA_DIRECTORY, "key.txt"), "rb+")           
-    # The encrypted key read from the file
-    enc_api_key    = key_file.read()                        
-    if enc_api_key == b'': return "NULL"
-
-    # Preparing the Fernet class with the key
-    fernet         = Fernet(encryption_key)                 
-    # Decrypting the key
-    decrypted_key  = fernet.decrypt(enc_api_key).decode()   
-
-    return decrypted_key
+    return api_key_holder.get()
 
 def test_api_key(url, api_key):
-    response = requests.get(
-        str(url)+"/api/v1/apikey",
-        headers={
-            'Accept': 'application/json',
-            'Authorization': 'Bearer '+str(api_key)
-        }
-    )
+    response = client.get(url, "/api/v1/apikey", api_key)
     return response.status_code
 
 # Expires an API key
@@ -83,17 +218,19 @@ def expire_key(url, api_key):
     json_payload=json.dumps(payload)
     app.logger.debug("Sending the payload '"+str(json_payload)+"' to the headscale server")
 
-    response = requests.post(
-        str(url)+"/api/v1/apikey/expire",
-        data=json_payload,
-        headers={
-            'Accept': 'application/json',
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer '+str(api_key)
-            }
-    )
+    response = client.post(url, "/api/v1/apikey/expire", api_key, data=json_payload, headers={'Content-Type': 'application/json'})
     return response.status_code
 
+# Keys are renewed this long before they expire
+RENEWAL_WINDOW = timedelta(days=5)
+
+def renewal_time(expiration):
+    """ When a key expiring at expiration (a Headscale timestamp) is due for renewal """
+    return parser.parse(expiration) - RENEWAL_WINDOW
+
+def renewal_due(expiration):
+    return datetime.now(timezone.utc) >= renewal_time(expiration)
+
 # Checks if the key needs to be renewed
 # If it does, renews the key, then expires the old key
 def renew_api_key(url, api_key):
@@ -103,29 +240,17 @@ def renew_api_key(url, api_key):
     key_info            = get_api_key_info(url, api_key)
     expiration_time     = key_info["expiration"]
     today_date          = date.today()
-    expire              = parser.parse(expiration_time)
-    expire_fmt          = str(expire.year) + "-" + str(expire.month).zfill(2) + "-" + str(expire.day).zfill(2)
-    expire_date         = date.fromisoformat(expire_fmt)
-    delta               = expire_date - today_date
     tmp                 = today_date + timedelta(days=90) 
     new_expiration_date = str(tmp)+"T00:00:00.000000Z"
 
-    # If the delta is less than 5 days, renew the key:
-    if delta < timedelta(days=5):
-        app.logger.warning("Key is about to expire.  Delta is "+str(delta))
+    # If the key is inside the renewal window, renew it (renewal.py checks the same window):
+    if renewal_due(expiration_time):
+        app.logger.warning("Key is about to expire.  Expiration is "+str(expiration_time))
         payload = {'expiration':str(new_expiration_date)}
         json_payload=json.dumps(payload)
         app.logger.debug("Sending the payload '"+str(json_payload)+"' to the headscale server")
 
-        response = requests.post(
-            str(url)+"/api/v1/apikey",
-            data=json_payload,
-            headers={
-                'Accept': 'application/json',
-                'Content-Type': 'application/json',
-                'Authorization': 'Bearer '+str(api_key)
-                }
-        )
+        response = client.post(url, "/api/v1/apikey", api_key, data=json_payload, headers={'Content-Type': 'application/json'})
         new_key = response.json()
         app.logger.debug("JSON:  "+json.dumps(new_key))
         app.logger.debug("New Key is:  "+new_key["apiKey"])
@@ -148,14 +273,7 @@ def renew_api_key(url, api_key):
 # Gets information about the current API key
 def get_api_key_info(url, api_key):
     app.logger.info("Getting API key information")
-    response = requests.get(
-        str(url)+"/api/v1/apikey",
-        headers={
-            'Accept': 'application/json',
-            'Authorization': 'Bearer '+str(api_key)
-        }
-    )
-    json_response = response.json()
+    _, json_response = client.fetch(url, "/api/v1/apikey", api_key)
     # Find the current key in the array:  
     key_prefix = str(api_key[0:10])
     app.logger.info("Looking for valid API Key...")
@@ -165,273 +283,3 @@ def get_api_key_info(url, api_key):
             return key
     app.logger.error("Could not find a valid key in Headscale.  Need a new API key.")
     return "Key not found"
-
-##################################################################
-# Functions related to MACHINES
-##################################################################
-
-# register a new machine
-def register_machine(url, api_key, machine_key, user):
-    app.logger.info("Registering machine %s to user %s", str(machine_key), str(user))
-    response = requests.post(
-        str(url)+"/api/v1/machine/register?user="+str(user)+"&key="+str(machine_key),
-        headers={
-            'Accept': 'application/json',
-            'Authorization': 'Bearer '+str(api_key)
-        }
-    )
-    return response.json()
-
-
-# Sets the machines tags
-def set_machine_tags(url, api_key, machine_id, tags_list):
-    app.logger.info("Setting machine_id %s tag %s", str(machine_id), str(tags_list))
-    response = requests.post(
-        str(url)+"/api/v1/machine/"+str(machine_id)+"/tags",
-        data=tags_list,
-        headers={
-            'Accept': 'application/json',
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer '+str(api_key)
-            }
-    )
-    return response.json()
-
-# Moves machine_id to user "new_user"
-def move_user(url, api_key, machine_id, new_user):
-    app.logger.info("Moving machine_id %s to user %s", str(machine_id), str(new_user))
-    response = requests.post(
-        str(url)+"/api/v1/machine/"+str(machine_id)+"/user?user="+str(new_user),
-        headers={
-            'Accept': 'application/json',
-            'Authorization': 'Bearer '+str(api_key)
-        }
-    )
-    return response.json()
-
-def update_route(url, api_key, route_id, current_state):
-    action = "disable" if current_state == "True" else "enable"
-
-    app.logger.info("Updating Route %s:  Action: %s", str(route_id), str(action))
-
-    # Debug
-    app.logger.debug("URL:  "+str(url))
-    app.logger.debug("Route ID:  "+str(route_id))
-    app.logger.debug("Current State:  "+str(current_state))
-    app.logger.debug("Action to take:  "+str(action))
-
-    response = requests.post(
-        str(url)+"/api/v1/routes/"+str(route_id)+"/"+str(action),
-        headers={
-            'Accept': 'application/json',
-            'Authorization': 'Bearer '+str(api_key)
-        }
-    )
-    return response.json()
-
-# Get all machines on the Headscale network
-def get_machines(url, api_key):
-    app.logger.info("Getting machine information")
-    response = requests.get(
-        str(url)+"/api/v1/machine",
-        headers={
-            'Accept': 'application/json',
-            'Authorization': 'Bearer '+str(api_key)
-        }
-    )
-    return response.json()
-
-# Get machine with "machine_id" on the Headscale network
-def get_machine_info(url, api_key, machine_id):
-    app.logger.info("Getting information for machine ID %s", str(machine_id))
-    response = requests.get(
-        str(url)+"/api/v1/machine/"+str(machine_id),
-        headers={
-            'Accept': 'application/json',
-            'Authorization': 'Bearer '+str(api_key)
-        }
-    )
-    return response.json()
-
-# Delete a machine from Headscale
-def delete_machine(url, api_key, machine_id):
-    app.logger.info("Deleting machine %s", str(machine_id))
-    response = requests.delete(
-        str(url)+"/api/v1/machine/"+str(machine_id),
-        headers={
-            'Accept': 'application/json',
-            'Authorization': 'Bearer '+str(api_key)
-        }
-    )
-    status = "True" if response.status_code == 200 else "False"
-    if response.status_code == 200:
-        app.logger.info("Machine deleted.")
-    else:
-        app.logger.error("Deleting machine failed!  %s", str(response.json()))
-    return {"status": status, "body": response.json()}
-
-# Rename "machine_id" with name "new_name"
-def rename_machine(url, api_key, machine_id, new_name):
-    app.logger.info("Renaming machine %s", str(machine_id))
-    response = requests.post(
-        str(url)+"/api/v1/machine/"+str(machine_id)+"/rename/"+str(new_name),
-        headers={
-            'Accept': 'application/json',
-            'Authorization': 'Bearer '+str(api_key)
-        }
-    )
-    status = "True" if response.status_code == 200 else "False"
-    if response.status_code == 200:
-        app.logger.info("Machine renamed")
-    else:
-        app.logger.error("Machine rename failed!  %s", str(response.json()))
-    return {"status": status, "body": response.json()}
-
-# Gets routes for the passed machine_id
-def get_machine_routes(url, api_key, machine_id):
-    app.logger.info("Getting routes for machine %s", str(machine_id))
-    response = requests.get(
-        str(url)+"/api/v1/machine/"+str(machine_id)+"/routes",
-        headers={
-            'Accept': 'application/json',
-            'Authorization': 'Bearer '+str(api_key)
-        }
-    )
-    if response.status_code == 200:
-        app.logger.info("Routes obtained")
-    else:
-        app.logger.error("Failed to get routes:  %s", str(response.json()))
-    return response.json()
-
-# Gets routes for the entire tailnet
-def get_routes(url, api_key):
-    app.logger.info("Getting routes")
-    response = requests.get(
-        str(url)+"/api/v1/routes",
-        headers={
-            'Accept': 'application/json',
-            'Authorization': 'Bearer '+str(api_key)
-        }
-    )
-    return response.json()
-##################################################################
-# Functions related to USERS
-##################################################################
-
-# Get all users in use
-def get_users(url, api_key):
-    app.logger.info("Getting Users")
-    response = requests.get(
-        str(url)+"/api/v1/user",
-        headers={
-            'Accept': 'application/json',
-            'Authorization': 'Bearer '+str(api_key)
-        }
-    )
-    return response.json()
-
-# Rename "old_name" with name "new_name"
-def rename_user(url, api_key, old_name, new_name):
-    app.logger.info("Renaming user %s to %s.", str(old_name), str(new_name))
-    response = requests.post(
-        str(url)+"/api/v1/user/"+str(old_name)+"/rename/"+str(new_name),
-        headers={
-            'Accept': 'application/json',
-            'Authorization': 'Bearer '+str(api_key)
-        }
-    )
-    status = "True" if response.status_code == 200 else "False"
-    if response.status_code == 200:
-        app.logger.info("User renamed.")
-    else:
-        app.logger.error("Renaming User failed!")
-    return {"status": status, "body": response.json()}
-
-# Delete a user from Headscale
-def delete_user(url, api_key, user_name):
-    app.logger.info("Deleting a User:  %s", str(user_name))
-    response = requests.delete(
-        str(url)+"/api/v1/user/"+str(user_name),
-        headers={
-            'Accept': 'application/json',
-            'Authorization': 'Bearer '+str(api_key)
-        }
-    )
-    status = "True" if response.status_code == 200 else "False"
-    if response.status_code == 200:
-        app.logger.info("User deleted.")
-    else:
-        app.logger.error("Deleting User failed!")
-    return {"status": status, "body": response.json()}
-
-# Add a user from Headscale
-def add_user(url, api_key, data):
-    app.logger.info("Adding user:  %s", str(data))
-    response = requests.post(
-        str(url)+"/api/v1/user",
-        data=data,
-        headers={
-            'Accept': 'application/json',
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer '+str(api_key)
-        }
-    )
-    status = "True" if response.status_code == 200 else "False"
-    if response.status_code == 200:
-        app.logger.info("User added.")
-    else:
-        app.logger.error("Adding User failed!")
-    return {"status": status, "body": response.json()}
-
-##################################################################
-# Functions related to PREAUTH KEYS in USERS
-##################################################################
-
-# Get all PreAuth keys associated with a user "user_name"
-def get_preauth_keys(url, api_key, user_name):
-    app.logger.info("Getting PreAuth Keys in User %s", str(user_name))
-    response = requests.get(
-        str(url)+"/api/v1/preauthkey?user="+str(user_name),
-        headers={
-            'Accept': 'application/json',
-            'Authorization': 'Bearer '+str(api_key)
-        }
-    )
-    return response.json()
-
-# Add a preauth key to the user "user_name" given the booleans "ephemeral" 
-# and "reusable" with the expiration date "date" contained in the JSON payload "data"
-def add_preauth_key(url, api_key, data):
-    app.logger.info("Adding PreAuth Key:  %s", str(data))
-    response = requests.post(
-        str(url)+"/api/v1/preauthkey",
-        data=data,
-        headers={
-            'Accept': 'application/json',
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer '+str(api_key)
-        }
-    )
-    status = "True" if response.status_code == 200 else "False"
-    if response.status_code == 200:
-        app.logger.info("PreAuth Key added.")
-    else:
-        app.logger.error("Adding PreAuth Key failed!")
-    return {"status": status, "body": response.json()}
-
-# Expire a pre-auth key.  data is {"user": "string", "key": "string"}
-def expire_preauth_key(url, api_key, data):
-    app.logger.info("Expiring PreAuth Key...")
-    response = requests.post(
-        str(url)+"/api/v1/preauthkey/expire",
-        data=data,
-        headers={
-            'Accept': 'application/json',
-            'Content-Type': 'application/json',
-            'Authorization': 'Bearer '+str(api_key)
-        }
-    )
-    status = "True" if response.status_code == 200 else "False"
-    app.logger.debug("expire_preauth_key - Return:  "+str(response.json()))
-    app.logger.debug("expire_preauth_key - Status:  "+str(status))
-    return {"status": status, "body": response.json()}
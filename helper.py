@@ -1,7 +1,9 @@
 # pylint: disable=wrong-import-order
 
-import os, headscale, requests, logging
-from flask import Flask
+import os, time, headscale, config, deadline, requests, sqlite3, logging, threading
+from store   import shared_store
+from breaker import breaker
+from flask   import Flask
 
 LOG_LEVEL = os.environ["LOG_LEVEL"].replace('"', '').upper()
 DATA_DIRECTORY = os.environ["DATA_DIRECTORY"].replace('"', '') if os.environ["DATA_DIRECTORY"] else "/data"
@@ -54,7 +56,7 @@ def text_color_duration(duration):
     return "green-text                     "
 
 def key_check():
-    """ Checks the validity of a Headsclae API key and renews it if it's nearing expiration """
+    """ Checks the validity of a Headsclae API key.  Renewal is handled by renewal.key_renewal """
     api_key    = headscale.get_api_key()
     url        = headscale.get_url()
 
@@ -62,13 +64,15 @@ def key_check():
     # AKA, if headscale returns Unauthorized, fail:
     app.logger.info("Testing API key validity.")
     status = headscale.test_api_key(url, api_key)
+    # Headscale itself is failing, not the key.  Keep serving cached data.
+    if status >= 500 and breaker.degraded():
+        app.logger.warning("Headscale answered %i.  Skipping the key check.", status)
+        return True
     if status != 200:
         app.logger.info("Got a non-200 response from Headscale.  Test failed (Response:  %i)", status)
         return False
     else:
         app.logger.info("Key check passed.")
-        # Check if the key needs to be renewed
-        headscale.renew_api_key(url, api_key)
         return True
 
 def get_color(import_id, item_type = ""):
@@ -170,10 +174,19 @@ def access_checks():
 
     # Check 1: Check: the Headscale server is reachable:
     server_reachable = False
-    response = requests.get(str(url)+"/health")
-    if response.status_code == 200:
+    response_status  = "No response"
+    try:
+        response = headscale.client.get(url, "/health")
+        response_status = str(response.status_code)
+        if response.status_code == 200:
+            server_reachable = True
+    except requests.exceptions.RequestException as error:
+        app.logger.critical("Headscale URL: Request failed: %s", str(error))
+    # A server that has answered before is most likely restarting.  Pages serve cached data meanwhile.
+    if not server_reachable and breaker.degraded():
+        app.logger.warning("Headscale is unreachable.  Serving cached data.")
         server_reachable = True
-    else:
+    if not server_reachable:
         checks_passed = False
         app.logger.critical("Headscale URL: Response 200: FAILED")
 
@@ -205,8 +218,7 @@ def access_checks():
     else: app.logger.error(f"{os.path.join(DATA_DIRECTORY, 'key.txt')} EXIST: FAILED - NO ERROR")
 
     # Check: /etc/headscale/config.yaml is readable:
-    if os.access('/etc/headscale/config.yaml', os.R_OK):  config_readable = True
-    elif os.access('/etc/headscale/config.yml', os.R_OK): config_readable = True
+    if config.config_service.readable(): config_readable = True
     else:
         app.logger.error("/etc/headscale/config.y(a)ml: READ: FAILED")
         checks_passed = False
@@ -222,7 +234,7 @@ def access_checks():
         message = """
         <p>Your headscale server is either unreachable or not properly configured.
         Please ensure your configuration is correct (Check for 200 status on
-        """+url+"""/api/v1 failed.  Response:  """+str(response.status_code)+""".)</p>
+        """+url+"""/api/v1 failed.  Response:  """+response_status+""".)</p>
         """
 
         message_html += format_message("Error", "Headscale unreachable", message)
@@ -293,10 +305,109 @@ def access_checks():
 
     return message_html
 
-def load_checks():
-    """ Bundles all the checks into a single function to call easier """
+def run_checks():
+    """ Runs every check and returns the page to send the user to ("Pass" for none) """
     # General error checks.  See the function for more info:
-    if access_checks() != "Pass": return 'error_page'
+    message = access_checks()
+    if message != "Pass": return 'error_page', message
     # If the API key fails, redirect to the settings page:
-    if not key_check(): return 'settings_page'
-    return "Pass"
+    try:
+        if not key_check(): return 'settings_page', ""
+    except requests.exceptions.RequestException as error:
+        if breaker.degraded(): return "Pass", ""
+
+        app.logger.critical("API key check failed:  %s", str(error))
+        return 'error_page', format_message("Error", "Headscale unreachable", "<p>"+str(error)+"</p>")
+    return "Pass", ""
+
+HEALTH_CHECK_INTERVAL = float(os.environ.get("HEALTH_CHECK_INTERVAL", "30"))
+# Longest the first page waits for the background thread's first checks:  a /health and an API key request
+FIRST_CHECK_WAIT      = 2 * (headscale.HS_CONNECT_TIMEOUT + headscale.HS_READ_TIMEOUT)
+
+class HealthState():
+    """ Runs the page checks in the background and caches the verdict.
+        With a shared store, every worker uses the most recent verdict from any of them. """
+    def __init__(self, interval, shared=None):
+        self.interval   = interval
+        self.shared     = shared
+        self.verdict    = None  # None until the first run
+        self.message    = ""    # access_checks() output when the checks fail
+        self.thread     = None
+        self.lock       = threading.Lock()
+        self.wake       = threading.Event()
+        self.first_run  = threading.Event()  # Set once the background thread has finished its first checks
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None: return
+            self.thread = threading.Thread(target=self.run, name="health-checks", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            self.wake.clear()
+            try:
+                # Another worker may have just run the checks
+                if not self.adopt_shared(self.interval): self.refresh()
+            except Exception as error: # pylint: disable=broad-except
+                app.logger.error("Background health check failed:  %s", str(error))
+            self.first_run.set()
+            self.wake.wait(self.interval)
+
+    def adopt_shared(self, max_age):
+        """ Takes the shared verdict if it is younger than max_age.  Returns True if it did. """
+        if self.shared is None: return False
+        try: row = self.shared.get("health", "verdict")
+        except sqlite3.Error as error:
+            app.logger.warning("Shared store read failed:  %s", str(error))
+            return False
+        if row is None or time.time() - row[1] >= max_age: return False
+        with self.lock:
+            self.verdict = row[0]["verdict"]
+            self.message = row[0]["message"]
+        return True
+
+    def refresh(self):
+        """ Runs the checks now and stores the result """
+        # The verdict is shared by every page, so one page's deadline mustn't cut the checks short
+        with deadline.unbounded(): verdict, message = run_checks()
+        with self.lock:
+            self.verdict = verdict
+            self.message = message
+        if self.shared is not None:
+            try: self.shared.put("health", "verdict", {"verdict": verdict, "message": message})
+            except sqlite3.Error as error: app.logger.warning("Shared store write failed:  %s", str(error))
+        return verdict
+
+    def invalidate(self):
+        """ Re-runs the checks in the background, in every worker.  Pages keep the last verdict until then. """
+        if self.shared is not None:
+            try: self.shared.delete("health", "verdict")
+            except sqlite3.Error as error: app.logger.warning("Shared store write failed:  %s", str(error))
+        self.wake.set()
+
+    def on_auth_failure(self):
+        # Only a passing verdict can go stale this way.  Ignoring the rest also keeps the
+        # 401 from our own key test from re-triggering the checks in a loop.
+        if self.verdict == "Pass": self.invalidate()
+
+    def get_verdict(self):
+        self.start()
+        # A missing or old shared verdict means another worker invalidated it (or the checks
+        # are overdue).  The background thread re-runs them;  this page uses the last verdict.
+        if not self.adopt_shared(2 * self.interval) and self.shared is not None: self.wake.set()
+        with self.lock: verdict = self.verdict
+        if verdict is not None: return verdict
+        # Only the first pages in this worker wait, and only for the background thread's checks
+        self.first_run.wait(FIRST_CHECK_WAIT)
+        with self.lock: verdict = self.verdict
+        # The background checks failed (or hung).  Run them here so the page still gets an answer.
+        if verdict is None: verdict = self.refresh()
+        return verdict
+
+health_state = HealthState(HEALTH_CHECK_INTERVAL, shared_store)
+headscale.client.on_auth_failure(health_state.on_auth_failure)
+
+def load_checks():
+    """ Returns the cached verdict of the page checks.  See HealthState. """
+    return health_state.get_verdict()
@@ -0,0 +1,158 @@
+# pylint: disable=wrong-import-order
+
+import deadline, logs, os, time, asyncio, itertools, contextlib, contextvars, threading
+from collections import OrderedDict, deque
+
+logger = logs.get_logger(__name__)
+
+##################################################################
+# Admission control for requests to Headscale
+##################################################################
+HS_MAX_RPS        = float(os.environ.get("HS_MAX_RPS", "50"))                      # Requests per second.  0 disables the limit.
+HS_BURST          = float(os.environ.get("HS_BURST", str(max(HS_MAX_RPS, 1))))     # Requests allowed at once after an idle period
+HS_MAX_CONCURRENT = int(os.environ.get("HS_MAX_CONCURRENT", "10"))                 # Requests to Headscale in flight at once
+
+# Requests made for one page render (or /api call) share a scope.  Queued requests are
+# admitted round-robin across scopes, so a large page can't starve the pages behind it.
+request_scope = contextvars.ContextVar("request_scope", default="background")
+scope_ids     = itertools.count(1)
+
+@contextlib.contextmanager
+def scope(name):
+    token = request_scope.set(name+"-"+str(next(scope_ids)))
+    try: yield
+    finally: request_scope.reset(token)
+
+class UpstreamLimiter():
+    """ Token bucket plus a concurrency cap, shared by the synchronous and asynchronous clients.
+        Waiters are threads (blocked on an Event) or coroutines (awaiting a Future). """
+    def __init__(self, rate, burst, concurrency):
+        self.rate        = rate
+        self.burst       = burst
+        self.concurrency = concurrency
+        self.tokens      = burst
+        self.refilled_at = time.monotonic()
+        self.active      = 0
+        self.queues      = OrderedDict()  # scope -> deque of waiters, in round-robin order
+        self.depth       = 0              # Waiters across every queue
+        self.timer       = None           # Wakes the dispatcher when the next token is due
+        self.lock        = threading.Lock()
+        # Metrics for /api/stats
+        self.admitted    = 0
+        self.queued      = 0
+        self.max_depth   = 0
+        self.waited      = 0.0
+
+    def refill(self, now):
+        if self.rate <= 0:
+            self.tokens = self.burst
+            return
+        self.tokens      = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+    def admit(self, now):
+        """ Takes a token and a slot, if both are free.  Called with the lock held. """
+        self.refill(now)
+        if self.active >= self.concurrency or (self.rate > 0 and self.tokens < 1): return False
+        if self.rate > 0: self.tokens -= 1
+        self.active   += 1
+        self.admitted += 1
+        return True
+
+    def dispatch(self):
+        """ Admits queued waiters, one scope at a time.  Called with the lock held. """
+        now = time.monotonic()
+        while self.queues and self.admit(now):
+            name, waiters = next(iter(self.queues.items()))
+            waiter = waiters.popleft()
+            if waiters: self.queues.move_to_end(name)
+            else: del self.queues[name]
+            self.depth -= 1
+            self.waited += now - waiter["queued_at"]
+            waiter["admitted"] = True
+            waiter["wake"]()
+        # Out of tokens with free slots:  come back when the next token is due
+        if self.queues and self.active < self.concurrency and self.timer is None:
+            self.timer = threading.Timer((1 - self.tokens) / self.rate, self.on_timer)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def on_timer(self):
+        with self.lock:
+            self.timer = None
+            self.dispatch()
+
+    def enqueue(self, wake):
+        """ Returns None if admitted right away, or the queued waiter """
+        with self.lock:
+            if not self.queues and self.admit(time.monotonic()): return None
+            waiter = {"wake": wake, "admitted": False, "queued_at": time.monotonic(), "scope": request_scope.get()}
+            self.queues.setdefault(waiter["scope"], deque()).append(waiter)
+            self.depth    += 1
+            self.queued   += 1
+            self.max_depth = max(self.max_depth, self.depth)
+            self.dispatch()
+            return waiter
+
+    def withdraw(self, waiter):
+        """ Removes a waiter that gave up.  Returns False if it had already been admitted. """
+        with self.lock:
+            if waiter["admitted"]: return False
+            waiters = self.queues[waiter["scope"]]
+            waiters.remove(waiter)
+            if not waiters: del self.queues[waiter["scope"]]
+            self.depth -= 1
+            return True
+
+    def acquire(self):
+        """ Blocks the calling thread until it may send a request, or the request's deadline passes """
+        event  = threading.Event()
+        waiter = self.enqueue(event.set)
+        if waiter is None or event.wait(deadline.remaining()): return
+        if self.withdraw(waiter): raise deadline.DeadlineExceeded("Request deadline exceeded while queued for Headscale")
+
+    async def acquire_async(self):
+        """ acquire() for coroutines """
+        loop   = asyncio.get_running_loop()
+        future = loop.create_future()
+        def admitted():
+            if not future.done(): future.set_result(True)
+        waiter = self.enqueue(lambda: loop.call_soon_threadsafe(admitted))
+        if waiter is None: return
+        try: await deadline.wait(future)
+        except BaseException:
+            if not self.withdraw(waiter): self.release()
+            raise
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+            self.dispatch()
+
+    @contextlib.contextmanager
+    def slot(self):
+        self.acquire()
+        try: yield
+        finally: self.release()
+
+    @contextlib.asynccontextmanager
+    async def slot_async(self):
+        await self.acquire_async()
+        try: yield
+        finally: self.release()
+
+    def stats(self):
+        with self.lock:
+            self.refill(time.monotonic())
+            return {
+                "active"          : self.active,
+                "queue_depth"     : self.depth,
+                "queued_scopes"   : len(self.queues),
+                "max_queue_depth" : self.max_depth,
+                "admitted"        : self.admitted,
+                "queued"          : self.queued,
+                "average_wait_ms" : round(1000 * self.waited / self.queued, 1) if self.queued else 0,
+                "tokens"          : round(self.tokens, 1),
+            }
+
+limiter = UpstreamLimiter(HS_MAX_RPS, HS_BURST, HS_MAX_CONCURRENT)
@@ -0,0 +1,24 @@
+# pylint: disable=wrong-import-order
+
+import os, logging
+from flask.logging import default_handler, has_level_handler
+
+##################################################################
+# Logging for the modules that aren't Flask applications
+##################################################################
+LOG_LEVEL  = os.environ["LOG_LEVEL"].replace('"', '').upper()
+LOG_LEVELS = {
+    "DEBUG"   : logging.DEBUG,
+    "INFO"    : logging.INFO,
+    "WARNING" : logging.WARNING,
+    "ERROR"   : logging.ERROR,
+    "CRITICAL": logging.CRITICAL,
+}
+
+def get_logger(name):
+    """ The logger for a module, at LOG_LEVEL and in the same format as Flask's app.logger """
+    logger = logging.getLogger(name)
+    if LOG_LEVEL in LOG_LEVELS: logger.setLevel(LOG_LEVELS[LOG_LEVEL])
+    # Flask only adds its handler when nothing (ie, gunicorn) already handles the level
+    if not has_level_handler(logger): logger.addHandler(default_handler)
+    return logger
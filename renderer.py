@@ -1,10 +1,10 @@
 # pylint: disable=line-too-long, wrong-import-order
 
-import headscale, helper, pytz, os, yaml, logging, json
-from flask              import Flask, Markup, render_template
+import helper, config, fragments, timestamps, topology, os, logging, json, threading
+from flask              import Flask, Markup, escape, render_template
+from breaker            import breaker
 from datetime           import datetime
-from dateutil           import parser
-from concurrent.futures import ALL_COMPLETED, wait
+from collections        import deque
 from flask_executor     import Executor
 
 LOG_LEVEL = os.environ["LOG_LEVEL"].replace('"', '').upper()
@@ -18,105 +18,80 @@ match LOG_LEVEL:
     case "CRITICAL": app.logger.setLevel(logging.CRITICAL)
 executor = Executor(app)
 
-def render_overview():
+RENDER_WINDOW = 32  # Cards rendering ahead of the one being sent
+
+# Config-derived Overview sections, rebuilt only when the config file changes
+overview_config_cache = {"version": None, "content": ""}
+overview_config_lock  = threading.Lock()
+
+# lastSeen and lastSuccessfulUpdate move on almost every poll.  They are left out of a machine card's
+# fragment key and filled into the (possibly cached) card through these placeholders.
+MOVING_MACHINE_FIELDS = ("lastSeen", "lastSuccessfulUpdate")
+LAST_SEEN_TIME        = "<!--last-seen-time-->"
+LAST_SEEN_EPOCH       = "<!--last-seen-epoch-->"
+LAST_UPDATE_TIME      = "<!--last-update-time-->"
+
+# Shown in place of a count or a page that Headscale didn't return before the page deadline
+TIMED_OUT = "<i class='material-icons tooltipped' data-position='left' data-tooltip='Headscale did not answer in time'>hourglass_empty</i>"
+
+def render_stale_banner():
+    """ Shown above a page built from cached data while Headscale is failing.  See breaker.py. """
+    stale_since = breaker.stale_since()
+    if stale_since is None: return Markup("")
+    since       = datetime.fromtimestamp(stale_since, timestamps.TIMEZONE).strftime("%Y-%m-%d %H:%M:%S %Z")
+    return Markup("""
+    <div class="card-panel orange lighten-4">
+        <i class="material-icons left">cloud_off</i>
+        Headscale is not responding.  Showing cached data, stale since """+since+""".
+    </div>""")
+
+def relative_time(moment, delta_type=""):
+    """ Placeholder custom.js fills with how long ago moment was, or for delta_type "expiry", how long until it is """
+    return "<span class='relative-time' data-epoch='"+str(timestamps.epoch(moment))+"' data-type='"+delta_type+"'></span>"
+
+def render_timed_out():
+    return Markup("<br><br><br><center>Headscale did not answer in time.  Reload the page to try again.</center>")
+
+def render_overview(tailnet):
+    # tailnet = snapshot.load() result with machines, routes, users and preauth_keys
     app.logger.info("Rendering the Overview page")
-    url           = headscale.get_url()
-    api_key       = headscale.get_api_key()
 
-    timezone         = pytz.timezone(os.environ["TZ"] if os.environ["TZ"] else "UTC")
-    local_time       = timezone.localize(datetime.now())
-    
-    # Overview page will just read static information from the config file and display it
-    # Open the config.yaml and parse it.
-    config_file = ""
-    try:    
-        config_file = open("/etc/headscale/config.yml",  "r")
-        app.logger.info("Opening /etc/headscale/config.yml")
-    except: 
-        config_file = open("/etc/headscale/config.yaml", "r")
-        app.logger.info("Opening /etc/headscale/config.yaml")
-    config_yaml = yaml.safe_load(config_file)
+    local_time       = timestamps.now()
 
     # Get and display the following information:
     # Overview of the server's machines, users, preauth keys, API key expiration, server version
     
-    # Get all machines:
-    machines = headscale.get_machines(url, api_key)
-    machines_count = len(machines["machines"])
+    # Get all machines.  Resources missing from tailnet didn't load before the page deadline.
+    machines_count = len(tailnet["machines"]["machines"]) if "machines" in tailnet else TIMED_OUT
 
     # Need to check if routes are attached to an active machine:
     # ISSUE:  https://github.com/iFargle/headscale-webui/issues/36 
     # ISSUE:  https://github.com/juanfont/headscale/issues/1228 
 
     # Get all routes:
-    routes = headscale.get_routes(url,api_key)
-
-    total_routes = 0
-    for route in routes["routes"]:
-        if int(route['machine']['id']) != 0: 
-            total_routes += 1
-
-    enabled_routes = 0
-    for route in routes["routes"]:
-        if route["enabled"] and route['advertised'] and int(route['machine']['id']) != 0: 
-            enabled_routes += 1
+    if "routes" in tailnet:
+        route_counts = topology.get_topology(tailnet["routes"]).counts()
+    else:
+        route_counts = {"total": TIMED_OUT, "enabled": TIMED_OUT, "exits": TIMED_OUT, "exits_enabled": TIMED_OUT}
 
+    total_routes        = route_counts["total"]
+    enabled_routes      = route_counts["enabled"]
     # Get a count of all enabled exit routes
-    exits_count = 0
-    exits_enabled_count = 0
-    for route in routes["routes"]:
-        if route['advertised'] and int(route['machine']['id']) != 0:
-            if route["prefix"] == "0.0.0.0/0" or route["prefix"] == "::/0":
-                exits_count +=1
-                if route["enabled"]:
-                    exits_enabled_count += 1
+    exits_count         = route_counts["exits"]
+    exits_enabled_count = route_counts["exits_enabled"]
 
     # Get User and PreAuth Key counts
     user_count        = 0
     usable_keys_count = 0
-    users = headscale.get_users(url, api_key)
+    users = tailnet.get("users", {"users": []})
+    all_preauth_keys = tailnet.get("preauth_keys", {})
     for user in users["users"]:
         user_count +=1
-        preauth_keys = headscale.get_preauth_keys(url, api_key, user["name"])
-        for key in preauth_keys["preAuthKeys"]:
-            expiration_parse = parser.parse(key["expiration"])
-            key_expired = True if expiration_parse < local_time else False
-            if key["reusable"] and not key_expired: usable_keys_count += 1
-            if not key["reusable"] and not key["used"] and not key_expired: usable_keys_count += 1
-
-    # General Content variables:
-    ip_prefixes, server_url, disable_check_updates, ephemeral_node_inactivity_timeout, node_update_check_interval = "N/A", "N/A", "N/A", "N/A", "N/A"
-    if "ip_prefixes"                       in config_yaml:  ip_prefixes                       = str(config_yaml["ip_prefixes"])
-    if "server_url"                        in config_yaml:  server_url                        = str(config_yaml["server_url"])
-    if "disable_check_updates"             in config_yaml:  disable_check_updates             = str(config_yaml["disable_check_updates"])
-    if "ephemeral_node_inactivity_timeout" in config_yaml:  ephemeral_node_inactivity_timeout = str(config_yaml["ephemeral_node_inactivity_timeout"])
-    if "node_update_check_interval"        in config_yaml:  node_update_check_interval        = str(config_yaml["node_update_check_interval"])
-
-    # OIDC Content variables:
-    issuer, client_id, scope, use_expiry_from_token, expiry = "N/A", "N/A", "N/A", "N/A", "N/A"
-    if "oidc" in config_yaml:
-        if "issuer"                in config_yaml["oidc"] : issuer                = str(config_yaml["oidc"]["issuer"])                
-        if "client_id"             in config_yaml["oidc"] : client_id             = str(config_yaml["oidc"]["client_id"])             
-        if "scope"                 in config_yaml["oidc"] : scope                 = str(config_yaml["oidc"]["scope"])                 
-        if "use_expiry_from_token" in config_yaml["oidc"] : use_expiry_from_token = str(config_yaml["oidc"]["use_expiry_from_token"]) 
-        if "expiry"                in config_yaml["oidc"] : expiry                = str(config_yaml["oidc"]["expiry"])   
-
-    # Embedded DERP server information.
-    enabled, region_id, region_code, region_name, stun_listen_addr = "N/A", "N/A", "N/A", "N/A", "N/A"
-    if "derp" in config_yaml:
-        if "server" in config_yaml["derp"] and config_yaml["derp"]["server"]["enabled"]:
-            if "enabled"          in config_yaml["derp"]["server"]: enabled          = str(config_yaml["derp"]["server"]["enabled"])          
-            if "region_id"        in config_yaml["derp"]["server"]: region_id        = str(config_yaml["derp"]["server"]["region_id"])        
-            if "region_code"      in config_yaml["derp"]["server"]: region_code      = str(config_yaml["derp"]["server"]["region_code"])      
-            if "region_name"      in config_yaml["derp"]["server"]: region_name      = str(config_yaml["derp"]["server"]["region_name"])      
-            if "stun_listen_addr" in config_yaml["derp"]["server"]: stun_listen_addr = str(config_yaml["derp"]["server"]["stun_listen_addr"]) 
-    
-    nameservers, magic_dns, domains, base_domain = "N/A", "N/A", "N/A", "N/A"
-    if "dns_config" in config_yaml:
-        if "nameservers" in config_yaml["dns_config"]: nameservers = str(config_yaml["dns_config"]["nameservers"]) 
-        if "magic_dns"   in config_yaml["dns_config"]: magic_dns   = str(config_yaml["dns_config"]["magic_dns"])   
-        if "domains"     in config_yaml["dns_config"]: domains     = str(config_yaml["dns_config"]["domains"])     
-        if "base_domain" in config_yaml["dns_config"]: base_domain = str(config_yaml["dns_config"]["base_domain"]) 
+        for key in all_preauth_keys.get(user["name"], {"preAuthKeys": []})["preAuthKeys"]:
+            if preauth_key_usable(key, local_time): usable_keys_count += 1
+    # A partial count would be misleading
+    if "users" not in tailnet: user_count = TIMED_OUT
+    if "users" not in tailnet or any(user["name"] not in all_preauth_keys for user in users["users"]): usable_keys_count = TIMED_OUT
 
     # Start putting the content together
     overview_content = """
@@ -135,6 +110,53 @@ def render_overview():
         <div class="col s1"></div>
     </div>
     """
+    content = "<br>" + overview_content + render_overview_config(config.get_config())
+    return Markup(content)
+
+def render_overview_config(config_yaml):
+    # Overview page will just read static information from the config file and display it.
+    # The parsed config is versioned, so only rebuild the HTML when the file has changed.
+    with overview_config_lock:
+        if overview_config_cache["version"] == config_yaml.version:
+            return overview_config_cache["content"]
+
+    app.logger.info("Building the Overview config sections (config version %s)", str(config_yaml.version))
+    oidc, derp, dns_config = config_yaml.oidc, config_yaml.derp, config_yaml.dns_config
+
+    # General Content variables:
+    ip_prefixes, server_url, disable_check_updates, ephemeral_node_inactivity_timeout, node_update_check_interval = "N/A", "N/A", "N/A", "N/A", "N/A"
+    if "ip_prefixes"                       in config_yaml:  ip_prefixes                       = str(config_yaml.ip_prefixes)
+    if "server_url"                        in config_yaml:  server_url                        = str(config_yaml.server_url)
+    if "disable_check_updates"             in config_yaml:  disable_check_updates             = str(config_yaml.disable_check_updates)
+    if "ephemeral_node_inactivity_timeout" in config_yaml:  ephemeral_node_inactivity_timeout = str(config_yaml.ephemeral_node_inactivity_timeout)
+    if "node_update_check_interval"        in config_yaml:  node_update_check_interval        = str(config_yaml.node_update_check_interval)
+
+    # OIDC Content variables:
+    issuer, client_id, scope, use_expiry_from_token, expiry = "N/A", "N/A", "N/A", "N/A", "N/A"
+    if "oidc" in config_yaml:
+        if "issuer"                in oidc : issuer                = str(oidc["issuer"])                
+        if "client_id"             in oidc : client_id             = str(oidc["client_id"])             
+        if "scope"                 in oidc : scope                 = str(oidc["scope"])                 
+        if "use_expiry_from_token" in oidc : use_expiry_from_token = str(oidc["use_expiry_from_token"]) 
+        if "expiry"                in oidc : expiry                = str(oidc["expiry"])   
+
+    # Embedded DERP server information.
+    enabled, region_id, region_code, region_name, stun_listen_addr = "N/A", "N/A", "N/A", "N/A", "N/A"
+    if "derp" in config_yaml:
+        if "server" in derp and derp["server"].get("enabled"):
+            if "enabled"          in derp["server"]: enabled          = str(derp["server"]["enabled"])          
+            if "region_id"        in derp["server"]: region_id        = str(derp["server"]["region_id"])        
+            if "region_code"      in derp["server"]: region_code      = str(derp["server"]["region_code"])      
+            if "region_name"      in derp["server"]: region_name      = str(derp["server"]["region_name"])      
+            if "stun_listen_addr" in derp["server"]: stun_listen_addr = str(derp["server"]["stun_listen_addr"]) 
+    
+    nameservers, magic_dns, domains, base_domain = "N/A", "N/A", "N/A", "N/A"
+    if "dns_config" in config_yaml:
+        if "nameservers" in dns_config: nameservers = str(dns_config["nameservers"]) 
+        if "magic_dns"   in dns_config: magic_dns   = str(dns_config["magic_dns"])   
+        if "domains"     in dns_config: domains     = str(dns_config["domains"])     
+        if "base_domain" in dns_config: base_domain = str(dns_config["base_domain"]) 
+
     general_content = """
     <div class="row">
         <div class="col s1"></div>
@@ -205,8 +227,8 @@ def render_overview():
     # Remove DERP if it isn't available or isn't enabled
     if "derp" not in config_yaml:  derp_content = ""
     if "derp" in config_yaml:
-        if "server" in config_yaml["derp"]:
-            if str(config_yaml["derp"]["server"]["enabled"]) == "False":
+        if "server" in derp:
+            if str(derp["server"].get("enabled")) == "False":
                 derp_content = ""
 
     # TODO:  
@@ -216,7 +238,7 @@ def render_overview():
     #     The IP prefixes
     #     The DNS config
 
-    if config_yaml["derp"]["paths"]: pass
+    #     If derp["paths"] is set:
     #   # open the path:
     #   derp_file = 
     #   config_file = open("/etc/headscale/config.yaml", "r")
@@ -227,27 +249,15 @@ def render_overview():
     #     The log level
     #     What kind of Database is being used to drive headscale
 
-    content = "<br>" + overview_content + general_content + derp_content + oidc_content + dns_content + ""
-    return Markup(content)
-
-def thread_machine_content(machine, machine_content, idx, all_routes, failover_pair_prefixes):
-    # machine      = passed in machine information
-    # content      = place to write the content
-
-    # app.logger.debug("Machine Information")
-    # app.logger.debug(str(machine))
-    app.logger.debug("Machine Information =================")
-    app.logger.debug("Name:  %s, ID:  %s, User:  %s, givenName: %s, ", str(machine["name"]), str(machine["id"]), str(machine["user"]["name"]), str(machine["givenName"]))
-
-    url           = headscale.get_url()
-    api_key       = headscale.get_api_key()
+    content = general_content + derp_content + oidc_content + dns_content
+    with overview_config_lock:
+        overview_config_cache["version"] = config_yaml.version
+        overview_config_cache["content"] = content
+    return content
 
-    # Set the current timezone and local time
-    timezone   = pytz.timezone(os.environ["TZ"] if os.environ["TZ"] else "UTC")
-    local_time = timezone.localize(datetime.now())
-
-    # Get the machines routes
-    pulled_routes = headscale.get_machine_routes(url, api_key, machine["id"])
+def render_machine_routes(machine_id, route_topology):
+    """ The Routes collection item on a machine card.  Returns (html, exit_route_enabled, ha_enabled) """
+    pulled_routes = route_topology.machine_routes(machine_id)
     routes = ""
 
     # Test if the machine is an exit node:
@@ -257,12 +267,12 @@ def thread_machine_content(machine, machine_content, idx, all_routes, failover_p
     ha_enabled = False
 
     # If the length of "routes" is NULL/0, there are no routes, enabled or disabled:
-    if len(pulled_routes["routes"]) > 0:
+    if len(pulled_routes) > 0:
         advertised_routes = False
 
         # First, check if there are any routes that are both enabled and advertised
         # If that is true, we will output the collection-item for routes.  Otherwise, it will not be displayed.
-        for route in pulled_routes["routes"]:
+        for route in pulled_routes:
             if route["advertised"]: 
                 advertised_routes = True
         if advertised_routes:
@@ -272,8 +282,6 @@ def thread_machine_content(machine, machine_content, idx, all_routes, failover_p
                     <span class="title">Routes</span>
                     <p>
             """
-            # app.logger.debug("Pulled Routes Dump:  "+str(pulled_routes))
-            # app.logger.debug("All    Routes Dump:  "+str(all_routes))
 
             # Find all exits and put their ID's into the exit_routes array
             exit_routes  = []
@@ -281,8 +289,8 @@ def thread_machine_content(machine, machine_content, idx, all_routes, failover_p
             exit_tooltip = "enable"
             exit_route_enabled = False
             
-            for route in pulled_routes["routes"]:
-                if route["prefix"] == "0.0.0.0/0" or route["prefix"] == "::/0":
+            for route in pulled_routes:
+                if topology.is_exit_prefix(route["prefix"]):
                     exit_routes.append(route["id"])
                     exit_route_found = True
                     # Test if it is enabled:
@@ -298,43 +306,25 @@ def thread_machine_content(machine, machine_content, idx, all_routes, failover_p
                 routes = routes+""" <p 
                     class='waves-effect waves-light btn-small """+exit_enabled_color+""" lighten-2 tooltipped'
                     data-position='top' data-tooltip='Click to """+exit_tooltip+"""'
-                    id='"""+machine["id"]+"""-exit'
-                    onclick="toggle_exit("""+exit_routes[0]+""", """+exit_routes[1]+""", '"""+machine["id"]+"""-exit', '"""+str(exit_route_enabled)+"""', 'machines')">
+                    id='"""+machine_id+"""-exit'
+                    onclick="toggle_exit("""+exit_routes[0]+""", """+exit_routes[1]+""", '"""+machine_id+"""-exit', '"""+str(exit_route_enabled)+"""', 'machines')">
                     Exit Route
                 </p>
                 """
 
-            # Check if the route has another enabled identical route.  
-            # Check all routes from the current machine...
-            for route in pulled_routes["routes"]:
-                # ... against all routes from all machines ....
-                for route_info in all_routes["routes"]:
-                    app.logger.debug("Comparing routes %s and %s", str(route["prefix"]), str(route_info["prefix"]))
-                    # ... If the route prefixes match and are not exit nodes ... 
-                    if str(route_info["prefix"]) == str(route["prefix"]) and (route["prefix"] != "0.0.0.0/0" and route["prefix"] != "::/0"):
-                        # Check if the route ID's match.  If they don't ... 
-                        app.logger.debug("Found a match:  %s and %s", str(route["prefix"]), str(route_info["prefix"]))
-                        if route_info["id"] != route["id"]:
-                            app.logger.debug("Route ID's don't match.  They're on different nodes.")
-                            # ... Check if the routes prefix is already in the array...
-                            if route["prefix"] not in failover_pair_prefixes:
-                                #  IF it isn't, add it.
-                                app.logger.info("New HA pair found:  %s", str(route["prefix"]))
-                                failover_pair_prefixes.append(str(route["prefix"]))
-                            if route["enabled"] and route_info["enabled"]:
-                                # If it is already in the array. . .
-                                # Show as HA only if both routes are enabled:
-                                app.logger.debug("Both routes are enabled.  Setting as HA [%s] (%s) ", str(machine["name"]), str(route["prefix"]))
-                                ha_enabled = True
-                # If the route is an exit node and already counted as a failover route, it IS a failover route, so display it.
-                if route["prefix"] != "0.0.0.0/0" and route["prefix"] != "::/0" and route["prefix"] in failover_pair_prefixes:
+            # Show as HA only if a failover route and one of its partners are both enabled:
+            ha_enabled = route_topology.ha_enabled(machine_id)
+
+            # Failover routes share their prefix with a route on another machine.
+            # Each failover group gets its own color, fixed by the topology.
+            for route in pulled_routes:
+                if route_topology.is_failover(route):
                     route_enabled = "red"
                     route_tooltip = 'enable'
-                    color_index   = failover_pair_prefixes.index(str(route["prefix"]))
+                    color_index   = route_topology.failover_color_index(route["prefix"])
                     route_enabled_color = helper.get_color(color_index, "failover")
                     if route["enabled"]:
-                        color_index   = failover_pair_prefixes.index(str(route["prefix"]))
-                        route_enabled = helper.get_color(color_index, "failover")
+                        route_enabled = route_enabled_color
                         route_tooltip = 'disable'
                     routes = routes+""" <p 
                         class='waves-effect waves-light btn-small """+route_enabled+""" lighten-2 tooltipped'
@@ -346,9 +336,9 @@ def thread_machine_content(machine, machine_content, idx, all_routes, failover_p
                     """
                     
             # Get the remaining routes:
-            for route in pulled_routes["routes"]:
+            for route in pulled_routes:
                 # Get the remaining routes - No exits or failover pairs
-                if route["prefix"] != "0.0.0.0/0" and route["prefix"] != "::/0" and route["prefix"] not in failover_pair_prefixes:
+                if not topology.is_exit_prefix(route["prefix"]) and not route_topology.is_failover(route):
                     app.logger.debug("Route:  ["+str(route['machine']['name'])+"] id: "+str(route['id'])+" / prefix: "+str(route['prefix'])+" enabled?:  "+str(route['enabled']))
                     route_enabled = "red"
                     route_tooltip = 'enable'
@@ -364,176 +354,195 @@ def thread_machine_content(machine, machine_content, idx, all_routes, failover_p
                     </p>
                     """
             routes = routes+"</p></li>"
+    return routes, exit_route_enabled, ha_enabled
+
+def machine_route_facts(machine_id, route_topology):
+    """ What render_machine_routes() reads:  the machine's routes, and each failover group's color and partners """
+    routes   = route_topology.machine_routes(machine_id)
+    failover = {
+        route["prefix"]: [route_topology.failover_color_index(route["prefix"]), [[partner["id"], partner["enabled"]] for partner in route_topology.failover_groups[route["prefix"]]]]
+        for route in routes if route_topology.is_failover(route)
+    }
+    return {"routes": routes, "failover": failover}
+
+def machines_page_context(tailnet):
+    """ Phase one of the Machines page:  everything that depends on more than one machine
+        (failover groups and their colors, exit pairs) plus every machine's timestamps, computed once """
+    return {
+        # Converted once per machines response, not once per card
+        "times"         : timestamps.get_machine_times(tailnet["machines"]),
+        # Without routes, each card gets a placeholder that the browser fills in.
+        "route_topology": topology.get_topology(tailnet["routes"]) if "routes" in tailnet else None,
+    }
+
+def render_machine_card(machine, context):
+    """ Phase two:  one machine's card.  Reads only machine and context, so cards can be
+        rendered in any order, on any thread, with the same result. """
+    app.logger.debug("Machine Information =================")
+    app.logger.debug("Name:  %s, ID:  %s, User:  %s, givenName: %s, ", str(machine["name"]), str(machine["id"]), str(machine["user"]["name"]), str(machine["givenName"]))
 
-    # Get machine tags
-    tag_array = ""
-    for tag in machine["forcedTags"]: 
-        tag_array = tag_array+"{tag: '"+tag[4:]+"'}, "
-    tags = """
-        <li class="collection-item avatar">
-            <i class="material-icons circle tooltipped" data-position="right" data-tooltip="Spaces will be replaced with a dash (-) upon page refresh">label</i>
-            <span class="title">Tags</span>
-            <p><div style='margin: 0px' class='chips' id='"""+machine["id"]+"""-tags'></div></p>
-        </li>
-        <script>
-            window.addEventListener('load', 
-                function() { 
-                    var instances = M.Chips.init ( 
-                        document.getElementById('"""+machine['id']+"""-tags'),  ({
-                            data:["""+tag_array+"""], 
-                            onChipDelete() { delete_chip("""+machine["id"]+""", this.chipsData) }, 
-                            onChipAdd()    { add_chip("""+machine["id"]+""",    this.chipsData) }
-                        }) 
-                    );
-                }, false
-            )
-        </script>
-        """
+    times          = context["times"][str(machine["id"])]
+    route_topology = context["route_topology"]
 
-    # Get the machine IP's
-    machine_ips = "<ul>"
-    for ip_address in machine["ipAddresses"]:
-        machine_ips = machine_ips+"<li>"+ip_address+"</li>"
-    machine_ips = machine_ips+"</ul>"
-
-    # Format the dates for easy readability
-    last_seen_parse   = parser.parse(machine["lastSeen"])
-    last_seen_local   = last_seen_parse.astimezone(timezone)
-    last_seen_delta   = local_time - last_seen_local
-    last_seen_print   = helper.pretty_print_duration(last_seen_delta)
-    last_seen_time    = str(last_seen_local.strftime('%A %m/%d/%Y, %H:%M:%S'))+" "+str(timezone)+" ("+str(last_seen_print)+")"
-    
-    last_update_parse = local_time if machine["lastSuccessfulUpdate"] is None else parser.parse(machine["lastSuccessfulUpdate"])
-    last_update_local = last_update_parse.astimezone(timezone)
-    last_update_delta = local_time - last_update_local
-    last_update_print = helper.pretty_print_duration(last_update_delta)
-    last_update_time  = str(last_update_local.strftime('%A %m/%d/%Y, %H:%M:%S'))+" "+str(timezone)+" ("+str(last_update_print)+")"
-
-    created_parse     = parser.parse(machine["createdAt"])
-    created_local     = created_parse.astimezone(timezone)
-    created_delta     = local_time - created_local
-    created_print     = helper.pretty_print_duration(created_delta)
-    created_time      = str(created_local.strftime('%A %m/%d/%Y, %H:%M:%S'))+" "+str(timezone)+" ("+str(created_print)+")"
-
-    # If there is no expiration date, we don't need to do any calculations:
-    if machine["expiry"] != "0001-01-01T00:00:00Z":
-        expiry_parse     = parser.parse(machine["expiry"])
-        expiry_local     = expiry_parse.astimezone(timezone)
-        expiry_delta     = expiry_local - local_time
-        expiry_print     = helper.pretty_print_duration(expiry_delta, "expiry")
-        if str(expiry_local.strftime('%Y')) in ("0001",  "9999", "0000"):
-            expiry_time  = "No expiration date."
-        elif int(expiry_local.strftime('%Y')) > int(expiry_local.strftime('%Y'))+2:
-            expiry_time  = str(expiry_local.strftime('%m/%Y'))+" "+str(timezone)+" ("+str(expiry_print)+")"
-        else: 
-            expiry_time  = str(expiry_local.strftime('%A %m/%d/%Y, %H:%M:%S'))+" "+str(timezone)+" ("+str(expiry_print)+")"
+    # The card shows the machine record (tags included), its routes and their failover groups.
+    # Relative times are filled in by custom.js, so the card doesn't change with the clock.
+    route_facts = None if route_topology is None else machine_route_facts(machine["id"], route_topology)
+    card_key    = fragments.fragment_key({field: value for field, value in machine.items() if field not in MOVING_MACHINE_FIELDS}, route_facts, str(timestamps.TIMEZONE))
 
-        expiring_soon = True if int(expiry_delta.days) < 14 and int(expiry_delta.days) > 0 else False
-        app.logger.debug("Machine:  "+machine["name"]+" expires:  "+str(expiry_local.strftime('%Y'))+" / "+str(expiry_delta.days))
+    # Format the dates for easy readability.  custom.js adds how long ago (or until) each one is.
+    last_seen_local = times["lastSeen"]
+    last_seen_time  = timestamps.absolute(last_seen_local)+" "+relative_time(last_seen_local)
+    if times["lastSuccessfulUpdate"] is None:
+        last_update_time = "Never"
     else:
-        expiry_time  = "No expiration date."
-        expiring_soon = False
-        app.logger.debug("Machine:  "+machine["name"]+" has no expiration date")
-
-
-    # Get the first 10 characters of the PreAuth Key:
-    if machine["preAuthKey"]:
-        preauth_key = str(machine["preAuthKey"]["key"])[0:10]
-    else: preauth_key = "None"
-
-    # Set the status and user badge color:
-    text_color = helper.text_color_duration(last_seen_delta)
-    user_color = helper.get_color(int(machine["user"]["id"]))
-
-    # Generate the various badges:
-    status_badge      = "<i class='material-icons left tooltipped " + text_color + "' data-position='top' data-tooltip='Last Seen:  "+last_seen_print+"' id='"+machine["id"]+"-status'>fiber_manual_record</i>"
-    user_badge        = "<span class='badge ipinfo " + user_color + " white-text hide-on-small-only' id='"+machine["id"]+"-ns-badge'>"+machine["user"]["name"]+"</span>"
-    exit_node_badge   = "" if not exit_route_enabled else "<span class='badge grey white-text text-lighten-4 tooltipped' data-position='left' data-tooltip='This machine has an enabled exit route.'>Exit</span>"
-    ha_route_badge    = "" if not ha_enabled         else "<span class='badge blue-grey white-text text-lighten-4 tooltipped' data-position='left' data-tooltip='This machine has an enabled High Availabiilty (Failover) route.'>HA</span>"
-    expiration_badge  = "" if not expiring_soon      else "<span class='badge red white-text text-lighten-4 tooltipped' data-position='left' data-tooltip='This machine expires soon.'>Expiring!</span>"
-
-    machine_content[idx] = (str(render_template(
-        'machines_card.html', 
-        given_name        = machine["givenName"],
-        machine_id        = machine["id"],
-        hostname          = machine["name"],
-        ns_name           = machine["user"]["name"],
-        ns_id             = machine["user"]["id"],
-        ns_created        = machine["user"]["createdAt"],
-        last_seen         = str(last_seen_print),
-        last_update       = str(last_update_print),
-        machine_ips       = Markup(machine_ips),
-        advertised_routes = Markup(routes),
-        exit_node_badge   = Markup(exit_node_badge),
-        ha_route_badge    = Markup(ha_route_badge),
-        status_badge      = Markup(status_badge),
-        user_badge        = Markup(user_badge),
-        last_update_time  = str(last_update_time),
-        last_seen_time    = str(last_seen_time),
-        created_time      = str(created_time),
-        expiry_time       = str(expiry_time),
-        preauth_key       = str(preauth_key),
-        expiration_badge  = Markup(expiration_badge),
-        machine_tags      = Markup(tags),
-        taglist           = machine["forcedTags"]
-    )))
-    app.logger.info("Finished thread for machine "+machine["givenName"]+" index "+str(idx))
-
-def render_machines_cards():
+        last_update_local = times["lastSuccessfulUpdate"]
+        last_update_time  = timestamps.absolute(last_update_local)+" "+relative_time(last_update_local)
+
+    def render():
+        # Get the machines routes.  Without a route topology (the routes request missed the
+        # page deadline) the section is filled in by the browser once the page has loaded.
+        if route_topology is not None:
+            routes, exit_route_enabled, ha_enabled = render_machine_routes(machine["id"], route_topology)
+        else:
+            routes, exit_route_enabled, ha_enabled = deferred_section("api/machine_routes", {"id": machine["id"]}, "Routes", "directions"), False, False
+
+        # Get machine tags
+        tag_array = ""
+        for tag in machine["forcedTags"]: 
+            tag_array = tag_array+"{tag: '"+tag[4:]+"'}, "
+        tags = """
+            <li class="collection-item avatar">
+                <i class="material-icons circle tooltipped" data-position="right" data-tooltip="Spaces will be replaced with a dash (-) upon page refresh">label</i>
+                <span class="title">Tags</span>
+                <p><div style='margin: 0px' class='chips' id='"""+machine["id"]+"""-tags'></div></p>
+            </li>
+            <script>
+                window.addEventListener('load', 
+                    function() { 
+                        var instances = M.Chips.init ( 
+                            document.getElementById('"""+machine['id']+"""-tags'),  ({
+                                data:["""+tag_array+"""], 
+                                onChipDelete() { delete_chip("""+machine["id"]+""", this.chipsData) }, 
+                                onChipAdd()    { add_chip("""+machine["id"]+""",    this.chipsData) }
+                            }) 
+                        );
+                    }, false
+                )
+            </script>
+            """
+
+        # Get the machine IP's
+        machine_ips = "<ul>"
+        for ip_address in machine["ipAddresses"]:
+            machine_ips = machine_ips+"<li>"+ip_address+"</li>"
+        machine_ips = machine_ips+"</ul>"
+
+        created_local     = times["createdAt"]
+        created_time      = timestamps.absolute(created_local)+" "+relative_time(created_local)
+
+        # If there is no expiration date, we don't need to do any calculations:
+        expiration_badge  = ""
+        if machine["expiry"] != "0001-01-01T00:00:00Z":
+            expiry_local     = times["expiry"]
+            if str(expiry_local.strftime('%Y')) in ("0001",  "9999", "0000"):
+                expiry_time  = "No expiration date."
+            elif int(expiry_local.strftime('%Y')) > int(expiry_local.strftime('%Y'))+2:
+                expiry_time  = str(expiry_local.strftime('%m/%Y'))+" "+str(timestamps.TIMEZONE)+" "+relative_time(expiry_local, "expiry")
+            else: 
+                expiry_time  = timestamps.absolute(expiry_local)+" "+relative_time(expiry_local, "expiry")
+
+            # Shown by custom.js while the machine expires in the next two weeks
+            expiration_badge = "<span class='badge red white-text text-lighten-4 tooltipped expiring-badge hide' data-epoch='"+str(timestamps.epoch(expiry_local))+"' data-position='left' data-tooltip='This machine expires soon.'>Expiring!</span>"
+            app.logger.debug("Machine:  "+machine["name"]+" expires:  "+str(expiry_local.strftime('%Y')))
+        else:
+            expiry_time  = "No expiration date."
+            app.logger.debug("Machine:  "+machine["name"]+" has no expiration date")
+
+        # Get the first 10 characters of the PreAuth Key:
+        if machine["preAuthKey"]:
+            preauth_key = str(machine["preAuthKey"]["key"])[0:10]
+        else: preauth_key = "None"
+
+        # Set the user badge color:
+        user_color = helper.get_color(int(machine["user"]["id"]))
+
+        # Generate the various badges.  custom.js colors the status badge by how long ago the machine was seen.
+        status_badge      = "<i class='material-icons left tooltipped last-seen-status' data-epoch='"+LAST_SEEN_EPOCH+"' data-position='top' data-tooltip='Last Seen' id='"+machine["id"]+"-status'>fiber_manual_record</i>"
+        user_badge        = "<span class='badge ipinfo " + user_color + " white-text hide-on-small-only' id='"+machine["id"]+"-ns-badge'>"+machine["user"]["name"]+"</span>"
+        exit_node_badge   = "" if not exit_route_enabled else "<span class='badge grey white-text text-lighten-4 tooltipped' data-position='left' data-tooltip='This machine has an enabled exit route.'>Exit</span>"
+        ha_route_badge    = "" if not ha_enabled         else "<span class='badge blue-grey white-text text-lighten-4 tooltipped' data-position='left' data-tooltip='This machine has an enabled High Availabiilty (Failover) route.'>HA</span>"
+
+        return str(render_template(
+            'machines_card.html', 
+            given_name        = machine["givenName"],
+            machine_id        = machine["id"],
+            hostname          = machine["name"],
+            ns_name           = machine["user"]["name"],
+            ns_id             = machine["user"]["id"],
+            ns_created        = machine["user"]["createdAt"],
+            machine_ips       = Markup(machine_ips),
+            advertised_routes = Markup(routes),
+            exit_node_badge   = Markup(exit_node_badge),
+            ha_route_badge    = Markup(ha_route_badge),
+            status_badge      = Markup(status_badge),
+            user_badge        = Markup(user_badge),
+            last_update_time  = Markup(LAST_UPDATE_TIME),
+            last_seen_time    = Markup(LAST_SEEN_TIME),
+            created_time      = Markup(created_time),
+            expiry_time       = Markup(expiry_time),
+            preauth_key       = str(preauth_key),
+            expiration_badge  = Markup(expiration_badge),
+            machine_tags      = Markup(tags),
+            taglist           = machine["forcedTags"]
+        ))
+
+    card = fragments.machine_cards.get(card_key, render)
+    return card.replace(LAST_SEEN_TIME, last_seen_time).replace(LAST_SEEN_EPOCH, str(timestamps.epoch(last_seen_local))).replace(LAST_UPDATE_TIME, last_update_time)
+
+def render_machines_cards(tailnet):
+    """ Yields the Machines page's cards in the order of the machines response, each as soon as it
+        (and every card before it) has rendered.  The template iterates it, so with STREAM_PAGES the
+        first cards go out while the rest are still rendering. """
+    # tailnet = snapshot.load() result with machines and routes
     app.logger.info("Rendering machine cards")
-    url           = headscale.get_url()
-    api_key       = headscale.get_api_key()
-    machines_list = headscale.get_machines(url, api_key)
-
-    #########################################
-    # Thread this entire thing.  
-    num_threads = len(machines_list["machines"])
-    iterable = []
-    machine_content = {}
-    failover_pair_prefixes = []
-    for i in range (0, num_threads):
-        app.logger.debug("Appending iterable:  "+str(i))
-        iterable.append(i)
-    # Flask-Executor Method:
-
-    # Get all routes
-    all_routes = headscale.get_routes(url, api_key)
-    # app.logger.debug("All found routes")
-    # app.logger.debug(str(all_routes))
+    if "machines" not in tailnet:
+        yield render_timed_out()
+        return
+    machines = tailnet["machines"]["machines"]
+    context  = machines_page_context(tailnet)
 
+    yield Markup("<ul class='collapsible expandable'>")
     if LOG_LEVEL == "DEBUG":
         # DEBUG:  Do in a forloop:
-        for idx in iterable: thread_machine_content(machines_list["machines"][idx], machine_content, idx, all_routes, failover_pair_prefixes)
+        for machine in machines: yield Markup(render_machine_card(machine, context))
     else:
-        app.logger.info("Starting futures")
-        futures = [executor.submit(thread_machine_content, machines_list["machines"][idx], machine_content, idx, all_routes, failover_pair_prefixes) for idx in iterable]
-        # Wait for the executor to finish all jobs:
-        wait(futures, return_when=ALL_COMPLETED)
-        app.logger.info("Finished futures")
-
-    # Sort the content by machine_id:
-    sorted_machines = {key: val for key, val in sorted(machine_content.items(), key = lambda ele: ele[0])}
-
-    content = "<ul class='collapsible expandable'>"
-    # Print the content
-
-    for index in range(0, num_threads):
-        content = content+str(sorted_machines[index])
-
-    content = content+"</ul>"
-
-    return Markup(content)
-
-def render_users_cards():
+        # Only RENDER_WINDOW cards are rendered ahead of the one being sent, so memory
+        # stays flat however large the tailnet is
+        pending = deque()
+        for machine in machines:
+            pending.append(executor.submit(render_machine_card, machine, context))
+            if len(pending) >= RENDER_WINDOW: yield Markup(pending.popleft().result())
+        while pending: yield Markup(pending.popleft().result())
+    yield Markup("</ul>")
+
+def render_users_cards(tailnet):
+    """ Yields the Users page's cards one user at a time.  See render_machines_cards(). """
+    # tailnet = snapshot.load() result with users and preauth_keys
     app.logger.info("Rendering Users cards")
-    url       = headscale.get_url()
-    api_key   = headscale.get_api_key()
-    user_list = headscale.get_users(url, api_key)
+    if "users" not in tailnet:
+        yield render_timed_out()
+        return
+    user_list = tailnet["users"]
+    all_preauth_keys = tailnet.get("preauth_keys", {})
 
-    content = "<ul class='collapsible expandable'>"
+    yield Markup("<ul class='collapsible expandable'>")
     for user in user_list["users"]:
         # Get all preAuth Keys in the user, only display if one exists:
-        preauth_keys_collection = build_preauth_key_table(user["name"])
+        # Keys that missed the page deadline are loaded by the browser
+        if user["name"] in all_preauth_keys:
+            preauth_keys_collection = build_preauth_key_table(user["name"], all_preauth_keys[user["name"]])
+        else:
+            preauth_keys_collection = deferred_section("api/build_preauthkey_table", {"name": user["name"]}, "PreAuth Keys", "vpn_key")
 
         # Set the user badge color:
         user_color = helper.get_color(int(user["id"]), "text")
@@ -541,22 +550,36 @@ def render_users_cards():
         # Generate the various badges:
         status_badge      = "<i class='material-icons left "+user_color+"' id='"+user["id"]+"-status'>fiber_manual_record</i>"
 
-        content = content + render_template(
+        yield Markup(render_template(
             'users_card.html', 
             status_badge            = Markup(status_badge),
             user_name               = user["name"],
             user_id                 = user["id"],
             preauth_keys_collection = Markup(preauth_keys_collection)
-        ) 
-    content = content+"</ul>"
-    return Markup(content)
-
-def build_preauth_key_table(user_name):
+        ))
+    yield Markup("</ul>")
+
+def deferred_section(url, payload, title, icon):
+    """ Placeholder for a collection item that missed the page deadline.
+        custom.js POSTs payload to url and swaps in the HTML it returns. """
+    return """<li class="collection-item avatar deferred-section" data-url='"""+url+"""' data-payload='"""+str(escape(json.dumps(payload)))+"""'>
+            <i class="material-icons circle">"""+icon+"""</i>
+            <span class="title">"""+title+"""</span>
+            <p class="deferred-status">Still loading from Headscale...</p>
+        </li>"""
+
+def preauth_key_usable(key, local_time):
+    """ A key is usable if it hasn't expired and is either reusable or unused """
+    expiration_parse = timestamps.parse(key["expiration"])
+    key_expired = True if expiration_parse < local_time else False
+    if key["reusable"] and not key_expired: return True
+    if not key["reusable"] and not key["used"] and not key_expired: return True
+    return False
+
+def build_preauth_key_table(user_name, preauth_keys):
+    # preauth_keys = /api/v1/preauthkey response for user_name
     app.logger.info("Building the PreAuth key table for User:  %s", str(user_name))
-    url            = headscale.get_url()
-    api_key        = headscale.get_api_key()
 
-    preauth_keys = headscale.get_preauth_keys(url, api_key, user_name)
     preauth_keys_collection = """<li class="collection-item avatar">
             <span
                 class='badge grey lighten-2 btn-small' 
@@ -586,34 +609,31 @@ def build_preauth_key_table(user_name):
                         </tr>
                     </thead>
                 """
+    local_time = timestamps.now()
     for key in preauth_keys["preAuthKeys"]:
-        # Get the key expiration date and compare it to now to check if it's expired:
-        # Set the current timezone and local time
-        timezone         = pytz.timezone(os.environ["TZ"] if os.environ["TZ"] else "UTC")
-        local_time       = timezone.localize(datetime.now())
-        expiration_parse = parser.parse(key["expiration"])
-        key_expired = True if expiration_parse < local_time else False
-        expiration_time  = str(expiration_parse.strftime('%A %m/%d/%Y, %H:%M:%S'))+" "+str(timezone)
-
-        key_usable = False
-        if key["reusable"] and not key_expired: key_usable = True
-        if not key["reusable"] and not key["used"] and not key_expired: key_usable = True
-        
+        expiration_parse = timestamps.parse(key["expiration"])
+        expiration_time  = str(expiration_parse.strftime('%A %m/%d/%Y, %H:%M:%S'))+" "+str(timestamps.TIMEZONE)
+
+        # Keys that are usable now carry their expiration, so custom.js can mark the row
+        # (and drop its Usable dot and Expire button) if it passes while the page is open.
+        key_usable = preauth_key_usable(key, local_time)
+
         # Class for the javascript function to look for to toggle the hide function
         hide_expired = "expired-row" if not key_usable else ""
+        expires_at   = "data-expiration='"+str(timestamps.epoch(expiration_parse))+"'" if key_usable else ""
 
         btn_reusable  = "<i class='pulse material-icons tiny blue-text text-darken-1'>fiber_manual_record</i>"   if key["reusable"]  else ""
         btn_ephemeral = "<i class='pulse material-icons tiny red-text text-darken-1'>fiber_manual_record</i>"    if key["ephemeral"] else ""
         btn_used      = "<i class='pulse material-icons tiny yellow-text text-darken-1'>fiber_manual_record</i>" if key["used"]      else ""
-        btn_usable    = "<i class='pulse material-icons tiny green-text text-darken-1'>fiber_manual_record</i>"  if key_usable       else ""
+        btn_usable    = "<i class='pulse material-icons tiny green-text text-darken-1 key-usable'>fiber_manual_record</i>"  if key_usable       else ""
 
         # Other buttons:
-        btn_delete    = "<span href='#card_modal' data-tooltip='Expire this PreAuth Key' class='btn-small modal-trigger badge tooltipped white-text red' onclick='load_modal_expire_preauth_key(\""+user_name+"\", \""+str(key["key"])+"\")'>Expire</span>" if key_usable else ""
+        btn_delete    = "<span href='#card_modal' data-tooltip='Expire this PreAuth Key' class='btn-small modal-trigger badge tooltipped white-text red key-usable' onclick='load_modal_expire_preauth_key(\""+user_name+"\", \""+str(key["key"])+"\")'>Expire</span>" if key_usable else ""
         tooltip_data  = "Expiration:  "+expiration_time
 
         # TR ID will look like "1-albert-tr"
         preauth_keys_collection = preauth_keys_collection+"""
-            <tr id='"""+key["id"]+"""-"""+user_name+"""-tr' class='"""+hide_expired+"""'>
+            <tr id='"""+key["id"]+"""-"""+user_name+"""-tr' class='"""+hide_expired+"""' """+expires_at+""">
                 <td>"""+str(key["id"])+"""</td>
                 <td  onclick=copy_preauth_key('"""+str(key["key"])+"""') class='tooltipped' data-tooltip='"""+tooltip_data+"""'>"""+str(key["key"])[0:10]+"""</td>
                 <td><center>"""+btn_reusable+"""</center></td>
@@ -671,18 +691,16 @@ def render_search():
     """
     return Markup(html_payload)
 
-def render_routes():
+def render_routes(tailnet):
+    # tailnet = snapshot.load() result with routes
     app.logger.info("Rendering Routes page")
-    url           = headscale.get_url()
-    api_key       = headscale.get_api_key()
-    all_routes    = headscale.get_routes(url, api_key)
+    if "routes" not in tailnet: return render_timed_out()
+    all_routes    = tailnet["routes"]
 
     # If there are no routes, just exit:
     if len(all_routes) == 0: return Markup("<br><br><br><center>There are no routes to display!</center>")
-    # Get a list of all Route ID's to iterate through:
-    all_routes_id_list = []
+    route_topology = topology.get_topology(all_routes)
     for route in all_routes["routes"]:
-        all_routes_id_list.append(route["id"])
         if route["machine"]["name"]:
             app.logger.info("Found route %s / machine: %s", str(route["id"]), route["machine"]["name"])
         else: 
@@ -718,6 +736,7 @@ def render_routes():
     route_content += """<p><table>
     <thead>
         <tr>
+            <th width="40px"></th>
             <th>ID       </th>
             <th>Machine  </th>
             <th>Route    </th>
@@ -744,18 +763,15 @@ def render_routes():
 
         if is_enabled:  enabled_display = enabled
         # Check if a prefix is an Exit route:
-        if prefix == "0.0.0.0/0" or prefix == "::/0":  is_exit = True
+        if topology.is_exit_prefix(prefix):  is_exit = True
         # Check if a prefix is part of a failover pair:
-        for route_check in all_routes["routes"]:
-            if not is_exit:
-                if route["prefix"] == route_check["prefix"]:
-                    if route["id"] != route_check["id"]:
-                        is_failover = True
+        if route_topology.is_failover(route): is_failover = True
 
         if not is_exit and not is_failover and machine != "":
         # Build a simple table for all non-exit routes:
             route_content += """
             <tr>
+                <td><label><input type="checkbox" class="filled-in bulk-select" value='"""+str(route_id)+"""' onchange="bulk_selection_changed()"/><span></span></label></td>
                 <td>"""+str(route_id         )+"""</td>
                 <td>"""+str(machine          )+"""</td>
                 <td>"""+str(prefix           )+"""</td>
@@ -766,23 +782,7 @@ def render_routes():
 
     ##############################################################################################
     # Step 2:  Get all failover routes only.  Add a separate table per failover prefix
-    failover_route_prefix = []
-    failover_available = False
-
-    for route in all_routes["routes"]:
-        # Get a list of all prefixes for all routes...
-        for route_check in all_routes["routes"]:
-            # ... that  aren't exit routes... 
-            if route["prefix"] !="0.0.0.0/0" and route["prefix"] != "::/0":
-                # if the curren route matches any prefix of any other route...
-                if route["prefix"] == route_check["prefix"]:
-                    # and the route ID's are different ...
-                    if route["id"] != route_check["id"]:
-                        # ... and the prefix is not already in the list...
-                        if route["prefix"] not in failover_route_prefix:
-                            # append the prefix to the failover_route_prefix list
-                            failover_route_prefix.append(route["prefix"])
-                            failover_available = True
+    failover_available = len(route_topology.failover_groups) > 0
 
     if failover_available:
         # Set up the display code:
@@ -791,22 +791,17 @@ def render_routes():
 
         failover_content = markup_pre+failover_title
         # Build the display for failover routes:
-        for route_prefix in failover_route_prefix:
+        for route_prefix, failover_group in route_topology.failover_groups.items():
             # Get all route ID's associated with the route_prefix:
-            route_id_list = []
-            for route in all_routes["routes"]:
-                if route["prefix"] == route_prefix:
-                    route_id_list.append(route["id"])
+            route_id_list = [route["id"] for route in failover_group]
 
             # Set up the display code:
             failover_enabled  = "<i id='"+str(route_prefix)+"' class='material-icons small left green-text text-lighten-2'>fiber_manual_record</i>"
             failover_disabled = "<i id='"+str(route_prefix)+"' class='material-icons small left red-text text-lighten-2'>fiber_manual_record</i>"
 
             failover_display = failover_disabled
-            for route_id in route_id_list:
-                # Get the routes index:
-                current_route_index = all_routes_id_list.index(route_id)
-                if all_routes["routes"][current_route_index]["enabled"]: failover_display = failover_enabled
+            for route in failover_group:
+                if route["enabled"]: failover_display = failover_enabled
 
 
             # Get all route_id's associated with the route prefix:
@@ -823,20 +818,18 @@ def render_routes():
                 <tbody>
             """
 
-            # Build the display:
-            for route_id in route_id_list:
-                idx = all_routes_id_list.index(route_id)
+            payload = []
+            for item in route_id_list: payload.append(int(item))
 
-                machine    = all_routes["routes"][idx]["machine"]["givenName"]
-                machine_id = all_routes["routes"][idx]["machine"]["id"]
-                is_primary = all_routes["routes"][idx]["isPrimary"]
-                is_enabled = all_routes["routes"][idx]["enabled"]
+            # Build the display:
+            for route in failover_group:
+                route_id   = route["id"]
+                machine    = route["machine"]["givenName"]
+                machine_id = route["machine"]["id"]
+                is_primary = route["isPrimary"]
+                is_enabled = route["enabled"]
 
-                payload = []
-                for item in route_id_list: payload.append(int(item))
-                 
                 app.logger.debug("[%s] Machine:  [%s]  %s : %s / %s", str(route_id), str(machine_id), str(machine), str(is_enabled), str(is_primary))
-                app.logger.debug(str(all_routes["routes"][idx]))
 
                 # Set up the display code:
                 enabled_display_enabled  = "<i id='"+str(route_id)+"' onclick='toggle_failover_route_routespage("+str(route_id)+", \"True\", \""+str(route_prefix)+"\", "+str(payload)+")'  class='material-icons green-text text-lighten-2 tooltipped' data-tooltip='Click to disable'>fiber_manual_record</i>"
@@ -861,16 +854,6 @@ def render_routes():
 
     ##############################################################################################
     # Step 3:  Get exit nodes only:
-    exit_node_list = []
-    # Get a list of nodes with exit routes:
-    for route in all_routes["routes"]:
-        # For every exit route found, store the machine name in an array:
-        if route["prefix"] == "0.0.0.0/0" or route["prefix"] == "::/0":
-            if route["machine"]["givenName"] not in exit_node_list: 
-                exit_node_list.append(route["machine"]["givenName"])
-
-    # Exit node display building:
-    # Display by machine, not by route
     exit_content = markup_pre+exit_title
     exit_content += """<p><table>
     <thead>
@@ -881,34 +864,24 @@ def render_routes():
     </thead>
     <tbody>
     """
-    # Get exit route ID's for each node in the list: 
-    for node in exit_node_list:
-        node_exit_route_ids = []
-        exit_enabled = False
-        exit_available = False
-        machine_id = 0
-        for route in all_routes["routes"]:
-            if route["prefix"] == "0.0.0.0/0" or route["prefix"] == "::/0":
-                if route["machine"]["givenName"] == node:
-                    node_exit_route_ids.append(route["id"])
-                    machine_id = route["machine"]["id"]
-                    exit_available = True
-                    if route["enabled"]:
-                        exit_enabled = True
+    # Get exit route ID's for each node with exit routes.  Display by machine, not by route:
+    for machine_id, exit_routes in route_topology.exit_nodes.items():
+        node                = exit_routes[0]["machine"]["givenName"]
+        node_exit_route_ids = [route["id"] for route in exit_routes]
+        exit_enabled        = any(route["enabled"] for route in exit_routes)
 
-        if exit_available:
-            # Set up the display code:
-            enabled  = "<i id='"+machine_id+"-exit' onclick='toggle_exit("+node_exit_route_ids[0]+", "+node_exit_route_ids[1]+", \""+machine_id+"-exit\", \"True\",  \"routes\")' class='material-icons green-text text-lighten-2 tooltipped' data-tooltip='Click to disable'>fiber_manual_record</i>"
-            disabled = "<i id='"+machine_id+"-exit' onclick='toggle_exit("+node_exit_route_ids[0]+", "+node_exit_route_ids[1]+", \""+machine_id+"-exit\", \"False\", \"routes\")' class='material-icons red-text text-lighten-2 tooltipped' data-tooltip='Click to enable' >fiber_manual_record</i>"
-            # Set the displays:
-            enabled_display = enabled if exit_enabled else disabled
+        # Set up the display code:
+        enabled  = "<i id='"+machine_id+"-exit' onclick='toggle_exit("+node_exit_route_ids[0]+", "+node_exit_route_ids[1]+", \""+machine_id+"-exit\", \"True\",  \"routes\")' class='material-icons green-text text-lighten-2 tooltipped' data-tooltip='Click to disable'>fiber_manual_record</i>"
+        disabled = "<i id='"+machine_id+"-exit' onclick='toggle_exit("+node_exit_route_ids[0]+", "+node_exit_route_ids[1]+", \""+machine_id+"-exit\", \"False\", \"routes\")' class='material-icons red-text text-lighten-2 tooltipped' data-tooltip='Click to enable' >fiber_manual_record</i>"
+        # Set the displays:
+        enabled_display = enabled if exit_enabled else disabled
 
-            exit_content += """
-            <tr>
-                <td>"""+str(node)+"""</td>
-                <td width="60px"><center>"""+str(enabled_display)+"""</center></td>
-            </tr>
-            """
+        exit_content += """
+        <tr>
+            <td>"""+str(node)+"""</td>
+            <td width="60px"><center>"""+str(enabled_display)+"""</center></td>
+        </tr>
+        """
     exit_content += "</tbody></table></p>"+markup_post
 
     content = route_content + failover_content + exit_content
@@ -0,0 +1,78 @@
+# pylint: disable=wrong-import-order
+
+import headscale, logs, os, fcntl, threading
+from datetime import datetime, timezone
+
+DATA_DIRECTORY = os.environ["DATA_DIRECTORY"].replace('"', '') if os.environ["DATA_DIRECTORY"] else "/data"
+logger = logs.get_logger(__name__)
+
+##################################################################
+# Background API key renewal
+##################################################################
+RENEWAL_LOCK_FILE    = os.path.join(DATA_DIRECTORY, "key.lock")
+RENEWAL_MIN_INTERVAL = 60             # Retry delay after a failure, in seconds
+RENEWAL_MAX_INTERVAL = 6 * 60 * 60    # Re-check the key at least this often, in seconds
+
+class KeyRenewalScheduler():
+    """ Renews the API key ahead of its expiration, outside of any page request """
+    def __init__(self, lock_file):
+        self.lock_file = lock_file
+        self.thread    = None
+        self.lock      = threading.Lock()
+        self.wake      = threading.Event()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None: return
+            self.thread = threading.Thread(target=self.run, name="key-renewal", daemon=True)
+            self.thread.start()
+
+    def reschedule(self):
+        """ Re-computes the next check immediately, ie after a new key was saved """
+        self.wake.set()
+
+    def run(self):
+        while True:
+            self.wake.clear()
+            try: delay = self.check()
+            except Exception as error: # pylint: disable=broad-except
+                logger.error("API key renewal check failed:  %s", str(error))
+                delay = RENEWAL_MIN_INTERVAL
+            logger.info("Next API key renewal check in %i seconds", int(delay))
+            self.wake.wait(delay)
+
+    def check(self):
+        """ Renews the key if it is inside the renewal window.  Returns seconds until the next check. """
+        api_key = headscale.get_api_key()
+        if not api_key or api_key == "NULL": return RENEWAL_MAX_INTERVAL
+        url      = headscale.get_url()
+        key_info = headscale.get_api_key_info(url, api_key)
+        if key_info == "Key not found": return RENEWAL_MIN_INTERVAL
+
+        # The same window headscale.renew_api_key renews in
+        renew_at = headscale.renewal_time(key_info["expiration"])
+        now      = datetime.now(timezone.utc)
+        if now >= renew_at:
+            self.renew(url)
+            # Check the new key's expiration (or retry a failed renewal) shortly
+            return RENEWAL_MIN_INTERVAL
+        return min(max((renew_at - now).total_seconds(), RENEWAL_MIN_INTERVAL), RENEWAL_MAX_INTERVAL)
+
+    def renew(self, url):
+        """ Rotates the key while holding an exclusive lock on the lock file """
+        with open(self.lock_file, "a") as lock_file:
+            try: fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info("Another worker is renewing the API key.  Skipping.")
+                return True
+            try:
+                # Re-read the key under the lock.  If another worker already rotated it,
+                # renew_api_key sees the new expiration and does nothing.
+                api_key = headscale.get_api_key()
+                renewed = headscale.renew_api_key(url, api_key)
+                logger.info("API key renewal finished.  Result:  %s", str(renewed))
+                return renewed
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+key_renewal = KeyRenewalScheduler(RENEWAL_LOCK_FILE)
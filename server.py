@@ -1,10 +1,8 @@
 # pylint: disable=wrong-import-order
 
-import headscale, helper, json, os, pytz, renderer, secrets, requests, logging
+import headscale, aioheadscale, breaker, bulk, deadline, helper, events, fragments, json, limiter, os, renderer, renewal, secrets, snapshot, timestamps, topology, requests, logging
 from functools                     import wraps
-from datetime                      import datetime
-from flask                         import Flask, escape, Markup, redirect, render_template, request, url_for
-from dateutil                      import parser
+from flask                         import Flask, escape, Markup, Response, redirect, render_template, request, stream_template, url_for
 from flask_executor                import Executor
 from werkzeug.middleware.proxy_fix import ProxyFix
 
@@ -17,6 +15,8 @@ AUTH_TYPE   = os.environ["AUTH_TYPE"].replace('"', '').lower()
 LOG_LEVEL   = os.environ["LOG_LEVEL"].replace('"', '').upper()
 # If LOG_LEVEL is DEBUG, enable Flask debugging:
 DEBUG_STATE = True if LOG_LEVEL == "DEBUG" else False
+# Send the Machines and Users pages while their cards are still rendering:
+STREAM_PAGES = os.environ.get("STREAM_PAGES", "false").replace('"', '').lower() == "true"
 
 # Initiate the Flask application and logging:
 app = Flask(__name__, static_url_path="/static")
@@ -33,6 +33,9 @@ app.logger.info("Headscale-WebUI Version:  "+os.environ["APP_VERSION"]+" / "+os.
 app.logger.info("LOG LEVEL SET TO %s", str(LOG_LEVEL))
 app.logger.info("DEBUG STATE:  %s", str(DEBUG_STATE))
 
+# Renew the API key in the background.  Workers coordinate through a lock file in DATA_DIRECTORY.
+renewal.key_renewal.start()
+
 ########################################################################################
 # Set Authentication type.  Currently "OIDC" and "BASIC"
 ########################################################################################
@@ -130,13 +133,35 @@ else:
             return decorated
     oidc = OpenIDConnect()
 
+# The login decorators above are synchronous.  Async views are turned back into plain
+# functions underneath them; their upstream calls still run on the shared I/O loop.
+def async_view(view_func):
+    @wraps(view_func)
+    def decorated(*args, **kwargs):
+        # Every Headscale call made for this request shares the endpoint's deadline,
+        # and queues behind the limiter as one scope (see limiter.py)
+        with deadline.budget(deadline.budget_for(request.endpoint)), limiter.scope(request.endpoint):
+            return app.ensure_sync(view_func)(*args, **kwargs)
+    return decorated
+
+@app.errorhandler(deadline.DeadlineExceeded)
+def deadline_exceeded(error):
+    app.logger.warning("%s missed its deadline:  %s", request.path, str(error))
+    return "Headscale did not answer in time", 504
+
+@app.errorhandler(breaker.CircuitOpen)
+def circuit_open(error):
+    app.logger.warning("%s failed fast:  %s", request.path, str(error))
+    return "Headscale is not responding", 503
+
 ########################################################################################
 # / pages - User-facing pages
 ########################################################################################
 @app.route('/')
 @app.route('/overview')
 @oidc.require_login
-def overview_page():
+@async_view
+async def overview_page():
     # Some basic sanity checks:
     pass_checks = str(helper.load_checks())
     if pass_checks != "Pass": return redirect(url_for(pass_checks))
@@ -151,8 +176,13 @@ def overview_page():
         OIDC_NAV_DROPDOWN = renderer.oidc_nav_dropdown(user_name, email_address, name)
         OIDC_NAV_MOBILE   = renderer.oidc_nav_mobile(user_name, email_address, name)
 
+    url     = headscale.get_url()
+    api_key = headscale.get_api_key()
+    tailnet = await snapshot.load(url, api_key, "machines", "routes", "users", "preauth_keys", partial=True)
+
     return render_template('overview.html',
-        render_page       = renderer.render_overview(),
+        render_page       = renderer.render_overview(tailnet),
+        STALE_BANNER      = renderer.render_stale_banner(),
         COLOR_NAV         = COLOR_NAV,
         COLOR_BTN         = COLOR_BTN,
         OIDC_NAV_DROPDOWN = OIDC_NAV_DROPDOWN,
@@ -161,7 +191,8 @@ def overview_page():
 
 @app.route('/routes', methods=('GET', 'POST'))
 @oidc.require_login
-def routes_page():
+@async_view
+async def routes_page():
     # Some basic sanity checks:
     pass_checks = str(helper.load_checks())
     if pass_checks != "Pass": return redirect(url_for(pass_checks))
@@ -177,8 +208,13 @@ def routes_page():
         OIDC_NAV_DROPDOWN = renderer.oidc_nav_dropdown(user_name, email_address, name)
         OIDC_NAV_MOBILE   = renderer.oidc_nav_mobile(user_name, email_address, name)
     
+    url     = headscale.get_url()
+    api_key = headscale.get_api_key()
+    tailnet = await snapshot.load(url, api_key, "routes", partial=True)
+
     return render_template('routes.html',
-        render_page       = renderer.render_routes(),
+        render_page       = renderer.render_routes(tailnet),
+        STALE_BANNER      = renderer.render_stale_banner(),
         COLOR_NAV         = COLOR_NAV,
         COLOR_BTN         = COLOR_BTN,
         OIDC_NAV_DROPDOWN = OIDC_NAV_DROPDOWN,
@@ -188,7 +224,8 @@ def routes_page():
 
 @app.route('/machines', methods=('GET', 'POST'))
 @oidc.require_login
-def machines_page():
+@async_view
+async def machines_page():
     # Some basic sanity checks:
     pass_checks = str(helper.load_checks())
     if pass_checks != "Pass": return redirect(url_for(pass_checks))
@@ -204,10 +241,15 @@ def machines_page():
         OIDC_NAV_DROPDOWN = renderer.oidc_nav_dropdown(user_name, email_address, name)
         OIDC_NAV_MOBILE   = renderer.oidc_nav_mobile(user_name, email_address, name)
     
-    cards = renderer.render_machines_cards()
-    return render_template('machines.html',
-        cards             = cards,
+    url     = headscale.get_url()
+    api_key = headscale.get_api_key()
+    tailnet = await snapshot.load(url, api_key, "machines", "routes", partial=True)
+    # Everything is loaded from Headscale by now.  Streaming only spreads out the rendering.
+    render  = stream_template if STREAM_PAGES else render_template
+    return render('machines.html',
+        cards             = renderer.render_machines_cards(tailnet),
         headscale_server  = headscale.get_url(True),
+        STALE_BANNER      = renderer.render_stale_banner(),
         COLOR_NAV         = COLOR_NAV,
         COLOR_BTN         = COLOR_BTN,
         OIDC_NAV_DROPDOWN = OIDC_NAV_DROPDOWN,
@@ -217,7 +259,8 @@ def machines_page():
 
 @app.route('/users', methods=('GET', 'POST'))
 @oidc.require_login
-def users_page():
+@async_view
+async def users_page():
     # Some basic sanity checks:
     pass_checks = str(helper.load_checks())
     if pass_checks != "Pass": return redirect(url_for(pass_checks))
@@ -233,9 +276,13 @@ def users_page():
         OIDC_NAV_DROPDOWN = renderer.oidc_nav_dropdown(user_name, email_address, name)
         OIDC_NAV_MOBILE   = renderer.oidc_nav_mobile(user_name, email_address, name)
 
-    cards = renderer.render_users_cards()
-    return render_template('users.html',
-        cards             = cards,
+    url     = headscale.get_url()
+    api_key = headscale.get_api_key()
+    tailnet = await snapshot.load(url, api_key, "users", "preauth_keys", partial=True)
+    render  = stream_template if STREAM_PAGES else render_template
+    return render('users.html',
+        cards             = renderer.render_users_cards(tailnet),
+        STALE_BANNER      = renderer.render_stale_banner(),
         COLOR_NAV         = COLOR_NAV,
         COLOR_BTN         = COLOR_BTN,
         OIDC_NAV_DROPDOWN = OIDC_NAV_DROPDOWN,
@@ -279,11 +326,12 @@ def settings_page():
 @app.route('/error')
 @oidc.require_login
 def error_page():
-    if helper.access_checks() == "Pass": 
+    # Re-run the checks now so a fixed problem doesn't wait for the next background check
+    if helper.health_state.refresh() != "error_page": 
         return redirect(url_for('overview_page'))
 
     return render_template('error.html', 
-        ERROR_MESSAGE = Markup(helper.access_checks())
+        ERROR_MESSAGE = Markup(helper.health_state.message)
     )
 
 @app.route('/logout')
@@ -301,61 +349,50 @@ def logout_page():
 
 @app.route('/api/test_key', methods=('GET', 'POST'))
 @oidc.require_login
-def test_key_page():
+@async_view
+async def test_key_page():
     api_key    = headscale.get_api_key()
     url        = headscale.get_url()
 
     # Test the API key.  If the test fails, return a failure.  
-    status = headscale.test_api_key(url, api_key)
+    status = await aioheadscale.test_api_key(url, api_key)
     if status != 200: return "Unauthenticated"
 
-    renewed = headscale.renew_api_key(url, api_key)
-    app.logger.warning("The below statement will be TRUE if the key has been renewed, ")
-    app.logger.warning("or DOES NOT need renewal.  False in all other cases")
-    app.logger.warning("Renewed:  "+str(renewed))
-    # The key works, let's renew it if it needs it.  If it does, re-read the api_key from the file:
-    if renewed: api_key = headscale.get_api_key()
-
-    key_info   = headscale.get_api_key_info(url, api_key)
-
-    # Set the current timezone and local time
-    timezone   = pytz.timezone(os.environ["TZ"] if os.environ["TZ"] else "UTC")
-    local_time = timezone.localize(datetime.now())
-
-    # Format the dates for easy readability
-    creation_parse   = parser.parse(key_info['createdAt'])
-    creation_local   = creation_parse.astimezone(timezone)
-    creation_delta   = local_time - creation_local
-    creation_print   = helper.pretty_print_duration(creation_delta)
-    creation_time    = str(creation_local.strftime('%A %m/%d/%Y, %H:%M:%S'))+" "+str(timezone)+" ("+str(creation_print)+")"
+    # Renewal happens in the background (see renewal.py), never on this request.
+    # The key info is shared with concurrent callers, so format a copy of it.
+    key_info   = dict(await aioheadscale.get_api_key_info(url, api_key))
 
-    expiration_parse = parser.parse(key_info['expiration'])
-    expiration_local = expiration_parse.astimezone(timezone)
-    expiration_delta = expiration_local - local_time
-    expiration_print = helper.pretty_print_duration(expiration_delta, "expiry")
-    expiration_time  = str(expiration_local.strftime('%A %m/%d/%Y, %H:%M:%S'))+" "+str(timezone)+" ("+str(expiration_print)+")"
+    # Format the dates for easy readability.  custom.js adds how long ago (or until) each one is.
+    creation_local   = timestamps.to_local(key_info['createdAt'])
+    expiration_local = timestamps.to_local(key_info['expiration'])
 
-    key_info['expiration'] = expiration_time
-    key_info['createdAt']  = creation_time
+    key_info['expiration']       = timestamps.absolute(expiration_local)
+    key_info['expiration_epoch'] = timestamps.epoch(expiration_local)
+    key_info['createdAt']        = timestamps.absolute(creation_local)
+    key_info['createdAt_epoch']  = timestamps.epoch(creation_local)
 
     message = json.dumps(key_info)
     return message
 
 @app.route('/api/save_key', methods=['POST'])
 @oidc.require_login
-def save_key_page():
+@async_view
+async def save_key_page():
     json_response = request.get_json()
     api_key       = json_response['api_key']
     url           = headscale.get_url()
     file_written  = headscale.set_api_key(api_key)
     message       = ''
+    # A new key can change the verdict of the page checks and the next renewal time
+    helper.health_state.invalidate()
+    renewal.key_renewal.reschedule()
 
     if file_written:
         # Re-read the file and get the new API key and test it
         api_key = headscale.get_api_key()
-        test_status = headscale.test_api_key(url, api_key)
+        test_status = await aioheadscale.test_api_key(url, api_key)
         if test_status == 200:
-            key_info   = headscale.get_api_key_info(url, api_key)
+            key_info   = await aioheadscale.get_api_key_info(url, api_key)
             expiration = key_info['expiration']
             message = "Key:  '"+api_key+"', Expiration:  "+expiration
             # If the key was saved successfully, test it:
@@ -368,162 +405,366 @@ def save_key_page():
 ########################################################################################
 @app.route('/api/update_route', methods=['POST'])
 @oidc.require_login
-def update_route_page():
+@async_view
+async def update_route_page():
     json_response = request.get_json()
     route_id      = escape(json_response['route_id'])
     url           = headscale.get_url()
     api_key       = headscale.get_api_key()
     current_state = json_response['current_state']
 
-    return headscale.update_route(url, api_key, route_id, current_state)
+    return await aioheadscale.update_route(url, api_key, route_id, current_state)
+
+@app.route('/api/update_routes', methods=['POST'])
+@oidc.require_login
+@async_view
+async def update_routes_page():
+    json_response = request.get_json()
+    route_ids     = [str(escape(route_id)) for route_id in json_response['route_ids']]
+    enabled       = bool(json_response['enabled'])
+    url           = headscale.get_url()
+    api_key       = headscale.get_api_key()
+
+    return await aioheadscale.update_routes(url, api_key, route_ids, enabled)
 
 @app.route('/api/machine_information', methods=['POST'])
 @oidc.require_login
-def machine_information_page():
+@async_view
+async def machine_information_page():
     json_response = request.get_json()
     machine_id    = escape(json_response['id'])
     url           = headscale.get_url()
     api_key       = headscale.get_api_key()
 
-    return headscale.get_machine_info(url, api_key, machine_id)
+    return await snapshot.load_machine_info(url, api_key, machine_id)
+
+@app.route('/api/machine_routes', methods=['POST'])
+@oidc.require_login
+@async_view
+async def machine_routes_page():
+    json_response = request.get_json()
+    machine_id    = str(escape(json_response['id']))
+    url           = headscale.get_url()
+    api_key       = headscale.get_api_key()
+
+    return await machine_routes(url, api_key, machine_id)
 
 @app.route('/api/delete_machine', methods=['POST'])
 @oidc.require_login
-def delete_machine_page():
+@async_view
+async def delete_machine_page():
     json_response = request.get_json()
     machine_id    = escape(json_response['id'])
     url           = headscale.get_url()
     api_key       = headscale.get_api_key()
 
-    return headscale.delete_machine(url, api_key, machine_id)
+    return await aioheadscale.delete_machine(url, api_key, machine_id)
 
 @app.route('/api/rename_machine', methods=['POST'])
 @oidc.require_login
-def rename_machine_page():
+@async_view
+async def rename_machine_page():
     json_response = request.get_json()
     machine_id    = escape(json_response['id'])
     new_name      = escape(json_response['new_name'])
     url           = headscale.get_url()
     api_key       = headscale.get_api_key()
 
-    return headscale.rename_machine(url, api_key, machine_id, new_name)
+    return await aioheadscale.rename_machine(url, api_key, machine_id, new_name)
 
 @app.route('/api/move_user', methods=['POST'])
 @oidc.require_login
-def move_user_page():
+@async_view
+async def move_user_page():
     json_response = request.get_json()
     machine_id    = escape(json_response['id'])
     new_user      = escape(json_response['new_user'])
     url           = headscale.get_url()
     api_key       = headscale.get_api_key()
 
-    return headscale.move_user(url, api_key, machine_id, new_user)
+    return await aioheadscale.move_user(url, api_key, machine_id, new_user)
 
 @app.route('/api/set_machine_tags', methods=['POST'])
 @oidc.require_login
-def set_machine_tags():
+@async_view
+async def set_machine_tags():
     json_response = request.get_json()
     machine_id    = escape(json_response['id'])
     machine_tags  = json_response['tags_list']
     url           = headscale.get_url()
     api_key       = headscale.get_api_key()
 
-    return headscale.set_machine_tags(url, api_key, machine_id, machine_tags)
+    return await aioheadscale.set_machine_tags(url, api_key, machine_id, machine_tags)
 
 @app.route('/api/register_machine', methods=['POST'])
 @oidc.require_login
-def register_machine():
+@async_view
+async def register_machine():
     json_response = request.get_json()
     machine_key   = escape(json_response['key'])
     user          = escape(json_response['user'])
     url           = headscale.get_url()
     api_key       = headscale.get_api_key()
 
-    return headscale.register_machine(url, api_key, machine_key, user)
+    return await aioheadscale.register_machine(url, api_key, machine_key, user)
+
+########################################################################################
+# Bulk API Endpoints.  Each starts a job; poll /api/bulk/<job_id> for its progress.
+########################################################################################
+def selected_ids(json_response, field):
+    return [str(escape(item)) for item in json_response.get(field, [])]
+
+@app.route('/api/bulk/delete_machines', methods=['POST'])
+@oidc.require_login
+@async_view
+async def bulk_delete_machines_page():
+    json_response = request.get_json()
+    machine_ids   = selected_ids(json_response, 'machines')
+    url           = headscale.get_url()
+    api_key       = headscale.get_api_key()
+
+    return await bulk.delete_machines(url, api_key, machine_ids)
+
+@app.route('/api/bulk/move_machines', methods=['POST'])
+@oidc.require_login
+@async_view
+async def bulk_move_machines_page():
+    json_response = request.get_json()
+    machine_ids   = selected_ids(json_response, 'machines')
+    new_user      = escape(json_response['new_user'])
+    url           = headscale.get_url()
+    api_key       = headscale.get_api_key()
+
+    return await bulk.move_machines(url, api_key, machine_ids, new_user)
+
+@app.route('/api/bulk/tag_machines', methods=['POST'])
+@oidc.require_login
+@async_view
+async def bulk_tag_machines_page():
+    json_response = request.get_json()
+    machine_ids   = selected_ids(json_response, 'machines')
+    tags          = selected_ids(json_response, 'tags')
+    mode          = str(json_response.get('mode', 'add'))
+    url           = headscale.get_url()
+    api_key       = headscale.get_api_key()
+    if mode not in bulk.TAG_MODES:
+        return {"status": "False", "body": {"message": "Unknown tag mode.  Use one of:  "+", ".join(bulk.TAG_MODES)}}, 400
+
+    return await bulk.tag_machines(url, api_key, machine_ids, tags, mode)
+
+@app.route('/api/bulk/update_routes', methods=['POST'])
+@oidc.require_login
+@async_view
+async def bulk_update_routes_page():
+    json_response = request.get_json()
+    enabled       = bool(json_response['enabled'])
+    route_ids     = selected_ids(json_response, 'routes')
+    prefixes      = selected_ids(json_response, 'prefixes')
+    machine_ids   = selected_ids(json_response, 'machines')
+    url           = headscale.get_url()
+    api_key       = headscale.get_api_key()
+
+    return await bulk.set_routes(url, api_key, enabled, route_ids, prefixes, machine_ids)
+
+@app.route('/api/bulk/<job_id>', methods=['GET'])
+@oidc.require_login
+def bulk_job_page(job_id):
+    job = bulk.jobs.get(str(escape(job_id)))
+    if job is None: return {"status": "False", "body": {"message": "Unknown job"}}, 404
+    return {"status": "True", "job": job}
 
 ########################################################################################
 # User API Endpoints
 ########################################################################################
 @app.route('/api/rename_user', methods=['POST'])
 @oidc.require_login
-def rename_user_page():
+@async_view
+async def rename_user_page():
     json_response = request.get_json()
     old_name      = escape(json_response['old_name'])
     new_name      = escape(json_response['new_name'])
     url           = headscale.get_url()
     api_key       = headscale.get_api_key()
 
-    return headscale.rename_user(url, api_key, old_name, new_name)
+    return await aioheadscale.rename_user(url, api_key, old_name, new_name)
 
 @app.route('/api/add_user', methods=['POST'])
 @oidc.require_login
-def add_user():
+@async_view
+async def add_user():
     json_response  = request.get_json()
     user_name      = str(escape(json_response['name']))
     url            = headscale.get_url()
     api_key        = headscale.get_api_key()
     json_string    = '{"name": "'+user_name+'"}'
 
-    return headscale.add_user(url, api_key, json_string)
+    return await aioheadscale.add_user(url, api_key, json_string)
 
 @app.route('/api/delete_user', methods=['POST'])
 @oidc.require_login
-def delete_user():
+@async_view
+async def delete_user():
     json_response  = request.get_json()
     user_name      = str(escape(json_response['name']))
     url            = headscale.get_url()
     api_key        = headscale.get_api_key()
 
-    return headscale.delete_user(url, api_key, user_name)
+    return await aioheadscale.delete_user(url, api_key, user_name)
 
 @app.route('/api/get_users', methods=['POST'])
 @oidc.require_login
-def get_users_page():
+@async_view
+async def get_users_page():
     url           = headscale.get_url()
     api_key       = headscale.get_api_key()
     
-    return headscale.get_users(url, api_key)
+    return (await snapshot.load(url, api_key, "users"))["users"]
 
 ########################################################################################
 # Pre-Auth Key API Endpoints
 ########################################################################################
 @app.route('/api/add_preauth_key', methods=['POST'])
 @oidc.require_login
-def add_preauth_key():
+@async_view
+async def add_preauth_key():
     json_response  = json.dumps(request.get_json())
     url            = headscale.get_url()
     api_key        = headscale.get_api_key()
 
-    return headscale.add_preauth_key(url, api_key, json_response)
+    return await aioheadscale.add_preauth_key(url, api_key, json_response)
 
 @app.route('/api/expire_preauth_key', methods=['POST'])
 @oidc.require_login
-def expire_preauth_key():
+@async_view
+async def expire_preauth_key():
     json_response  = json.dumps(request.get_json())
     url            = headscale.get_url()
     api_key        = headscale.get_api_key()
 
-    return headscale.expire_preauth_key(url, api_key, json_response)
+    return await aioheadscale.expire_preauth_key(url, api_key, json_response)
 
 @app.route('/api/build_preauthkey_table', methods=['POST'])
 @oidc.require_login
-def build_preauth_key_table():
+@async_view
+async def build_preauth_key_table():
     json_response  = request.get_json()
     user_name      = str(escape(json_response['name']))
+    url            = headscale.get_url()
+    api_key        = headscale.get_api_key()
 
-    return renderer.build_preauth_key_table(user_name)
+    return await preauth_key_table(url, api_key, user_name)
 
 ########################################################################################
 # Route API Endpoints
 ########################################################################################
 @app.route('/api/get_routes', methods=['POST'])
 @oidc.require_login
-def get_route_info():
+@async_view
+async def get_route_info():
+    url     = headscale.get_url()
+    api_key = headscale.get_api_key()
+
+    return (await snapshot.load(url, api_key, "routes"))["routes"]
+
+########################################################################################
+# Batch API Endpoint
+########################################################################################
+BATCH_MAX_OPS = 20
+
+async def load_resource(url, api_key, resource):
+    return (await snapshot.load(url, api_key, resource))[resource]
+
+async def machine_routes(url, api_key, machine_id):
+    routes = await load_resource(url, api_key, "routes")
+    return renderer.render_machine_routes(machine_id, topology.get_topology(routes))[0]
+
+async def preauth_key_table(url, api_key, user_name):
+    preauth_keys = await aioheadscale.get_preauth_keys(url, api_key, user_name)
+    return str(renderer.build_preauth_key_table(user_name, preauth_keys))
+
+# Operations /api/batch can run, by endpoint name.  Each takes (url, api_key, args),
+# where args is the JSON body the matching /api endpoint takes.
+BATCH_OPS = {
+    "machine_information"   : lambda url, api_key, args: snapshot.load_machine_info(url, api_key, escape(args['id'])),
+    "machine_routes"        : lambda url, api_key, args: machine_routes(url, api_key, str(escape(args['id']))),
+    "get_users"             : lambda url, api_key, args: load_resource(url, api_key, "users"),
+    "get_routes"            : lambda url, api_key, args: load_resource(url, api_key, "routes"),
+    "build_preauthkey_table": lambda url, api_key, args: preauth_key_table(url, api_key, str(escape(args['name']))),
+    "update_route"          : lambda url, api_key, args: aioheadscale.update_route(url, api_key, escape(args['route_id']), args['current_state']),
+    "rename_machine"        : lambda url, api_key, args: aioheadscale.rename_machine(url, api_key, escape(args['id']), escape(args['new_name'])),
+    "move_user"             : lambda url, api_key, args: aioheadscale.move_user(url, api_key, escape(args['id']), escape(args['new_user'])),
+    "set_machine_tags"      : lambda url, api_key, args: aioheadscale.set_machine_tags(url, api_key, escape(args['id']), args['tags_list']),
+    "delete_machine"        : lambda url, api_key, args: aioheadscale.delete_machine(url, api_key, escape(args['id'])),
+    "rename_user"           : lambda url, api_key, args: aioheadscale.rename_user(url, api_key, escape(args['old_name']), escape(args['new_name'])),
+    "expire_preauth_key"    : lambda url, api_key, args: aioheadscale.expire_preauth_key(url, api_key, json.dumps(args)),
+}
+# Ops that change Headscale.  A batch holding any of them runs one op at a time, in order.
+BATCH_MUTATIONS = ("update_route", "rename_machine", "move_user", "set_machine_tags", "delete_machine", "rename_user", "expire_preauth_key")
+
+@app.route('/api/batch', methods=['POST'])
+@oidc.require_login
+@async_view
+async def batch_page():
+    """ Runs several API calls in one round-trip.  The body is a list of {"op", "args"}.
+        Reads run concurrently.  If any op changes Headscale, every op runs in turn, in
+        list order.  Returns {"results": [...]}, in order, each {"ok": true, "result"} or
+        {"ok": false, "error"}. """
+    entries = request.get_json()
     url     = headscale.get_url()
     api_key = headscale.get_api_key()
+    if not isinstance(entries, list) or len(entries) > BATCH_MAX_OPS:
+        return {"status": "False", "body": {"message": "Send a list of at most "+str(BATCH_MAX_OPS)+" operations"}}, 400
+
+    async def run(entry):
+        if not isinstance(entry, dict): return {"ok": False, "error": "Each op must be an object"}
+        operation = BATCH_OPS.get(entry.get("op"))
+        if operation is None: return {"ok": False, "error": "Unknown op"}
+        args = entry.get("args", {})
+        if not isinstance(args, dict): return {"ok": False, "error": "args must be an object"}
+        try: return {"ok": True, "result": await operation(url, api_key, args)}
+        except Exception as error: # pylint: disable=broad-except
+            app.logger.error("Batch op %s failed:  %s", str(entry.get("op")), str(error))
+            return {"ok": False, "error": str(error)}
+
+    if any(isinstance(entry, dict) and entry.get("op") in BATCH_MUTATIONS for entry in entries):
+        return {"results": [await run(entry) for entry in entries]}
+    return {"results": await aioheadscale.gather(*(run(entry) for entry in entries))}
 
-    return headscale.get_routes(url, api_key)
+########################################################################################
+# Statistics
+########################################################################################
+@app.route('/api/stats', methods=['GET'])
+@oidc.require_login
+def stats_page():
+    """ Queue depth and admission counters for the Headscale limiter, plus breaker, single-flight and card cache state """
+    return {
+        "limiter"      : limiter.limiter.stats(),
+        "single_flight": {
+            "joined"      : headscale.client.in_flight.joined,
+            "joined_async": aioheadscale.client.in_flight.joined,
+        },
+        "breaker"      : {
+            "state"      : breaker.breaker.state,
+            "failures"   : breaker.breaker.failures,
+            "stale_since": breaker.breaker.stale_since(),
+        },
+        "machine_cards": fragments.machine_cards.stats(),
+    }
 
+########################################################################################
+# Live update stream
+########################################################################################
+@app.route('/api/events', methods=['GET'])
+@oidc.require_login
+def events_page():
+    # EventSource sends the id of the last diff it received when it reconnects
+    last_event_id = request.headers.get("Last-Event-ID", "")
+    last_event_id = int(last_event_id) if last_event_id.isdigit() else None
+
+    return Response(events.broker.stream(last_event_id), mimetype="text/event-stream", headers={
+        "Cache-Control"    : "no-cache",
+        "X-Accel-Buffering": "no",  # Don't let a reverse proxy buffer the stream
+    })
 
 ########################################################################################
 # Main thread
@@ -0,0 +1,233 @@
+# pylint: disable=wrong-import-order
+
+import headscale, aioheadscale, deadline, topology, logs, os, time, fcntl, threading
+from cache   import cache, cache_bypass
+from store   import shared_store
+from breaker import CircuitOpen
+
+DATA_DIRECTORY = os.environ["DATA_DIRECTORY"].replace('"', '') if os.environ["DATA_DIRECTORY"] else "/data"
+logger = logs.get_logger(__name__)
+
+##################################################################
+# Snapshot mode:  serve pages from a periodically polled tailnet model
+##################################################################
+SNAPSHOT_MODE     = os.environ.get("SNAPSHOT_MODE", "false").replace('"', '').lower() == "true"
+SNAPSHOT_INTERVAL = float(os.environ.get("SNAPSHOT_INTERVAL", "15"))
+
+RESOURCES         = ("machines", "routes", "users", "preauth_keys")
+POLLER_LOCK_FILE  = os.path.join(DATA_DIRECTORY, "poller.lock")
+SYNC_INTERVAL     = 1  # Seconds between checks of the shared store when several workers share it
+IDLE_GRACE        = 30 # Seconds the poller keeps running (without SNAPSHOT_MODE) after the last event stream closes
+
+class Snapshot():
+    """ One consistent, read-only view of machines, routes, users and PreAuth keys """
+    __slots__ = ("version", "taken_at", "generations", "machines", "routes", "users", "preauth_keys", "topology", "machines_by_id")
+
+    def __init__(self, version, taken_at, generations, machines, routes, users, preauth_keys):
+        values = {
+            "version"       : version,
+            "taken_at"      : taken_at,
+            "generations"   : generations,   # Cache generation of each resource when the poll started
+            "machines"      : machines,      # /api/v1/machine response
+            "routes"        : routes,        # /api/v1/routes response
+            "users"         : users,         # /api/v1/user response
+            "preauth_keys"  : preauth_keys,  # {user_name: /api/v1/preauthkey response}
+            "topology"      : topology.get_topology(routes),
+            "machines_by_id": {str(machine["id"]): machine for machine in machines["machines"]},
+        }
+        for name, value in values.items(): object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Snapshots are immutable.  Publish a new one instead.")
+
+    def is_stale(self, resources):
+        """ True if any of resources was changed (by any worker) after this snapshot was taken """
+        return any(cache.generation(resource) != self.generations.get(resource) for resource in resources)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in ("version", "taken_at", "generations", "machines", "routes", "users", "preauth_keys")}
+
+class SnapshotPoller():
+    """ Polls Headscale on an interval and publishes a new Snapshot after every poll.
+        With a shared store, one worker (the holder of POLLER_LOCK_FILE) polls and
+        the others publish the snapshots it stores. """
+    def __init__(self, interval, shared=None):
+        self.interval    = interval
+        self.shared      = shared
+        self.current     = None
+        self.version     = 0
+        self.listeners   = []   # Called with (old_snapshot, new_snapshot) after every publish
+        self.leader_file = None
+        self.subscribers = 0    # Open /api/events streams.  Without SNAPSHOT_MODE, the poller only runs for them.
+        self.idle_since  = None
+        self.thread      = None
+        self.lock        = threading.Lock()
+        self.wake        = threading.Event()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None: return
+            self.thread = threading.Thread(target=self.run, name="snapshot-poller", daemon=True)
+            self.thread.start()
+
+    def subscribe(self):
+        """ Keeps the poller running for an event stream.  Pair with unsubscribe(). """
+        with self.lock:
+            self.subscribers += 1
+            self.idle_since   = None
+        self.start()
+
+    def unsubscribe(self):
+        with self.lock:
+            self.subscribers -= 1
+            if self.subscribers == 0: self.idle_since = time.time()
+
+    def stop_if_idle(self):
+        """ Ends the thread once nothing has needed it for IDLE_GRACE.  Returns True if it did. """
+        with self.lock:
+            if SNAPSHOT_MODE or self.subscribers > 0 or self.idle_since is None: return False
+            if time.time() - self.idle_since < IDLE_GRACE: return False
+            self.thread     = None
+            self.idle_since = None
+            # The next stream starts from a fresh snapshot, not a diff against one taken long ago
+            self.current    = None
+        if self.leader_file is not None:
+            # Lets a worker with open streams take over polling
+            self.leader_file.close()
+            self.leader_file = None
+        logger.info("No live update streams are open.  Stopping the snapshot poller.")
+        return True
+
+    def refresh_soon(self, resources):
+        """ Polls again right away, ie after a mutation """
+        self.wake.set()
+
+    def on_publish(self, listener):
+        self.listeners.append(listener)
+
+    def is_leader(self):
+        """ True if this worker polls Headscale.  Leadership passes on when the holder exits. """
+        if self.shared is None or self.leader_file is not None: return True
+        lock_file = open(POLLER_LOCK_FILE, "a")
+        try: fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        logger.info("This worker now polls Headscale for snapshots")
+        self.leader_file = lock_file  # Held open (and locked) for the life of the process
+        return True
+
+    def run(self):
+        # The poller always reads from Headscale, then leaves the fresh results in the cache
+        cache_bypass.set(True)
+        last_poll = 0
+        while True:
+            self.wake.clear()
+            if self.stop_if_idle(): return
+            try:
+                if not self.is_leader(): self.follow()
+                elif self.poll_due(last_poll):
+                    last_poll = time.time()
+                    self.poll()
+            except Exception as error: # pylint: disable=broad-except
+                # Keep serving the last good snapshot
+                logger.error("Snapshot poll failed:  %s", str(error))
+            self.wake.wait(self.interval if self.shared is None else SYNC_INTERVAL)
+
+    def poll_due(self, last_poll):
+        if self.shared is None or self.current is None: return True
+        return time.time() - last_poll >= self.interval or self.current.is_stale(RESOURCES)
+
+    def poll(self):
+        taken_at    = time.time()
+        generations = {resource: cache.generation(resource) for resource in RESOURCES}
+        url         = headscale.get_url()
+        api_key     = headscale.get_api_key()
+        if not api_key or api_key == "NULL": return
+
+        # Runs on the I/O loop in a copy of this thread's context, so the cache is still bypassed
+        tailnet  = aioheadscale.run(fetch(url, api_key, "machines", "routes", "users"))
+        machines, routes, users = tailnet["machines"], tailnet["routes"], tailnet["users"]
+        # A failed request returns an error body instead of the expected list
+        if "machines" not in machines or "routes" not in routes or "users" not in users:
+            logger.error("Snapshot poll got an error response from Headscale.  Keeping the last snapshot.")
+            return
+        preauth_keys = aioheadscale.run(aioheadscale.get_all_preauth_keys(url, api_key, users))
+
+        # Continue the numbering of a previous leader
+        stored  = self.shared.get("snapshot", "current") if self.shared else None
+        version = max(self.version, stored[0]["version"] if stored else 0) + 1
+        new_snapshot = Snapshot(version, taken_at, generations, machines, routes, users, preauth_keys)
+        if self.shared: self.shared.put("snapshot", "current", new_snapshot.to_dict())
+        self.publish(new_snapshot)
+
+    def follow(self):
+        """ Publishes the leader's latest snapshot if it is newer than ours """
+        stored = self.shared.get("snapshot", "current")
+        if stored is None: return
+        values = stored[0]
+        if self.current is not None and values["version"] <= self.current.version: return
+        self.publish(Snapshot(**values))
+
+    def publish(self, new_snapshot):
+        with self.lock:
+            old_snapshot = self.current
+            self.current = new_snapshot
+            self.version = new_snapshot.version
+        logger.info("Published snapshot version %i", new_snapshot.version)
+        for listener in self.listeners: listener(old_snapshot, new_snapshot)
+
+poller = SnapshotPoller(SNAPSHOT_INTERVAL, shared_store)
+# Mutations made through the UI show up on the next page load, not after the next interval
+cache.on_invalidate(poller.refresh_soon)
+
+def current(*resources):
+    """ Returns the latest snapshot, or None when pages should read from Headscale directly.
+        That is also the case while any of resources has changed since the snapshot was taken. """
+    if not SNAPSHOT_MODE: return None
+    poller.start()
+    with poller.lock: tailnet = poller.current
+    if tailnet is None or tailnet.is_stale(resources): return None
+    return tailnet
+
+##################################################################
+# Asynchronous loading for async views
+##################################################################
+LOADERS = {
+    "machines": aioheadscale.get_machines,
+    "routes"  : aioheadscale.get_routes,
+    "users"   : aioheadscale.get_users,
+}
+
+async def fetch(url, api_key, *resources, partial=False):
+    """ Fetches resources from Headscale concurrently.  Returns {resource: response}.
+        "preauth_keys" is {user_name: response} and needs "users" first.
+        With partial, resources that miss the request's deadline (or that can't be loaded
+        while the circuit is open) are left out for the page to defer.  Otherwise the error is raised. """
+    names = [resource for resource in resources if resource in LOADERS]
+    if "preauth_keys" in resources and "users" not in names: names.append("users")
+    responses = await aioheadscale.gather(*(LOADERS[name](url, api_key) for name in names), return_exceptions=True)
+    loaded    = {}
+    for name, response in zip(names, responses):
+        if isinstance(response, (deadline.DeadlineExceeded, CircuitOpen)) and partial:
+            logger.warning("Loading %s failed:  %s", name, str(response))
+        elif isinstance(response, BaseException): raise response
+        else: loaded[name] = response
+    if "preauth_keys" in resources and "users" in loaded:
+        try: loaded["preauth_keys"] = await aioheadscale.get_all_preauth_keys(url, api_key, loaded["users"])
+        except (deadline.DeadlineExceeded, CircuitOpen) as error:
+            if not partial: raise
+            logger.warning("Loading preauth_keys failed:  %s", str(error))
+    return loaded
+
+async def load(url, api_key, *resources, partial=False):
+    """ fetch(), served from the current snapshot when there is one """
+    tailnet = current(*resources)
+    if tailnet: return {resource: getattr(tailnet, resource) for resource in resources}
+    return await fetch(url, api_key, *resources, partial=partial)
+
+async def load_machine_info(url, api_key, machine_id):
+    tailnet = current("machines")
+    if tailnet and str(machine_id) in tailnet.machines_by_id:
+        return {"machine": tailnet.machines_by_id[str(machine_id)]}
+    return await aioheadscale.get_machine_info(url, api_key, machine_id)
@@ -203,16 +203,17 @@ function test_key() {
                             </tr>
                             <tr>
                                 <td><b>Expiration Date</b></td>
-                                <td>${json['expiration']}</td>
+                                <td>${json['expiration']} <span class='relative-time' data-epoch='${json['expiration_epoch']}' data-type='expiry'></span></td>
                             </tr>
                             <tr>
                                 <td><b>Creation Date</b></td>
-                                <td>${json['createdAt']}</td>
+                                <td>${json['createdAt']} <span class='relative-time' data-epoch='${json['createdAt_epoch']}' data-type=''></span></td>
                             </tr>
                         </tbody>
                     </table>
                     `
                 document.getElementById('test_modal_results').innerHTML = html
+                refresh_relative_times()
             }
         }
     })
@@ -384,71 +385,84 @@ function load_modal_expire_preauth_key(user_name, key) {
     modal_confirm.setAttribute('onclick', 'expire_preauth_key("' + user_name + '", "' + key + '")')
 }
 
+// Runs several API calls in one request (see /api/batch).  success gets the results, in order.
+function api_batch(ops, success) {
+    $.ajax({
+        type: "POST",
+        url: "api/batch",
+        data: JSON.stringify(ops),
+        contentType: "application/json",
+        success: function (response) {
+            for (let i = 0; i < response.results.length; i++) {
+                if (!response.results[i].ok) {
+                    load_modal_generic("error", "Error loading data", escapeHTML(response.results[i].error))
+                    return
+                }
+            }
+            success(response.results)
+        }
+    })
+}
+
 function load_modal_move_machine(machine_id) {
     document.getElementById('modal_content').innerHTML = loading()
     document.getElementById('modal_title').innerHTML = "Loading..."
     document.getElementById('modal_confirm').className = "green btn-flat white-text"
     document.getElementById('modal_confirm').innerText = "Move"
 
-    var data = { "id": machine_id }
-    $.ajax({
-        type: "POST",
-        url: "api/machine_information",
-        data: JSON.stringify(data),
-        contentType: "application/json",
-        success: function (headscale) {
-            $.ajax({
-                type: "POST",
-                url: "api/get_users",
-                success: function (response) {
-                    modal = document.getElementById('card_modal');
-                    modal_title = document.getElementById('modal_title');
-                    modal_body = document.getElementById('modal_content');
-                    modal_confirm = document.getElementById('modal_confirm');
-
-                    modal_title.innerHTML = "Move machine '" + headscale.machine.givenName + "'?"
-
-                    select_html = `<h6>Select a User</h6><select id='move-select'>`
-                    for (let i = 0; i < response.users.length; i++) {
-                        var name = response["users"][i]["name"]
-                        select_html = select_html + `<option value="${name}">${name}</option>`
-                    }
-                    select_html = select_html + `</select>`
+    // Machine information and the user list in one round-trip
+    var ops = [
+        { "op": "machine_information", "args": { "id": machine_id } },
+        { "op": "get_users" }
+    ]
+    api_batch(ops, function (results) {
+        var headscale = results[0].result
+        var response = results[1].result
+        modal = document.getElementById('card_modal');
+        modal_title = document.getElementById('modal_title');
+        modal_body = document.getElementById('modal_content');
+        modal_confirm = document.getElementById('modal_confirm');
+
+        modal_title.innerHTML = "Move machine '" + headscale.machine.givenName + "'?"
+
+        select_html = `<h6>Select a User</h6><select id='move-select'>`
+        for (let i = 0; i < response.users.length; i++) {
+            var name = response["users"][i]["name"]
+            select_html = select_html + `<option value="${name}">${name}</option>`
+        }
+        select_html = select_html + `</select>`
 
-                    body_html = `
-                    <ul class="collection">
-                        <li class="collection-item avatar">
-                            <i class="material-icons circle">language</i>
-                            <span class="title">Information</span>
-                            <p>You are about to move ${headscale.machine.givenName} to a new user.</p>
-                        </li>
-                    </ul>`
-                    body_html = body_html + select_html
-                    body_html = body_html + `<h6>Machine Information</h6>
-                    <table class="highlight">
-                        <tbody>
-                            <tr>
-                                <td><b>Machine ID</b></td>
-                                <td>${headscale.machine.id}</td>
-                            </tr>
-                            <tr>
-                                <td><b>Hostname</b></td>
-                                <td>${headscale.machine.name}</td>
-                            </tr>
-                            <tr>
-                                <td><b>User</b></td>
-                                <td>${headscale.machine.user.name}</td>
-                            </tr>
-                        </tbody>
-                    </table>
-                    `
+        body_html = `
+        <ul class="collection">
+            <li class="collection-item avatar">
+                <i class="material-icons circle">language</i>
+                <span class="title">Information</span>
+                <p>You are about to move ${headscale.machine.givenName} to a new user.</p>
+            </li>
+        </ul>`
+        body_html = body_html + select_html
+        body_html = body_html + `<h6>Machine Information</h6>
+        <table class="highlight">
+            <tbody>
+                <tr>
+                    <td><b>Machine ID</b></td>
+                    <td>${headscale.machine.id}</td>
+                </tr>
+                <tr>
+                    <td><b>Hostname</b></td>
+                    <td>${headscale.machine.name}</td>
+                </tr>
+                <tr>
+                    <td><b>User</b></td>
+                    <td>${headscale.machine.user.name}</td>
+                </tr>
+            </tbody>
+        </table>
+        `
 
-                    modal_body.innerHTML = body_html
-                    M.FormSelect.init(document.querySelectorAll('select'))
-                }
-            })
-            modal_confirm.setAttribute('onclick', 'move_machine(' + machine_id + ')')
-        }
+        modal_body.innerHTML = body_html
+        M.FormSelect.init(document.querySelectorAll('select'))
+        modal_confirm.setAttribute('onclick', 'move_machine(' + machine_id + ')')
     })
 }
 
@@ -762,8 +776,8 @@ function delete_machine(machine_id) {
 }
 
 function toggle_exit(route1, route2, exit_id, current_state, page) {
-    var data1 = { "route_id": route1, "current_state": current_state }
-    var data2 = { "route_id": route2, "current_state": current_state }
+    // Both exit routes (IPv4 and IPv6) change together, or not at all
+    var data = { "route_ids": [route1, route2], "enabled": current_state != "True" }
     var element = document.getElementById(exit_id);
 
     var disabledClass = ""
@@ -782,39 +796,50 @@ function toggle_exit(route1, route2, exit_id, current_state, page) {
     var enabledTooltip = "Click to disable"
     var disableState = "False"
     var enableState = "True"
-    var action_taken = "unchanged.";
 
     $.ajax({
         type: "POST",
-        url: "api/update_route",
-        data: JSON.stringify(data1),
+        url: "api/update_routes",
+        data: JSON.stringify(data),
         contentType: "application/json",
         success: function (response) {
-            $.ajax({
-                type: "POST",
-                url: "api/update_route",
-                data: JSON.stringify(data2),
-                contentType: "application/json",
-                success: function (response) {
-                    // Response is a JSON object containing the Headscale API response of /v1/api/machines/<id>/route
-                    if (element.className == disabledClass) {
-                        element.className = enabledClass
-                        action_taken = "enabled."
-                        element.setAttribute('data-tooltip', enabledTooltip)
-                        element.setAttribute('onclick', 'toggle_exit(' + route1 + ', ' + route2 + ', "' + exit_id + '", "' + enableState + '", "' + page + '")')
-                    } else if (element.className == enabledClass) {
-                        element.className = disabledClass
-                        action_taken = "disabled."
-                        element.setAttribute('data-tooltip', disabledTooltip)
-                        element.setAttribute('onclick', 'toggle_exit(' + route1 + ', ' + route2 + ', "' + exit_id + '", "' + disableState + '", "' + page + '")')
-                    }
-                    M.toast({ html: 'Exit Route ' + action_taken });
-                }
-            })
+            // Response is the new state of both routes
+            var exit_enabled = false
+            for (let i = 0; i < response.routes.length; i++) {
+                if (response.routes[i].enabled) { exit_enabled = true }
+            }
+            if (exit_enabled) {
+                element.className = enabledClass
+                element.setAttribute('data-tooltip', enabledTooltip)
+                element.setAttribute('onclick', 'toggle_exit(' + route1 + ', ' + route2 + ', "' + exit_id + '", "' + enableState + '", "' + page + '")')
+            } else {
+                element.className = disabledClass
+                element.setAttribute('data-tooltip', disabledTooltip)
+                element.setAttribute('onclick', 'toggle_exit(' + route1 + ', ' + route2 + ', "' + exit_id + '", "' + disableState + '", "' + page + '")')
+            }
+            if (response.status == "True") {
+                M.toast({ html: 'Exit Route ' + (exit_enabled ? "enabled." : "disabled.") });
+            } else {
+                load_modal_generic("error", "Error updating the exit routes", update_routes_error(response))
+            }
         }
     })
 }
 
+// Describes a failed api/update_routes call from the state Headscale reports afterwards
+function update_routes_error(response) {
+    var message = "Headscale rejected routes " + escapeHTML(response.failed.join(", ")) + "."
+    if (response.not_reverted.length > 0) {
+        message += "  Routes " + escapeHTML(response.not_reverted.join(", ")) + " were changed and could not be put back."
+    }
+    message += "<br><br>The routes are now:<ul>"
+    for (let i = 0; i < response.routes.length; i++) {
+        var route = response.routes[i]
+        message += "<li>" + escapeHTML(route.id + " (" + route.prefix + "):  " + (route.enabled ? "enabled" : "disabled")) + "</li>"
+    }
+    return message + "</ul>"
+}
+
 function toggle_route(route_id, current_state, page) {
     var data = { "route_id": route_id, "current_state": current_state }
     var element = document.getElementById(route_id);
@@ -875,11 +900,7 @@ function get_routes() {
 }
 
 function toggle_failover_route_routespage(routeid, current_state, prefix, route_id_list) {
-    // First, toggle the route:
-    // toggle_route(route_id, current_state, page)
-    var data = { "route_id": routeid, "current_state": current_state }
-    console.log("Data:  " + JSON.stringify(data))
-    console.log("Passed in:  " + routeid + ", " + current_state + ", " + prefix + ", " + route_id_list)
+    var data = { "route_ids": [routeid], "enabled": current_state != "True" }
     var element = document.getElementById(routeid);
 
     var disabledClass = "material-icons red-text text-lighten-2 tooltipped";
@@ -891,72 +912,35 @@ function toggle_failover_route_routespage(routeid, current_state, prefix, route_
     var enabledTooltip = "Click to disable"
     var disableState = "False"
     var enableState = "True"
-    var action_taken = "unchanged."
 
     $.ajax({
         type: "POST",
-        url: "api/update_route",
+        url: "api/update_routes",
         data: JSON.stringify(data),
         contentType: "application/json",
         success: function (response) {
-            console.log("Success:  Route ID:  " + routeid)
-            console.log("Success: route_id_list:  " + route_id_list)
-            if (element.className == disabledClass) {
-                element.className = enabledClass
-                action_taken = "enabled."
-                element.setAttribute('data-tooltip', enabledTooltip)
-                element.setAttribute('onclick', 'toggle_failover_route_routespage(' + routeid + ', "' + enableState + '", "' + prefix + '", [' + route_id_list + '])')
-            } else if (element.className == enabledClass) {
-                element.className = disabledClass
-                action_taken = "disabled."
-                element.setAttribute('data-tooltip', disabledTooltip)
-                element.setAttribute('onclick', 'toggle_failover_route_routespage(' + routeid + ', "' + disableState + '", "' + prefix + '", [' + route_id_list + '])')
-            }
-            M.toast({ html: 'Route ' + action_taken });
-
-            // Get all route info:
-            console.log("Getting info for prefix " + prefix)
-            var routes = get_routes()
+            // Response has the state of every route for this prefix, including the new primary, even if the update failed
             var failover_enabled = false
-
-            // Get the primary and enabled displays for the prefix:
-            for (let i = 0; i < route_id_list.length; i++) {
-                console.log("route_id_list[" + i + "]: " + route_id_list[i])
-                var route_id = route_id_list[i]
-                var route_index = route_id - 1
-                console.log("Looking for route " + route_id + " at index " + route_index)
-                console.log("isPrimary:  " + routes["routes"][route_index]["isPrimary"])
-
-                // Set the Primary class:
-                var primary_element = document.getElementById(route_id + "-primary")
-                var primary_status = routes["routes"][route_index]["isPrimary"]
-                var enabled_status = routes["routes"][route_index]["enabled"]
-
-                console.log("enabled_status:  " + enabled_status)
-
-                if (enabled_status == true) {
-                    failover_enabled = true
-                }
-
-                console.log("Setting primary class '" + route_id + "-primary':  " + primary_status)
-                if (primary_status == true) {
-                    console.log("Detected this route is primary.  Setting the class")
-                    primary_element.className = enabledClass
-                } else if (primary_status == false) {
-                    console.log("Detected this route is NOT primary.  Setting the class")
-                    primary_element.className = disabledClass
+            for (let i = 0; i < response.routes.length; i++) {
+                var route = response.routes[i]
+                if (route.enabled) { failover_enabled = true }
+
+                var primary_element = document.getElementById(route.id + "-primary")
+                if (primary_element) { primary_element.className = route.isPrimary ? enabledClass : disabledClass }
+
+                if (route.id == routeid) {
+                    var state = route.enabled ? enableState : disableState
+                    element.className = route.enabled ? enabledClass : disabledClass
+                    element.setAttribute('data-tooltip', route.enabled ? enabledTooltip : disabledTooltip)
+                    element.setAttribute('onclick', 'toggle_failover_route_routespage(' + routeid + ', "' + state + '", "' + prefix + '", [' + route_id_list + '])')
+                    if (response.status == "True") { M.toast({ html: 'Route ' + (route.enabled ? "enabled." : "disabled.") }); }
                 }
             }
+            if (response.status != "True") { load_modal_generic("error", "Error updating the route", update_routes_error(response)) }
 
             // if any route is enabled, set the prefix enable icon to enabled:
             var failover_element = document.getElementById(prefix)
-            console.log("Failover enabled:  " + failover_enabled)
-            if (failover_enabled == true) {
-                failover_element.className = failover_enabledClass
-            }
-            else if (failover_enabled == false) {
-                failover_element.className = failover_disabledClass
-            }
+            failover_element.className = failover_enabled ? failover_enabledClass : failover_disabledClass
         }
     })
 }
@@ -1213,3 +1197,382 @@ function copy_preauth_key(key) {
     navigator.clipboard.writeText(key);
     M.toast({ html: 'PreAuth key copied to clipboard.' })
 }
+
+//-----------------------------------------------------------
+// Live Updates on the Machines and Routes pages
+//-----------------------------------------------------------
+// Listens on api/events and patches only the elements a change affects
+function start_event_stream(page) {
+    if (!window.EventSource) { return }
+    var source = new EventSource("api/events")
+
+    source.addEventListener("diff", function (event) {
+        var diff = JSON.parse(event.data)
+        for (let i = 0; i < diff.changes.length; i++) {
+            apply_change(diff.changes[i], page)
+        }
+    })
+    // Sent when this page fell too far behind to be patched
+    source.addEventListener("reload", function (event) {
+        M.toast({ html: 'Some updates were missed.  Reload the page to see the latest state.' })
+    })
+}
+
+function apply_change(change, page) {
+    switch (change.type) {
+        case "machine_status": patch_machine_status(change); break
+        case "machine_tags": patch_machine_tags(change); break
+        case "machine_added":
+            if (page == "machines") { M.toast({ html: "Machine '" + escapeHTML(change.name) + "' was added.  Reload the page to see it." }) }
+            break
+        case "machine_removed":
+            var collapsible = document.getElementById(change.id + '-main-collapsible')
+            if (collapsible) { collapsible.className = "collapsible popout hide" }
+            break
+        case "route": patch_route(change, page); break
+        case "exit": patch_exit(change, page); break
+    }
+}
+
+// Sets the current_state argument of a toggle's onclick handler
+function set_onclick_state(element, state) {
+    var onclick = element.getAttribute('onclick')
+    if (onclick) { element.setAttribute('onclick', onclick.replace(/(["'])(True|False)\1/, '"' + state + '"')) }
+}
+
+function patch_machine_status(change) {
+    var element = document.getElementById(change.id + '-status')
+    if (!element) { return }
+    element.setAttribute('data-epoch', change.last_seen)
+    refresh_last_seen_status(element, Date.now() / 1000)
+}
+
+function patch_machine_tags(change) {
+    var element = document.getElementById(change.id + '-tags')
+    if (!element) { return }
+    var instance = M.Chips.getInstance(element)
+    if (instance) { instance.destroy() }
+    element.innerHTML = ""
+
+    var chips = []
+    for (let i = 0; i < change.tags.length; i++) { chips.push({ tag: change.tags[i] }) }
+    M.Chips.init(element, {
+        data: chips,
+        onChipDelete() { delete_chip(change.id, this.chipsData) },
+        onChipAdd() { add_chip(change.id, this.chipsData) }
+    })
+}
+
+function patch_route(change, page) {
+    var state = change.enabled ? "True" : "False"
+    var tooltip = change.enabled ? "Click to disable" : "Click to enable"
+    var color = change.enabled ? "green" : "red"
+
+    // The Routes page shows failover routes twice, so the ID isn't unique there
+    var elements = document.querySelectorAll("[id='" + change.id + "']")
+    for (let i = 0; i < elements.length; i++) {
+        var element = elements[i]
+        if (page == "machines") {
+            var button_color = change.enabled ? change.color : "red"
+            element.className = "waves-effect waves-light btn-small " + button_color + " lighten-2 tooltipped"
+            element.setAttribute('data-tooltip', change.failover ? tooltip + " (Failover Pair)" : tooltip)
+        } else {
+            element.className = "material-icons " + color + "-text text-lighten-2 tooltipped"
+            element.setAttribute('data-tooltip', tooltip)
+        }
+        set_onclick_state(element, state)
+    }
+
+    if (page == "routes" && change.failover) {
+        var primary_element = document.getElementById(change.id + "-primary")
+        if (primary_element) {
+            primary_element.className = "material-icons " + (change.primary ? "green" : "red") + "-text text-lighten-2"
+        }
+        var failover_element = document.querySelector("[id='" + change.prefix + "']")
+        if (failover_element) {
+            failover_element.className = "material-icons small left " + (change.prefix_enabled ? "green" : "red") + "-text text-lighten-2"
+        }
+    }
+}
+
+function patch_exit(change, page) {
+    var element = document.getElementById(change.machine_id + '-exit')
+    if (!element) { return }
+    var color = change.enabled ? "green" : "red"
+
+    if (page == "machines") {
+        element.className = "waves-effect waves-light btn-small " + color + " lighten-2 tooltipped"
+    } else {
+        element.className = "material-icons " + color + "-text text-lighten-2 tooltipped"
+    }
+    element.setAttribute('data-tooltip', change.enabled ? "Click to disable" : "Click to enable")
+    set_onclick_state(element, change.enabled ? "True" : "False")
+}
+
+//-----------------------------------------------------------
+// Deferred Sections
+//-----------------------------------------------------------
+// Sections that missed the page's deadline are rendered as placeholders.
+// Each one names the endpoint that renders it; fetch and swap them in.
+document.addEventListener('DOMContentLoaded', function () {
+    var sections = document.querySelectorAll('.deferred-section')
+    for (var i = 0; i < sections.length; i++) { fill_deferred_section(sections[i]) }
+});
+
+function fill_deferred_section(element) {
+    $.ajax({
+        type: "POST",
+        url: element.getAttribute('data-url'),
+        data: element.getAttribute('data-payload'),
+        contentType: "application/json",
+        success: function (response) {
+            var parent = element.parentNode
+            element.outerHTML = response
+            M.Tooltip.init(parent.querySelectorAll('.tooltipped'))
+            refresh_relative_times()
+        },
+        error: function () {
+            element.querySelector('.deferred-status').innerHTML = "Headscale did not answer in time.  Reload the page to try again."
+        }
+    })
+}
+
+//-----------------------------------------------------------
+// Bulk Actions on the Machines and Routes pages
+//-----------------------------------------------------------
+function bulk_selected() {
+    var selected = []
+    var boxes = document.querySelectorAll('.bulk-select:checked')
+    for (var i = 0; i < boxes.length; i++) { selected.push(boxes[i].value) }
+    return selected
+}
+
+function bulk_selection_changed() {
+    var count = bulk_selected().length
+    document.getElementById('bulk_count').innerHTML = count
+    document.getElementById('bulk_actions').className = count > 0 ? "row" : "row hide"
+}
+
+function bulk_clear() {
+    var boxes = document.querySelectorAll('.bulk-select:checked')
+    for (var i = 0; i < boxes.length; i++) { boxes[i].checked = false }
+    bulk_selection_changed()
+}
+
+function load_modal_bulk(title, body_html, confirm_text, confirm_color, onclick) {
+    document.getElementById('modal_title').innerHTML = title
+    document.getElementById('modal_content').innerHTML = body_html
+    document.getElementById('modal_confirm').className = confirm_color + " btn-flat white-text"
+    document.getElementById('modal_confirm').innerText = confirm_text
+    document.getElementById('modal_confirm').setAttribute('onclick', onclick)
+}
+
+function bulk_information(message) {
+    return `
+    <ul class="collection">
+        <li class="collection-item avatar">
+            <i class="material-icons circle">playlist_add_check</i>
+            <span class="title">Information</span>
+            <p>${message}</p>
+        </li>
+    </ul>`
+}
+
+function load_modal_bulk_delete() {
+    var count = bulk_selected().length
+    load_modal_bulk("Delete " + count + " machines?", bulk_information("You are about to delete " + count + " machines from Headscale.  This cannot be undone."), "Delete", "red", "start_bulk_job('api/bulk/delete_machines', { 'machines': bulk_selected() })")
+}
+
+function load_modal_bulk_move() {
+    var count = bulk_selected().length
+    document.getElementById('modal_content').innerHTML = loading()
+    document.getElementById('modal_title').innerHTML = "Loading..."
+    $.ajax({
+        type: "POST",
+        url: "api/get_users",
+        success: function (response) {
+            var select_html = `<h6>Select a User</h6><select id='bulk-move-select'>`
+            for (let i = 0; i < response.users.length; i++) {
+                var name = response["users"][i]["name"]
+                select_html = select_html + `<option value="${name}">${name}</option>`
+            }
+            select_html = select_html + `</select>`
+            load_modal_bulk("Move " + count + " machines?", bulk_information("You are about to move " + count + " machines to a new user.") + select_html, "Move", "green", "start_bulk_job('api/bulk/move_machines', { 'machines': bulk_selected(), 'new_user': document.getElementById('bulk-move-select').value })")
+            M.FormSelect.init(document.querySelectorAll('select'))
+        }
+    })
+}
+
+function load_modal_bulk_tag() {
+    var count = bulk_selected().length
+    var body_html = bulk_information("Tags are separated by commas.  Adding or removing tags keeps each machine's other tags.") + `
+    <h6>Tags</h6>
+    <input id='bulk-tags' type='text' placeholder='server, prod'>
+    <h6>Action</h6>
+    <select id='bulk-tag-mode'>
+        <option value="add">Add these tags</option>
+        <option value="remove">Remove these tags</option>
+        <option value="set">Replace all tags with these</option>
+    </select>`
+    load_modal_bulk("Tag " + count + " machines", body_html, "Apply", "green", "bulk_tag()")
+    M.FormSelect.init(document.querySelectorAll('select'))
+}
+
+function bulk_tag() {
+    var tags = document.getElementById('bulk-tags').value.toLowerCase().split(',')
+    var cleaned = []
+    for (var i = 0; i < tags.length; i++) {
+        var tag = tags[i].trim().replace(/\s+/g, '-')
+        if (tag) { cleaned.push(tag) }
+    }
+    start_bulk_job('api/bulk/tag_machines', { 'machines': bulk_selected(), 'tags': cleaned, 'mode': document.getElementById('bulk-tag-mode').value })
+}
+
+// field is "machines" (every route of the selected machines) or "routes"
+function load_modal_bulk_routes(enabled, field) {
+    var count = bulk_selected().length
+    var action = enabled ? "Enable" : "Disable"
+    var target = field == "machines" ? "all routes of " + count + " machines" : count + " routes"
+    load_modal_bulk(action + " " + target + "?", bulk_information("You are about to " + action.toLowerCase() + " " + target + "."), action, enabled ? "green" : "red", "start_bulk_job('api/bulk/update_routes', { 'enabled': " + enabled + ", '" + field + "': bulk_selected() })")
+}
+
+function start_bulk_job(url, data) {
+    document.getElementById('modal_content').innerHTML = loading()
+    document.getElementById('modal_confirm').className = "hide"
+    $.ajax({
+        type: "POST",
+        url: url,
+        data: JSON.stringify(data),
+        contentType: "application/json",
+        success: function (response) {
+            if (response.status == "True") {
+                show_bulk_progress(response.job)
+            } else {
+                M.Modal.getInstance(document.getElementById('card_modal')).close()
+                load_modal_generic("error", "Bulk action failed", escapeHTML(response.body.message))
+            }
+        }
+    })
+}
+
+function show_bulk_progress(job) {
+    var percent = job.total > 0 ? Math.round(100 * job.done / job.total) : 100
+    var body_html = `
+    <p>${job.done} of ${job.total} done, ${job.failed} failed.</p>
+    <div class="progress"><div class="determinate" style="width: ${percent}%"></div></div>`
+
+    if (job.status != "finished") {
+        document.getElementById('modal_content').innerHTML = body_html
+        setTimeout(function () {
+            $.ajax({
+                type: "GET",
+                url: "api/bulk/" + job.id,
+                success: function (response) { show_bulk_progress(response.job) }
+            })
+        }, 1000)
+        return
+    }
+
+    // Finished:  list the failures, then reload to show the changes
+    var failures = ""
+    for (var i = 0; i < job.results.length; i++) {
+        var result = job.results[i]
+        if (!result.ok) { failures += `<tr><td>${escapeHTML(result.label)}</td><td>${escapeHTML(result.detail)}</td></tr>` }
+    }
+    if (failures) { body_html += `<h6>Failures</h6><table class="highlight"><tbody>${failures}</tbody></table>` }
+    document.getElementById('modal_content').innerHTML = body_html
+    document.getElementById('modal_title').innerHTML = "Done"
+    document.getElementById('modal_confirm').className = "green btn-flat white-text"
+    document.getElementById('modal_confirm').innerText = "Reload"
+    document.getElementById('modal_confirm').setAttribute('onclick', 'location.reload()')
+    M.toast({ html: (job.total - job.failed) + " of " + job.total + " changed." })
+}
+
+//-----------------------------------------------------------
+// Relative Times
+//-----------------------------------------------------------
+// The server renders absolute times only, so its HTML doesn't change with the clock.
+// Elements carrying a data-epoch (seconds) get their relative time and color here.
+document.addEventListener('DOMContentLoaded', function () {
+    refresh_relative_times()
+    setInterval(refresh_relative_times, 15000)
+});
+
+// Splits a duration in seconds the way Python's timedelta does:  days are floored,
+// seconds are always positive.  Keeps the output identical to helper.pretty_print_duration.
+function duration_parts(duration) {
+    var days = Math.floor(duration / 86400)
+    var seconds = Math.floor(duration - days * 86400)
+    return { days: days, hours: days * 24 + Math.floor(seconds / 3600), mins: Math.floor((seconds % 3600) / 60), secs: seconds % 60 }
+}
+
+function pretty_print_duration(duration, delta_type) {
+    var d = duration_parts(duration)
+    if (delta_type == "expiry") {
+        if (d.days > 730) { return "in greater than two years" }
+        if (d.days > 365) { return "in greater than a year" }
+        if (d.days > 0) { return d.days > 1 ? "in " + d.days + " days" : "in " + d.days + " day" }
+        if (d.hours > 0) { return d.hours > 1 ? "in " + d.hours + " hours" : "in " + d.hours + " hour" }
+        if (d.mins > 0) { return d.mins > 1 ? "in " + d.mins + " minutes" : "in " + d.mins + " minute" }
+        return d.secs >= 1 || d.secs == 0 ? "in " + d.secs + " seconds" : "in " + d.secs + " second"
+    }
+    if (d.days > 730) { return "over two years ago" }
+    if (d.days > 365) { return "over a year ago" }
+    if (d.days > 0) { return d.days > 1 ? d.days + " days ago" : d.days + " day ago" }
+    if (d.hours > 0) { return d.hours > 1 ? d.hours + " hours ago" : d.hours + " hour ago" }
+    if (d.mins > 0) { return d.mins > 1 ? d.mins + " minutes ago" : d.mins + " minute ago" }
+    return d.secs >= 1 || d.secs == 0 ? d.secs + " seconds ago" : d.secs + " second ago"
+}
+
+// Same thresholds as helper.text_color_duration
+function text_color_duration(duration) {
+    var d = duration_parts(duration)
+    if (d.days > 30) { return "grey-text" }
+    if (d.days > 14) { return "red-text text-darken-2" }
+    if (d.days > 1) { return "deep-orange-text text-lighten-1" }
+    if (d.hours > 12) { return "orange-text" }
+    if (d.hours > 1) { return "orange-text text-lighten-2" }
+    if (d.hours == 1) { return "yellow-text" }
+    if (d.mins > 15) { return "yellow-text text-lighten-2" }
+    if (d.mins > 5) { return "green-text text-lighten-3" }
+    if (d.secs > 30) { return "green-text text-lighten-2" }
+    return "green-text"
+}
+
+function refresh_last_seen_status(element, now) {
+    var since = now - element.getAttribute('data-epoch')
+    element.className = "material-icons left tooltipped last-seen-status " + text_color_duration(since)
+    element.setAttribute('data-tooltip', 'Last Seen:  ' + pretty_print_duration(since))
+}
+
+function refresh_relative_times() {
+    var now = Date.now() / 1000
+
+    // "(5 minutes ago)" or, for expirations, "(in 3 days)"
+    var times = document.querySelectorAll('.relative-time[data-epoch]')
+    for (var i = 0; i < times.length; i++) {
+        var epoch = times[i].getAttribute('data-epoch')
+        var expiry = times[i].getAttribute('data-type') == "expiry"
+        times[i].textContent = "(" + pretty_print_duration(expiry ? epoch - now : now - epoch, expiry ? "expiry" : "") + ")"
+    }
+
+    var statuses = document.querySelectorAll('.last-seen-status[data-epoch]')
+    for (var i = 0; i < statuses.length; i++) { refresh_last_seen_status(statuses[i], now) }
+
+    // Machines expiring in the next two weeks
+    var badges = document.querySelectorAll('.expiring-badge[data-epoch]')
+    for (var i = 0; i < badges.length; i++) {
+        var days = Math.floor((badges[i].getAttribute('data-epoch') - now) / 86400)
+        badges[i].classList.toggle('hide', !(days > 0 && days < 14))
+    }
+
+    // PreAuth keys whose expiration has passed since the page was rendered
+    var keys = document.querySelectorAll('tr[data-expiration]')
+    for (var i = 0; i < keys.length; i++) {
+        if (keys[i].getAttribute('data-expiration') > now) { continue }
+        keys[i].removeAttribute('data-expiration')
+        keys[i].className = "expired-row"
+        var usable = keys[i].querySelectorAll('.key-usable')
+        for (var j = 0; j < usable.length; j++) { usable[j].remove() }
+    }
+}
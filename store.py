@@ -0,0 +1,105 @@
+# pylint: disable=wrong-import-order
+
+import logs, os, json, time, sqlite3, threading
+
+DATA_DIRECTORY = os.environ["DATA_DIRECTORY"].replace('"', '') if os.environ["DATA_DIRECTORY"] else "/data"
+logger = logs.get_logger(__name__)
+
+##################################################################
+# State shared by every gunicorn worker, in SQLite (WAL mode)
+##################################################################
+SHARED_STORE      = os.environ.get("SHARED_STORE", "true").replace('"', '').lower() != "false"
+SHARED_STORE_PATH = os.path.join(DATA_DIRECTORY, "shared.db")
+SHARED_STORE_MAX_AGE = 24 * 60 * 60   # Rows older than this are pruned, in seconds
+PRUNE_EVERY          = 100            # Writes between prunes
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS entries (
+        namespace  TEXT    NOT NULL,
+        key        TEXT    NOT NULL,
+        value      TEXT    NOT NULL,
+        stored_at  REAL    NOT NULL,
+        generation INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (namespace, key)
+    );
+    CREATE TABLE IF NOT EXISTS generations (
+        resource   TEXT    PRIMARY KEY,
+        generation INTEGER NOT NULL
+    );
+"""
+
+class SharedStore():
+    """ Namespaced JSON values plus per-resource generation counters.
+        Every thread gets its own connection; WAL lets readers run alongside a writer. """
+    def __init__(self, path):
+        self.path   = path
+        self.local  = threading.local()
+        self.writes = 0
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            self.local.connection = connection
+        return connection
+
+    def get(self, namespace, key):
+        """ Returns (value, stored_at, generation), or None """
+        row = self.connection().execute(
+            "SELECT value, stored_at, generation FROM entries WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        if row is None: return None
+        return json.loads(row[0]), row[1], row[2]
+
+    def put(self, namespace, key, value, generation=0, stored_at=None):
+        stored_at = time.time() if stored_at is None else stored_at
+        self.connection().execute(
+            "INSERT OR REPLACE INTO entries (namespace, key, value, stored_at, generation) VALUES (?, ?, ?, ?, ?)",
+            (namespace, key, json.dumps(value), stored_at, generation)
+        )
+        self.writes += 1
+        if self.writes % PRUNE_EVERY == 0: self.prune()
+
+    def delete(self, namespace, key=None):
+        """ Deletes one key, or the whole namespace """
+        if key is None: self.connection().execute("DELETE FROM entries WHERE namespace = ?", (namespace,))
+        else:           self.connection().execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def generation(self, resource):
+        row = self.connection().execute("SELECT generation FROM generations WHERE resource = ?", (resource,)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, resource):
+        """ Increments and returns the generation of resource, atomically across processes """
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "INSERT INTO generations (resource, generation) VALUES (?, 1) "
+                "ON CONFLICT(resource) DO UPDATE SET generation = generation + 1", (resource,)
+            )
+            generation = connection.execute("SELECT generation FROM generations WHERE resource = ?", (resource,)).fetchone()[0]
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return generation
+
+    def prune(self):
+        self.connection().execute("DELETE FROM entries WHERE stored_at < ?", (time.time() - SHARED_STORE_MAX_AGE,))
+
+def open_store():
+    """ Returns the shared store, or None when it is disabled or DATA_DIRECTORY isn't writable """
+    if not SHARED_STORE: return None
+    shared = SharedStore(SHARED_STORE_PATH)
+    try: shared.connection()
+    except sqlite3.Error as error:
+        logger.error("Failed to open the shared store at %s:  %s.  Workers will not share state.", SHARED_STORE_PATH, str(error))
+        return None
+    logger.info("Using the shared store at %s", SHARED_STORE_PATH)
+    return shared
+
+shared_store = open_store()
@@ -0,0 +1,48 @@
+# pylint: disable=wrong-import-order
+
+import os, asyncio, types, tempfile, httpx, pytest
+from cryptography.fernet import Fernet
+
+##################################################################
+# Environment the modules read when they are imported
+##################################################################
+TEST_ENVIRONMENT = {
+    "LOG_LEVEL"     : "WARNING",
+    "DATA_DIRECTORY": tempfile.mkdtemp(prefix="headscale-webui-tests-"),
+    "TZ"            : "America/New_York",
+    "KEY"           : Fernet.generate_key().decode(),
+    "HS_SERVER"     : "http://headscale.test",
+    "COLOR"         : "blue-grey",
+    "AUTH_TYPE"     : "",
+    "DOMAIN_NAME"   : "http://localhost",
+    "SCRIPT_NAME"   : "/",
+    "APP_VERSION"   : "test",
+    "GIT_BRANCH"    : "test",
+    "GIT_COMMIT"    : "0000000",
+    "BUILD_DATE"    : "",
+    "HS_VERSION"    : "",
+}
+for name, value in TEST_ENVIRONMENT.items(): os.environ.setdefault(name, value)
+
+##################################################################
+# A fake Headscale API for the asynchronous client
+##################################################################
+@pytest.fixture
+def fake_headscale():
+    """ Answers aioheadscale's requests from handlers registered in routes[(method, path)].
+        A handler takes the httpx.Request and returns (or, if async, resolves to) an httpx.Response. """
+    import aioheadscale
+    from cache import cache
+    fake = types.SimpleNamespace(routes={}, calls=[])
+
+    async def handle(request):
+        fake.calls.append((request.method, request.url.path))
+        response = fake.routes[(request.method, request.url.path)](request)
+        return await response if asyncio.iscoroutine(response) else response
+
+    # Nothing cached by an earlier test should answer for this one
+    cache.invalidate("machines", "routes", "users", "preauth_keys")
+    session = aioheadscale.client.session
+    aioheadscale.client.session = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+    yield fake
+    aioheadscale.client.session = session
@@ -0,0 +1,27 @@
+""" Headscale API records for the tests, with only the fields the UI reads """
+
+def machine(machine_id, user_id="1", user_name="albert", last_seen="2023-03-01T12:00:00Z", online=True, tags=(), expiry="0001-01-01T00:00:00Z"):
+    return {
+        "id"                  : str(machine_id),
+        "name"                : "machine-"+str(machine_id),
+        "givenName"           : "machine-"+str(machine_id),
+        "user"                : {"id": str(user_id), "name": user_name, "createdAt": "2023-01-01T00:00:00Z"},
+        "ipAddresses"         : ["100.64.0."+str(machine_id)],
+        "forcedTags"          : ["tag:"+tag for tag in tags],
+        "preAuthKey"          : None,
+        "online"              : online,
+        "lastSeen"            : last_seen,
+        "lastSuccessfulUpdate": last_seen,
+        "createdAt"           : "2023-01-01T00:00:00Z",
+        "expiry"              : expiry,
+    }
+
+def route(route_id, machine_id, prefix, enabled=True, primary=False, advertised=True):
+    return {
+        "id"        : str(route_id),
+        "machine"   : {"id": str(machine_id), "givenName": "machine-"+str(machine_id)},
+        "prefix"    : prefix,
+        "advertised": advertised,
+        "enabled"   : enabled,
+        "isPrimary" : primary,
+    }
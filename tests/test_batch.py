@@ -0,0 +1,63 @@
+import asyncio, httpx
+import headscale, server
+
+API_KEY = "0123456789abcdefghij"
+
+def answer_after(finished, name, seconds, body):
+    """ A handler that records name in finished once its answer is ready """
+    async def handler(request):
+        await asyncio.sleep(seconds)
+        finished.append(name)
+        return httpx.Response(200, json=body)
+    return handler
+
+def batch(body):
+    headscale.set_api_key(API_KEY)
+    with server.app.test_client() as client: return client.post("/api/batch", json=body)
+
+def test_malformed_batches_are_rejected():
+    assert batch({"op": "get_users"}).status_code == 400
+    assert batch([{"op": "get_users"}] * (server.BATCH_MAX_OPS + 1)).status_code == 400
+
+def test_malformed_entries_fail_alone(fake_headscale):
+    fake_headscale.routes[("GET", "/api/v1/user")] = answer_after([], "users", 0, {"users": []})
+    response = batch([
+        "get_users",
+        {"op": "get_users", "args": ["not", "an", "object"]},
+        {"op": "drop_database"},
+        {"args": {}},
+        {"op": "get_users"},
+    ])
+
+    assert response.status_code == 200
+    assert response.get_json()["results"] == [
+        {"ok": False, "error": "Each op must be an object"},
+        {"ok": False, "error": "args must be an object"},
+        {"ok": False, "error": "Unknown op"},
+        {"ok": False, "error": "Unknown op"},
+        {"ok": True,  "result": {"users": []}},
+    ]
+
+def test_reads_run_concurrently_and_answer_in_order(fake_headscale):
+    finished = []
+    fake_headscale.routes[("GET", "/api/v1/routes")] = answer_after(finished, "routes", 0.2, {"routes": []})
+    fake_headscale.routes[("GET", "/api/v1/user")]   = answer_after(finished, "users",  0,   {"users": []})
+    response = batch([{"op": "get_routes"}, {"op": "get_users"}])
+
+    assert finished == ["users", "routes"]
+    assert [result["ok"] for result in response.get_json()["results"]] == [True, True]
+
+def test_a_batch_with_mutations_runs_in_list_order(fake_headscale):
+    finished = []
+    fake_headscale.routes[("POST", "/api/v1/machine/1/rename/first")]  = answer_after(finished, "rename 1", 0.2, {"machine": {"id": "1"}})
+    fake_headscale.routes[("GET",  "/api/v1/user")]                    = answer_after(finished, "users",    0.1, {"users": []})
+    fake_headscale.routes[("POST", "/api/v1/machine/2/rename/second")] = answer_after(finished, "rename 2", 0,   {"machine": {"id": "2"}})
+    response = batch([
+        {"op": "rename_machine", "args": {"id": "1", "new_name": "first"}},
+        {"op": "get_users"},
+        {"op": "rename_machine", "args": {"id": "2", "new_name": "second"}},
+    ])
+
+    assert finished == ["rename 1", "users", "rename 2"]
+    results = response.get_json()["results"]
+    assert [result["result"]["status"] for result in (results[0], results[2])] == ["True", "True"]
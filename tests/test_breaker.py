@@ -0,0 +1,92 @@
+import pytest
+import breaker as breaker_module
+from breaker import CircuitBreaker, CircuitOpen
+from store   import SharedStore
+
+@pytest.fixture
+def now(monkeypatch):
+    """ A monotonic clock the test moves by hand """
+    clock = [100.0]
+    monkeypatch.setattr(breaker_module.time, "monotonic", lambda: clock[0])
+    return clock
+
+def fail(circuit, times):
+    for _ in range(times):
+        circuit.before_request()
+        circuit.record_failure()
+
+def test_the_circuit_opens_after_threshold_consecutive_failures(now):
+    circuit = CircuitBreaker(3, 10)
+    fail(circuit, 2)
+    circuit.before_request()
+    circuit.record_response(200)  # A success resets the count
+    fail(circuit, 2)
+    assert circuit.state == "closed" and not circuit.degraded()
+
+    fail(circuit, 1)
+    assert circuit.state == "open" and circuit.degraded()
+    with pytest.raises(CircuitOpen): circuit.before_request()
+
+def test_only_outage_statuses_count_as_failures(now):
+    circuit = CircuitBreaker(1, 10)
+    for status_code in (400, 401, 404, 500):
+        circuit.before_request()
+        circuit.record_response(status_code)
+    assert circuit.state == "closed"
+
+    circuit.before_request()
+    circuit.record_response(503)
+    assert circuit.state == "open"
+
+def test_one_probe_after_the_reset_timeout_closes_the_circuit(now):
+    circuit = CircuitBreaker(1, 10)
+    fail(circuit, 1)
+    now[0] += 10
+
+    circuit.before_request()
+    assert circuit.state == "half_open"
+    # Everybody else keeps failing fast until the probe answers
+    with pytest.raises(CircuitOpen): circuit.before_request()
+    circuit.record_response(200)
+
+    assert circuit.state == "closed" and not circuit.degraded()
+    circuit.before_request()
+
+def test_a_failed_probe_opens_the_circuit_again(now):
+    circuit = CircuitBreaker(3, 10)
+    fail(circuit, 3)
+    now[0] += 10
+    circuit.before_request()
+    circuit.record_response(504)
+
+    assert circuit.state == "open"
+    now[0] += 5
+    with pytest.raises(CircuitOpen): circuit.before_request()
+
+def test_a_probe_without_a_verdict_lets_the_next_caller_probe(now):
+    circuit = CircuitBreaker(1, 10)
+    fail(circuit, 1)
+    now[0] += 10
+    circuit.before_request()
+    circuit.release()  # ie, the probe's deadline passed
+
+    circuit.before_request()
+    assert circuit.state == "half_open"
+
+def test_other_workers_see_the_open_circuit(now, tmp_path):
+    path   = str(tmp_path / "shared.sqlite3")
+    first  = CircuitBreaker(1, 10, SharedStore(path))
+    second = CircuitBreaker(1, 10, SharedStore(path))
+    first.before_request()
+    first.record_success()
+    fail(first, 1)
+    first.writer.submit(lambda: None).result()  # Wait for the published state
+
+    assert second.degraded()
+    assert second.stale_since() == first.last_success
+
+    now[0] += 10
+    first.before_request()
+    first.record_success()
+    first.writer.submit(lambda: None).result()
+    assert not second.degraded()
@@ -0,0 +1,48 @@
+import json, time, httpx, pytest
+import bulk, headscale, server
+from samples import machine
+
+API_KEY = "0123456789abcdefghij"
+
+@pytest.fixture
+def tagged_machines(fake_headscale):
+    """ Two tagged machines.  Returns the tags each one is set to, by machine ID. """
+    machines = {"machines": [machine(1, tags=("web", "prod")), machine(2, tags=("db",))]}
+    fake_headscale.routes[("GET", "/api/v1/machine")] = lambda request: httpx.Response(200, json=machines)
+    new_tags = {}
+    def set_tags(machine_id):
+        def handler(request):
+            new_tags[machine_id] = json.loads(request.content)["tags"]
+            return httpx.Response(200, json={"machine": {"id": machine_id}})
+        return handler
+    for machine_id in ("1", "2"): fake_headscale.routes[("POST", "/api/v1/machine/"+machine_id+"/tags")] = set_tags(machine_id)
+    return new_tags
+
+def tag_machines(mode, tags):
+    headscale.set_api_key(API_KEY)
+    with server.app.test_client() as client:
+        response = client.post("/api/bulk/tag_machines", json={"machines": ["1", "2"], "tags": tags, "mode": mode})
+    if response.status_code != 200: return response
+    job_id   = response.get_json()["job"]["id"]
+    finished = time.monotonic() + 5
+    while bulk.jobs.get(job_id)["status"] != "finished" and time.monotonic() < finished: time.sleep(0.01)
+    return response
+
+@pytest.mark.parametrize("mode, expected", [
+    ("add",    {"1": ["tag:web", "tag:prod", "tag:db"], "2": ["tag:db", "tag:web"]}),
+    ("remove", {"1": ["tag:prod"],                      "2": []}),
+    ("set",    {"1": ["tag:web", "tag:db"],             "2": ["tag:web", "tag:db"]}),
+])
+def test_tag_modes(tagged_machines, mode, expected):
+    response = tag_machines(mode, ["web", "db"])
+
+    assert response.status_code == 200
+    assert bulk.jobs.get(response.get_json()["job"]["id"])["failed"] == 0
+    assert tagged_machines == expected
+
+def test_unknown_tag_modes_change_nothing(tagged_machines, fake_headscale):
+    response = tag_machines("replace", ["web"])
+
+    assert response.status_code == 400
+    assert tagged_machines == {}
+    assert fake_headscale.calls == []
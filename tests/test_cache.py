@@ -0,0 +1,88 @@
+import time, pytest
+import cache as cache_module
+from cache import TTLCache
+from store import SharedStore
+
+def counting_loader(values):
+    """ Returns a loader that hands out values in order and records how often it ran """
+    def loader():
+        loader.calls += 1
+        return values[loader.calls - 1], True
+    loader.calls = 0
+    return loader
+
+@pytest.fixture
+def now(monkeypatch):
+    """ A clock the test moves by hand """
+    clock = [1000.0]
+    monkeypatch.setattr(cache_module.time, "time", lambda: clock[0])
+    return clock
+
+def test_entries_are_served_until_their_ttl_passes(now):
+    ttl_cache = TTLCache({"users": 10}, 0, 16, 1 << 20)
+    loader    = counting_loader(["first", "second"])
+
+    assert ttl_cache.fetch("users", "key", loader) == "first"
+    now[0] += 9
+    assert ttl_cache.fetch("users", "key", loader) == "first"
+    now[0] += 2
+    assert ttl_cache.fetch("users", "key", loader) == "second"
+    assert loader.calls == 2
+
+def test_stale_entries_are_served_while_one_reader_revalidates(now, monkeypatch):
+    ttl_cache   = TTLCache({"users": 10}, 30, 16, 1 << 20)
+    revalidated = []
+    monkeypatch.setattr(ttl_cache, "_revalidate", lambda cache_key, loader, generation: revalidated.append(cache_key))
+    loader = counting_loader(["first", "second"])
+
+    ttl_cache.fetch("users", "key", loader)
+    now[0] += 15
+    assert ttl_cache.fetch("users", "key", loader) == "first"
+    assert ttl_cache.fetch("users", "key", loader) == "first"
+    assert revalidated == [("users", "key")] and loader.calls == 1
+
+    # Past the stale window the caller waits for Headscale again
+    now[0] += 30
+    assert ttl_cache.fetch("users", "key", loader) == "second"
+
+def test_invalidation_evicts_only_the_given_resources(now):
+    ttl_cache = TTLCache({"users": 10, "machines": 10}, 0, 16, 1 << 20)
+    ttl_cache.fetch("users",    "key", counting_loader(["users"]))
+    ttl_cache.fetch("machines", "key", counting_loader(["machines"]))
+    invalidated = []
+    ttl_cache.on_invalidate(invalidated.append)
+
+    ttl_cache.invalidate("users")
+
+    assert invalidated == [("users",)]
+    assert ttl_cache.lookup("users",    "key")[0] == "miss"
+    assert ttl_cache.lookup("machines", "key")[0] == "hit"
+
+def test_loads_started_before_an_invalidation_are_not_stored(now):
+    ttl_cache = TTLCache({"users": 10}, 0, 16, 1 << 20)
+    def loader():
+        ttl_cache.invalidate("users")  # A mutation lands while the GET is in flight
+        return "old", True
+
+    assert ttl_cache.fetch("users", "key", loader) == "old"
+    assert ttl_cache.lookup("users", "key")[0] == "miss"
+
+def test_entries_are_evicted_least_recently_used_first(now):
+    ttl_cache = TTLCache({"users": 10}, 0, 2, 1 << 20)
+    for key in ("a", "b"): ttl_cache.fetch("users", key, counting_loader([key]))
+    ttl_cache.lookup("users", "a")
+    ttl_cache.fetch("users", "c", counting_loader(["c"]))
+
+    assert [key for _, key in ttl_cache.entries] == ["a", "c"]
+
+def test_invalidation_in_one_worker_is_seen_by_another(now, tmp_path):
+    path   = str(tmp_path / "shared.sqlite3")
+    first  = TTLCache({"users": 10}, 0, 16, 1 << 20, SharedStore(path))
+    second = TTLCache({"users": 10}, 0, 16, 1 << 20, SharedStore(path))
+
+    first.fetch("users", "key", counting_loader(["value"]))
+    # The second worker reads the first worker's entry instead of calling Headscale
+    assert second.fetch("users", "key", counting_loader([])) == "value"
+
+    first.invalidate("users")
+    assert second.lookup("users", "key")[0] == "miss"
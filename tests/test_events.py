@@ -0,0 +1,30 @@
+import events, snapshot, timestamps
+from datetime import datetime
+from samples import machine, route
+
+def take(version, machines, routes=()):
+    return snapshot.Snapshot(version, 0, {}, {"machines": list(machines)}, {"routes": list(routes)}, {"users": []}, {})
+
+def test_only_machines_whose_online_state_changed_are_sent(monkeypatch):
+    old = take(1, [machine(1, last_seen="2023-03-01T12:00:00Z"), machine(2, last_seen="2023-03-01T12:00:00Z")])
+    new = take(2, [machine(1, last_seen="2023-03-01T12:00:05Z"), machine(2, last_seen="2023-03-01T12:00:05Z", online=False)])
+    parsed = []
+    monkeypatch.setattr(timestamps, "parse", lambda value: parsed.append(value) or datetime.fromisoformat(value))
+
+    assert events.diff_snapshots(old, new) == [{
+        "type": "machine_status", "id": "2", "online": False,
+        "last_seen": timestamps.epoch(datetime.fromisoformat("2023-03-01T12:00:05Z")),
+    }]
+    # lastSeen is only read for the machine that is sent
+    assert parsed == ["2023-03-01T12:00:05Z"]
+
+def test_tags_routes_and_exit_nodes_are_diffed():
+    old = take(1, [machine(1), machine(2)], [route(1, 1, "10.0.0.0/24"), route(2, 2, "0.0.0.0/0", enabled=False), route(3, 2, "::/0", enabled=False)])
+    new = take(2, [machine(1, tags=("web",)), machine(3)], [route(1, 1, "10.0.0.0/24", enabled=False), route(2, 2, "0.0.0.0/0"), route(3, 2, "::/0")])
+    changes = events.diff_snapshots(old, new)
+
+    assert {"type": "machine_tags", "id": "1", "tags": ["web"]} in changes
+    assert {"type": "machine_added", "id": "3", "name": "machine-3"} in changes
+    assert {"type": "machine_removed", "id": "2"} in changes
+    assert {"type": "exit", "machine_id": "2", "enabled": True} in changes
+    assert [change["id"] for change in changes if change["type"] == "route"] == ["1", "2", "3"]
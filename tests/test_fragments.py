@@ -0,0 +1,39 @@
+import fragments, renderer, timestamps
+from samples import machine
+
+def render_card(record):
+    tailnet = {"machines": {"machines": [record]}, "routes": {"routes": []}}
+    with renderer.app.app_context(): return renderer.render_machine_card(record, renderer.machines_page_context(tailnet))
+
+def test_cards_are_reused_when_only_last_seen_moves():
+    first  = render_card(machine(901, last_seen="2023-03-01T12:00:00Z"))
+    misses = fragments.machine_cards.misses
+    second = render_card(machine(901, last_seen="2023-03-01T12:00:07Z"))
+
+    assert fragments.machine_cards.misses == misses
+    seen = timestamps.to_local("2023-03-01T12:00:07Z")
+    assert timestamps.absolute(seen) in second
+    assert "data-epoch='"+str(timestamps.epoch(seen))+"'" in second
+    assert first != second
+    assert renderer.LAST_SEEN_TIME not in second and renderer.LAST_SEEN_EPOCH not in second and renderer.LAST_UPDATE_TIME not in second
+
+def test_other_changes_render_a_new_card():
+    render_card(machine(902))
+    misses = fragments.machine_cards.misses
+    card   = render_card(machine(902, tags=("servers",)))
+    assert fragments.machine_cards.misses == misses + 1
+    assert "tag:servers" in card
+
+def test_fragment_keys_ignore_dict_order():
+    assert fragments.fragment_key({"a": 1, "b": 2}) == fragments.fragment_key({"b": 2, "a": 1})
+    assert fragments.fragment_key({"a": 1}) != fragments.fragment_key({"a": 2})
+
+def test_machines_page_cards_render_in_order_and_count_in_this_process():
+    machines = [machine(machine_id) for machine_id in range(910, 950)]
+    tailnet  = {"machines": {"machines": machines}, "routes": {"routes": []}}
+    lookups  = fragments.machine_cards.hits + fragments.machine_cards.misses
+    with renderer.app.test_request_context(): cards = [str(card) for card in renderer.render_machines_cards(tailnet)]
+
+    assert fragments.machine_cards.hits + fragments.machine_cards.misses == lookups + len(machines)
+    assert cards[0] == "<ul class='collapsible expandable'>" and cards[-1] == "</ul>"
+    assert [card.split("-main-collapsible")[0].split("id=\"")[-1] for card in cards[1:-1]] == [str(machine_id) for machine_id in range(910, 950)]
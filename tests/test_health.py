@@ -0,0 +1,30 @@
+import time, threading
+import helper
+
+def test_first_pages_wait_for_the_background_checks(monkeypatch):
+    """ On a cold start, the checks run once (in the background thread), not once more per page """
+    runs = []
+    def run_checks():
+        runs.append(threading.current_thread().name)
+        time.sleep(0.2)
+        return "Pass", ""
+    monkeypatch.setattr(helper, "run_checks", run_checks)
+    health_state = helper.HealthState(60)
+
+    verdicts = []
+    pages    = [threading.Thread(target=lambda: verdicts.append(health_state.get_verdict())) for _ in range(3)]
+    for page in pages: page.start()
+    for page in pages: page.join()
+
+    assert verdicts == ["Pass"] * 3
+    assert runs == ["health-checks"]
+
+def test_a_failed_first_check_does_not_keep_pages_waiting(monkeypatch):
+    def run_checks(): raise RuntimeError("Headscale sent something unexpected")
+    monkeypatch.setattr(helper, "run_checks", run_checks)
+    health_state = helper.HealthState(60)
+    health_state.start()
+    assert health_state.first_run.wait(1)
+    # The page then runs the checks itself
+    monkeypatch.setattr(helper, "run_checks", lambda: ("settings_page", ""))
+    assert health_state.get_verdict() == "settings_page"
@@ -0,0 +1,52 @@
+import pytest
+import deadline
+from limiter import UpstreamLimiter, scope
+
+def queue(limiter, name, count, admitted):
+    """ Queues count waiters in a new scope.  Each records its name when admitted. """
+    with scope(name):
+        for number in range(1, count + 1):
+            label = name+str(number)
+            # None means it was admitted without queueing
+            if limiter.enqueue(lambda label=label: admitted.append(label)) is None: admitted.append(label)
+
+def test_queued_requests_are_admitted_round_robin_across_scopes():
+    limiter  = UpstreamLimiter(0, 1, 1)
+    admitted = []
+    limiter.acquire()  # Holds the only slot while the others queue
+    queue(limiter, "machines", 3, admitted)
+    queue(limiter, "users",    2, admitted)
+    assert limiter.stats()["queue_depth"] == 5 and limiter.stats()["queued_scopes"] == 2
+
+    for _ in range(5): limiter.release()
+
+    assert admitted == ["machines1", "users1", "machines2", "users2", "machines3"]
+    assert limiter.stats()["queue_depth"] == 0
+
+def test_no_more_than_the_concurrency_cap_run_at_once():
+    limiter  = UpstreamLimiter(0, 1, 2)
+    admitted = []
+    limiter.acquire()
+    queue(limiter, "page", 2, admitted)
+    assert admitted == ["page1"] and limiter.stats()["active"] == 2
+
+    limiter.release()
+    assert admitted == ["page1", "page2"] and limiter.stats()["active"] == 2
+
+def test_a_waiter_whose_deadline_passes_leaves_the_queue():
+    limiter = UpstreamLimiter(0, 1, 1)
+    limiter.acquire()
+    with deadline.budget(0.05):
+        with pytest.raises(deadline.DeadlineExceeded): limiter.acquire()
+
+    assert limiter.stats()["queue_depth"] == 0
+    limiter.release()
+    assert limiter.stats()["active"] == 0
+
+def test_the_token_bucket_allows_a_burst_and_then_queues():
+    limiter  = UpstreamLimiter(1, 2, 10)
+    admitted = []
+    queue(limiter, "page", 3, admitted)
+
+    assert admitted == ["page1", "page2"]
+    assert limiter.stats()["queue_depth"] == 1
@@ -0,0 +1,30 @@
+from datetime import timedelta
+import renderer, timestamps
+
+def preauth_key(key_id, expires_in, reusable=False, used=False):
+    expiration = (timestamps.now() + expires_in).isoformat()
+    return {"id": str(key_id), "key": "key"+str(key_id)+"0123456789", "reusable": reusable, "used": used, "ephemeral": False, "expiration": expiration}
+
+def row(table, key_id):
+    start = table.index("<tr id='"+str(key_id)+"-albert-tr'")
+    return table[start:table.index("</tr>", start)]
+
+def test_expired_keys_are_not_usable_without_javascript():
+    keys  = {"preAuthKeys": [
+        preauth_key(1, timedelta(days=1)),
+        preauth_key(2, -timedelta(days=1), reusable=True),
+        preauth_key(3, timedelta(days=1), used=True),
+    ]}
+    table = renderer.build_preauth_key_table("albert", keys)
+
+    assert "key-usable" in row(table, 1) and "data-expiration" in row(table, 1)
+    for key_id in (2, 3):
+        assert "class='expired-row'" in row(table, key_id)
+        assert "key-usable" not in row(table, key_id)
+
+def test_usable_keys_match_the_overview_count():
+    local_time = timestamps.now()
+    assert renderer.preauth_key_usable(preauth_key(1, timedelta(hours=1)), local_time)
+    assert renderer.preauth_key_usable(preauth_key(2, timedelta(hours=1), reusable=True, used=True), local_time)
+    assert not renderer.preauth_key_usable(preauth_key(3, -timedelta(hours=1), reusable=True), local_time)
+    assert not renderer.preauth_key_usable(preauth_key(4, timedelta(hours=1), used=True), local_time)
@@ -0,0 +1,30 @@
+import types, pytest
+from datetime import datetime, timedelta, timezone
+import headscale, renewal
+
+def test_check_and_renew_api_key_use_the_same_window(monkeypatch):
+    """ A key the scheduler finds inside the renewal window is renewed, not left for the next check """
+    # Five whole days away by date, but inside the window by the clock
+    expiration = (datetime.now(timezone.utc) + headscale.RENEWAL_WINDOW - timedelta(minutes=1)).isoformat()
+    posted     = []
+    def post(url, path, api_key=None, **kwargs):
+        posted.append(path)
+        return types.SimpleNamespace(status_code=200, json=lambda: {"apiKey": "fedcba9876543210"})
+    monkeypatch.setattr(headscale, "get_api_key",      lambda: "0123456789abcdefghij")
+    monkeypatch.setattr(headscale, "get_api_key_info", lambda url, api_key: {"expiration": expiration})
+    monkeypatch.setattr(headscale, "test_api_key",     lambda url, api_key: 200)
+    monkeypatch.setattr(headscale, "set_api_key",      lambda api_key: True)
+    monkeypatch.setattr(headscale, "expire_key",       lambda url, api_key: 200)
+    monkeypatch.setattr(headscale.client, "post",      post)
+
+    assert renewal.key_renewal.check() == renewal.RENEWAL_MIN_INTERVAL
+    assert posted == ["/api/v1/apikey"]
+
+def test_keys_outside_the_window_are_checked_again_before_it_opens(monkeypatch):
+    expiration = (datetime.now(timezone.utc) + headscale.RENEWAL_WINDOW + timedelta(hours=1)).isoformat()
+    monkeypatch.setattr(headscale, "get_api_key",      lambda: "0123456789abcdefghij")
+    monkeypatch.setattr(headscale, "get_api_key_info", lambda url, api_key: {"expiration": expiration})
+    monkeypatch.setattr(renewal.key_renewal, "renew",  lambda url: pytest.fail("Renewed a key outside the window"))
+
+    assert 59 * 60 < renewal.key_renewal.check() <= 60 * 60
+    assert not headscale.renewal_due(expiration)
@@ -0,0 +1,104 @@
+import asyncio, json, time, types, threading, httpx
+import aioheadscale, deadline, headscale, timestamps, server
+
+API_KEY = "0123456789abcdefghij"
+
+def test_concurrent_test_key_calls_get_an_unmodified_key(fake_headscale):
+    key = {"id": "1", "prefix": API_KEY[0:10], "createdAt": "2023-01-01T00:00:00Z", "expiration": "2023-04-01T00:00:00Z"}
+    async def api_keys(request):
+        await asyncio.sleep(0.2)  # Long enough for every caller to join the same request
+        return httpx.Response(200, json={"apiKeys": [dict(key)]})
+    fake_headscale.routes[("GET", "/api/v1/apikey")] = api_keys
+    headscale.set_api_key(API_KEY)
+    joined = aioheadscale.client.in_flight.joined
+
+    start     = threading.Barrier(4)
+    responses = []
+    def call():
+        with server.app.test_client() as client:
+            start.wait()
+            responses.append(client.get("/api/test_key"))
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+    assert aioheadscale.client.in_flight.joined > joined
+    assert [response.status_code for response in responses] == [200] * 4
+    for response in responses:
+        key_info = json.loads(response.data)
+        assert key_info["createdAt"]  == timestamps.absolute(timestamps.to_local(key["createdAt"]))
+        assert key_info["expiration"] == timestamps.absolute(timestamps.to_local(key["expiration"]))
+
+def test_sync_followers_do_not_inherit_the_leaders_deadline(monkeypatch):
+    """ The leader's request runs without its deadline, so a follower with more time gets the result """
+    budgets = []
+    release = threading.Event()
+    def get(url, path, api_key=None, **kwargs):
+        budgets.append(deadline.remaining())
+        release.wait(2)
+        return types.SimpleNamespace(status_code=200, json=lambda: {"ok": True})
+    monkeypatch.setattr(headscale.client, "get", get)
+
+    results = []
+    def fetch(seconds):
+        with deadline.budget(seconds): results.append(headscale.client.fetch("http://headscale.test", "/api/v1/deadline", API_KEY))
+    joined  = headscale.client.in_flight.joined
+    threads = [threading.Thread(target=fetch, args=(seconds,)) for seconds in (0.01, 30)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)  # The first thread leads, and its deadline passes
+    release.set()
+    for thread in threads: thread.join()
+
+    assert headscale.client.in_flight.joined == joined + 1
+    assert budgets == [None]
+    assert results == [(200, {"ok": True})] * 2
+
+def slow_users(fake_headscale, seconds=0.2):
+    """ Registers a /api/v1/user handler that answers each request with its own number """
+    async def users(request):
+        number = len(fake_headscale.calls)
+        await asyncio.sleep(seconds)
+        return httpx.Response(200, json={"users": [], "request": number})
+    fake_headscale.routes[("GET", "/api/v1/user")] = users
+
+def test_callers_with_different_api_keys_do_not_share_a_request(fake_headscale):
+    slow_users(fake_headscale)
+    async def fetch_both():
+        return await aioheadscale.gather(
+            aioheadscale.client.fetch("http://headscale.test", "/api/v1/user", API_KEY),
+            aioheadscale.client.fetch("http://headscale.test", "/api/v1/user", API_KEY[::-1]),
+        )
+    first, second = aioheadscale.run(fetch_both())
+
+    assert len(fake_headscale.calls) == 2
+    assert first[1]["request"] != second[1]["request"]
+
+def test_callers_after_an_invalidation_do_not_join_an_older_request(fake_headscale):
+    slow_users(fake_headscale)
+    async def fetch_around_invalidation():
+        before = asyncio.ensure_future(aioheadscale.cached_get("users", "http://headscale.test", API_KEY, "/api/v1/user"))
+        await asyncio.sleep(0.05)
+        await aioheadscale.cache.off_loop(aioheadscale.cache.invalidate, "users")
+        after  = await aioheadscale.cached_get("users", "http://headscale.test", API_KEY, "/api/v1/user")
+        return await before, after
+    before, after = aioheadscale.run(fetch_around_invalidation())
+
+    assert len(fake_headscale.calls) == 2
+    assert before["request"] != after["request"]
+
+def test_a_caller_that_runs_out_of_time_does_not_cancel_the_request_for_others(fake_headscale):
+    slow_users(fake_headscale)
+    async def impatient():
+        with deadline.budget(0.05): return await aioheadscale.client.fetch("http://headscale.test", "/api/v1/user", API_KEY)
+    async def fetch_both():
+        return await aioheadscale.gather(
+            impatient(),
+            aioheadscale.client.fetch("http://headscale.test", "/api/v1/user", API_KEY),
+            return_exceptions=True,
+        )
+    impatient_result, patient_result = aioheadscale.run(fetch_both())
+
+    assert isinstance(impatient_result, deadline.DeadlineExceeded)
+    assert patient_result[0] == 200
+    assert len(fake_headscale.calls) == 1
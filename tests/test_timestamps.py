@@ -0,0 +1,48 @@
+import json, shutil, subprocess, pytest
+from datetime import timedelta
+from dateutil import parser
+import helper, timestamps
+
+HEADSCALE_TIMES = [
+    "2023-03-01T12:00:00Z",
+    "2023-03-01T12:00:00.123456789Z",
+    "2023-07-15T23:59:59.5+02:00",
+    "2023-11-05T06:30:00.000000001Z",  # The hour New York leaves daylight saving time
+    "2024-02-29T00:00:00-05:00",
+]
+# Seconds, either side of every threshold in helper.pretty_print_duration and text_color_duration
+DURATIONS = [0, 1, 2, 30, 31, 59, 60, 61, 119, 120, 301, 901, 3599, 3600, 3601, 7199, 7200, 43201, 86399, 86400,
+             86401, 172800, 172801, 432001, 1209601, 2592001, 31536000, 31622400, 63072000, 63158400, 63158401,
+             -1, -59, -3601, -86401]
+
+def test_to_local_matches_dateutil():
+    for value in HEADSCALE_TIMES:
+        baseline = parser.parse(value).astimezone(timestamps.TIMEZONE)
+        local    = timestamps.to_local(value)
+        assert local == baseline
+        assert timestamps.absolute(local) == timestamps.absolute(baseline)
+        assert local.utcoffset() == baseline.utcoffset()
+
+def test_the_zero_time_stays_in_utc():
+    assert timestamps.to_local("0001-01-01T00:00:00Z").year == 1
+
+def test_epoch_is_the_whole_second_the_browser_counts_from():
+    for value in HEADSCALE_TIMES:
+        assert timestamps.epoch(timestamps.to_local(value)) == int(parser.parse(value).timestamp())
+
+@pytest.mark.skipif(shutil.which("node") is None, reason="needs node")
+def test_custom_js_formats_durations_like_helper():
+    with open("static/js/custom.js", "r", encoding="utf-8") as script:
+        source = script.read()
+    functions = source[source.index("function duration_parts"):source.index("function refresh_last_seen_status")]
+    program   = functions + "console.log(JSON.stringify(" + json.dumps(DURATIONS) + ".map(function (seconds) {" \
+        "return [pretty_print_duration(seconds, ''), pretty_print_duration(seconds, 'expiry'), text_color_duration(seconds)] })))"
+    results   = json.loads(subprocess.run(["node", "-e", program], capture_output=True, check=True, text=True).stdout)
+
+    for seconds, result in zip(DURATIONS, results):
+        duration = timedelta(seconds=seconds)
+        assert result == [
+            helper.pretty_print_duration(duration),
+            helper.pretty_print_duration(duration, "expiry"),
+            " ".join(helper.text_color_duration(duration).split()),
+        ], seconds
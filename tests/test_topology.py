@@ -0,0 +1,77 @@
+import random
+from topology import RouteTopology, get_topology
+from samples  import route
+
+EXITS = ("0.0.0.0/0", "::/0")
+
+##################################################################
+# The pairwise scans RouteTopology replaced, as the pages did them
+##################################################################
+def baseline_failover_prefixes(routes):
+    """ Step 2 of the Routes page:  prefixes in more than one route, in order of first appearance """
+    prefixes = []
+    for route_info in routes:
+        for route_check in routes:
+            if route_info["prefix"] not in EXITS and route_info["prefix"] == route_check["prefix"] \
+                and route_info["id"] != route_check["id"] and route_info["prefix"] not in prefixes:
+                prefixes.append(route_info["prefix"])
+    return prefixes
+
+def baseline_ha_enabled(machine_routes, routes):
+    """ The Machines page's HA badge """
+    for route_info in machine_routes:
+        for route_check in routes:
+            if route_check["prefix"] == route_info["prefix"] and route_info["prefix"] not in EXITS \
+                and route_check["id"] != route_info["id"] and route_info["enabled"] and route_check["enabled"]:
+                return True
+    return False
+
+def baseline_counts(routes):
+    """ The Overview page's route and exit counts """
+    counts = {"total": 0, "enabled": 0, "exits": 0, "exits_enabled": 0}
+    for route_info in routes:
+        if int(route_info["machine"]["id"]) == 0: continue
+        counts["total"] += 1
+        if route_info["enabled"] and route_info["advertised"]: counts["enabled"] += 1
+        if route_info["advertised"] and route_info["prefix"] in EXITS:
+            counts["exits"] += 1
+            if route_info["enabled"]: counts["exits_enabled"] += 1
+    return counts
+
+def random_routes(seed):
+    """ Exit pairs, shared subnets and orphaned routes, shuffled """
+    generator = random.Random(seed)
+    routes    = []
+    for machine_id in range(generator.randint(1, 12)):
+        prefixes = generator.sample(["10.0.0.0/24", "10.0.1.0/24", "192.168.1.0/24", "172.16.0.0/16"], generator.randint(0, 3))
+        if generator.random() < 0.3: prefixes += list(EXITS)
+        for prefix in prefixes:
+            routes.append(route(len(routes) + 1, machine_id, prefix, enabled=generator.random() < 0.6, advertised=generator.random() < 0.9))
+    generator.shuffle(routes)
+    return routes
+
+def test_topology_matches_the_baseline_scans():
+    for seed in range(200):
+        routes   = random_routes(seed)
+        topology = RouteTopology(routes)
+
+        assert list(topology.failover_groups) == baseline_failover_prefixes(routes)
+        assert topology.counts() == baseline_counts(routes)
+        for machine_id in {route_info["machine"]["id"] for route_info in routes}:
+            machine_routes = [route_info for route_info in routes if route_info["machine"]["id"] == machine_id]
+            assert topology.machine_routes(machine_id) == machine_routes
+            assert topology.ha_enabled(machine_id) == baseline_ha_enabled(machine_routes, routes)
+            assert topology.exit_nodes.get(machine_id, []) == [route_info for route_info in machine_routes if route_info["prefix"] in EXITS]
+
+def test_failover_colors_follow_the_response_order():
+    routes   = [route(1, 1, "10.0.1.0/24"), route(2, 1, "10.0.0.0/24"), route(3, 2, "10.0.0.0/24"), route(4, 2, "10.0.1.0/24")]
+    topology = RouteTopology(routes)
+
+    assert topology.failover_color_index("10.0.1.0/24") == 0
+    assert topology.failover_color_index("10.0.0.0/24") == 1
+
+def test_the_topology_is_reused_for_the_same_response():
+    all_routes = {"routes": [route(1, 1, "10.0.0.0/24")]}
+
+    assert get_topology(all_routes) is get_topology(all_routes)
+    assert get_topology({"routes": list(all_routes["routes"])}) is not get_topology(all_routes)
@@ -0,0 +1,65 @@
+# pylint: disable=wrong-import-order
+
+import logs, os, pytz, threading
+from datetime import datetime
+from dateutil import parser
+
+logger = logs.get_logger(__name__)
+
+##################################################################
+# Parsing and formatting Headscale's timestamps
+##################################################################
+# Resolved once.  TZ doesn't change while the process runs.
+TIMEZONE = pytz.timezone(os.environ["TZ"] if os.environ["TZ"] else "UTC")
+
+# Machine fields holding a timestamp.  lastSuccessfulUpdate may be null.
+MACHINE_FIELDS = ("lastSeen", "lastSuccessfulUpdate", "createdAt", "expiry")
+
+def parse(value):
+    """ Headscale sends RFC3339 with up to nine fractional digits, which fromisoformat reads
+        (to the microsecond) in Python 3.11.  Anything else goes through dateutil. """
+    try: return datetime.fromisoformat(value)
+    except ValueError: return parser.parse(value)
+
+def to_local(value):
+    """ A Headscale timestamp in TZ.  Go's zero time (0001-01-01) can't move west of UTC, so it stays in UTC. """
+    moment = parse(value)
+    try: return moment.astimezone(TIMEZONE)
+    except OverflowError: return moment
+
+def now():
+    return TIMEZONE.localize(datetime.now())
+
+def absolute(moment):
+    """ The long form used throughout the UI, ie "Monday 01/02/2023, 15:04:05 America/New_York" """
+    return str(moment.strftime('%A %m/%d/%Y, %H:%M:%S'))+" "+str(TIMEZONE)
+
+def epoch(moment):
+    return int(moment.timestamp())
+
+def convert_machines(machines):
+    """ {machine ID: {field: local datetime or None}} for every timestamp in a machines response.
+        Machines share many values (ie, the zero expiry), so each distinct string is parsed once. """
+    converted = {}
+    def local(value):
+        if value is None: return None
+        if value not in converted: converted[value] = to_local(value)
+        return converted[value]
+    return {
+        str(machine["id"]): {field: local(machine[field]) for field in MACHINE_FIELDS}
+        for machine in machines["machines"]
+    }
+
+# The machines response is cached and shared, so its converted timestamps can be too
+last_machine_times      = {"machines": None, "times": None}
+last_machine_times_lock = threading.Lock()
+
+def get_machine_times(machines):
+    """ Returns convert_machines(machines), reusing it for the same response """
+    with last_machine_times_lock:
+        if last_machine_times["machines"] is machines: return last_machine_times["times"]
+    times = convert_machines(machines)
+    with last_machine_times_lock:
+        last_machine_times["machines"] = machines
+        last_machine_times["times"]    = times
+    return times
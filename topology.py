@@ -0,0 +1,82 @@
+# pylint: disable=wrong-import-order
+
+import logs, threading
+
+logger = logs.get_logger(__name__)
+
+##################################################################
+# Route topology:  indexes over a single /api/v1/routes response
+##################################################################
+EXIT_PREFIXES = ("0.0.0.0/0", "::/0")
+
+def is_exit_prefix(prefix):
+    return prefix in EXIT_PREFIXES
+
+class RouteTopology():
+    """ Indexes a routes response once so pages never scan it pairwise """
+    def __init__(self, routes):
+        self.routes     = routes
+        self.by_id      = {}  # route ID   -> route
+        self.by_prefix  = {}  # prefix     -> [routes], in response order
+        self.by_machine = {}  # machine ID -> [routes], in response order
+        self.exit_nodes = {}  # machine ID -> [exit routes] (the IPv4 and IPv6 pair)
+
+        for route in routes:
+            machine_id = str(route["machine"]["id"])
+            self.by_id[str(route["id"])] = route
+            self.by_prefix.setdefault(route["prefix"], []).append(route)
+            self.by_machine.setdefault(machine_id, []).append(route)
+            if is_exit_prefix(route["prefix"]):
+                self.exit_nodes.setdefault(machine_id, []).append(route)
+
+        # Failover groups are non-exit prefixes advertised by more than one route.
+        # Their order (first appearance in the response) fixes each group's color.
+        self.failover_groups = {
+            prefix: group for prefix, group in self.by_prefix.items()
+            if not is_exit_prefix(prefix) and len(group) > 1
+        }
+        self.failover_index = {prefix: index for index, prefix in enumerate(self.failover_groups)}
+        logger.info("Indexed %i routes (%i failover groups, %i exit nodes)", len(routes), len(self.failover_groups), len(self.exit_nodes))
+
+    def machine_routes(self, machine_id):
+        return self.by_machine.get(str(machine_id), [])
+
+    def is_failover(self, route):
+        return route["prefix"] in self.failover_groups
+
+    def failover_color_index(self, prefix):
+        return self.failover_index[prefix]
+
+    def ha_enabled(self, machine_id):
+        """ True if the machine has an enabled route whose failover partner is also enabled """
+        for route in self.machine_routes(machine_id):
+            if not route["enabled"] or not self.is_failover(route): continue
+            for partner in self.failover_groups[route["prefix"]]:
+                if partner["id"] != route["id"] and partner["enabled"]: return True
+        return False
+
+    def counts(self):
+        """ Route and exit counts for the Overview page.  Routes on machine 0 are orphaned. """
+        counts = {"total": 0, "enabled": 0, "exits": 0, "exits_enabled": 0}
+        for route in self.routes:
+            if int(route["machine"]["id"]) == 0: continue
+            counts["total"] += 1
+            if route["enabled"] and route["advertised"]: counts["enabled"] += 1
+            if route["advertised"] and is_exit_prefix(route["prefix"]):
+                counts["exits"] += 1
+                if route["enabled"]: counts["exits_enabled"] += 1
+        return counts
+
+# The routes response is cached and shared, so the topology built for it can be too
+last_topology      = {"routes": None, "topology": None}
+last_topology_lock = threading.Lock()
+
+def get_topology(all_routes):
+    """ Returns the RouteTopology for a routes response, reusing it for the same response """
+    with last_topology_lock:
+        if last_topology["routes"] is all_routes: return last_topology["topology"]
+    route_topology = RouteTopology(all_routes["routes"])
+    with last_topology_lock:
+        last_topology["routes"]   = all_routes
+        last_topology["topology"] = route_topology
+    return route_topology